@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmarks of padova's hot paths: parsing isochrone and luminosity function
+tables, building and hashing settings, reading and writing the result
+cache, joining isochrone sets and exporting isochrones for StarFISH.
+
+Each benchmark runs on the bundled tables (``isocz0120.dat``,
+``lf_0019.dat`` and ``lf_1gyr_0019.dat``) and on synthetic grids made by
+repeating the bundled isochrones at other metallicities, scaled up to
+thousands of isochrones. The best time of several runs and the peak memory
+allocated during a run are recorded::
+
+    python benchmarks/hotpaths.py --output results.json
+
+Results are written as JSON, and can be compared with those of another
+version of padova::
+
+    python benchmarks/hotpaths.py --compare results.json
+
+Peak memory is measured with :mod:`tracemalloc` (Python 3.4+); it is
+``null`` where tracemalloc is not available.
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+from pkg_resources import resource_string
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import padova
+from padova.isocdata import IsochroneSet, join_isochrone_sets
+from padova.lfdata import LFTable
+from padova.resultcache import PadovaCache
+from padova.settings import Settings
+
+
+def bundled_text(name):
+    """Text of a bundled data file."""
+    return resource_string('padova', 'data/' + name).decode('utf-8')
+
+
+def synthetic_isochrone_table(n_isochrones):
+    """An isochrone table of `n_isochrones` isochrones, made by repeating
+    the bundled isochrones with relabelled metallicities.
+    """
+    text = bundled_text('isocz0120.dat')
+    header, body = text.split('#\tIsochrone', 1)
+    blocks = ['#\tIsochrone' + b for b in body.split('#\tIsochrone')]
+    parts = [header]
+    for i in range(n_isochrones):
+        z = 0.0001 * (1 + i // len(blocks))
+        parts.append(blocks[i % len(blocks)].replace(
+            'Z = 0.01200', 'Z = {0:.5f}'.format(z), 1))
+    return ''.join(parts)
+
+
+def measure(func, repeat):
+    """Best time (seconds) of `repeat` calls of `func`, and the peak memory
+    allocated (bytes) during a call.
+    """
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def benchmarks(scales):
+    """Generate ``(name, data, size, func)`` benchmarks.
+
+    Parameters
+    ----------
+    scales : list
+        Numbers of isochrones of the synthetic grids.
+    """
+    tables = [('isocz0120.dat', bundled_text('isocz0120.dat'))]
+    tables += [('synthetic', synthetic_isochrone_table(n)) for n in scales]
+    n_processes = multiprocessing.cpu_count()
+    for name, text in tables:
+        isoc_set = IsochroneSet(io.StringIO(text))
+        size = len(isoc_set)
+
+        yield ('IsochroneSet', name, size,
+               lambda text=text: IsochroneSet(io.StringIO(text)))
+
+        # Parallel parsing, on all cores, reads from a file
+        fd, path = tempfile.mkstemp(prefix='padova-bench-', suffix='.dat')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(text.encode('utf-8'))
+        try:
+            def parse_parallel(path=path):
+                with open(path) as f:
+                    IsochroneSet(f, n_processes=n_processes)
+            yield ('IsochroneSet(n_processes)', name, size, parse_parallel)
+        finally:
+            os.remove(path)
+
+        def join(isoc_set=isoc_set):
+            # The join rebuilds its left set, so join a fresh view of it
+            left = IsochroneSet.from_array(isoc_set.data, isoc_set.offsets,
+                                           isoc_set.metas,
+                                           isoc_set.header_lines)
+            join_isochrone_sets(left, isoc_set, right_bands=['J', 'H', 'Ks'])
+        yield ('join_isochrone_sets', name, size, join)
+
+        def export(isoc_set=isoc_set):
+            output_dir = tempfile.mkdtemp(prefix='padova-bench-')
+            try:
+                for isoc in isoc_set:
+                    isoc.export_for_starfish(output_dir)
+            finally:
+                shutil.rmtree(output_dir)
+        yield ('export_for_starfish', name, size, export)
+
+        def export_set(isoc_set=isoc_set):
+            output_dir = tempfile.mkdtemp(prefix='padova-bench-')
+            try:
+                isoc_set.export_for_starfish(output_dir)
+            finally:
+                shutil.rmtree(output_dir)
+        yield ('IsochroneSet.export_for_starfish', name, size, export_set)
+
+        def cache_set_get(text=text, isoc_set=isoc_set):
+            cache_dir = tempfile.mkdtemp(prefix='padova-bench-')
+            try:
+                cache = PadovaCache(cache_dir=cache_dir)
+                settings = Settings.load_package_settings()
+                cache[settings] = text
+                cache[settings]
+                cache.set_isochrone_set(settings, isoc_set)
+                np.array(cache.get_isochrone_set(settings).data)
+            finally:
+                shutil.rmtree(cache_dir)
+        yield ('PadovaCache', name, size, cache_set_get)
+
+    for name in ('lf_0019.dat', 'lf_1gyr_0019.dat'):
+        text = bundled_text(name)
+        yield ('LFTable', name, len(LFTable(io.StringIO(text)).lfs),
+               lambda text=text: LFTable(io.StringIO(text)))
+
+    for n in [1000]:
+        def settings(n=n):
+            for i in range(n):
+                # The cache key of the settings
+                s = Settings.load_package_settings(
+                    isoc_zeta=0.0001 + 0.00001 * i, photsys_file='2mass')
+                s.__hash__()
+        yield ('Settings', 'construct+hash', n, settings)
+
+
+def run(scales=(710, 2130), repeat=3, only=None):
+    """Run the benchmarks.
+
+    Parameters
+    ----------
+    scales : list
+        Numbers of isochrones of the synthetic grids.
+    repeat : int
+        Number of timed runs of each benchmark.
+    only : list
+        Names of the benchmarks to run; all if ``None``.
+
+    Returns
+    -------
+    results : dict
+        Versions of padova, Python and numpy, and a ``benchmarks`` list of
+        results with the ``name``, ``data``, ``size``, best ``time_s`` and
+        ``peak_bytes`` of each benchmark.
+    """
+    results = []
+    for name, data, size, func in benchmarks(scales):
+        if only is not None and name not in only:
+            continue
+        time_s, peak = measure(func, repeat)
+        results.append({'name': name, 'data': data, 'size': size,
+                        'time_s': time_s, 'peak_bytes': peak})
+    return {'padova': padova.__version__,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'repeat': repeat,
+            'benchmarks': results}
+
+
+def compare(results, reference):
+    """Print the ratios of times and peak memory of `results` to those of
+    the `reference` results.
+    """
+    ref = dict(((b['name'], b['data'], b['size']), b)
+               for b in reference['benchmarks'])
+    print('{0:<34s} {1:<18s} {2:>6s} {3:>10s} {4:>8s} {5:>8s}'.format(
+        'benchmark', 'data', 'size', 'time (s)', 'time', 'memory'))
+    for b in results['benchmarks']:
+        r = ref.get((b['name'], b['data'], b['size']))
+        time_ratio = mem_ratio = '-'
+        if r is not None:
+            time_ratio = '{0:.2f}x'.format(b['time_s'] / r['time_s'])
+            if b['peak_bytes'] and r['peak_bytes']:
+                mem_ratio = '{0:.2f}x'.format(b['peak_bytes'] /
+                                              r['peak_bytes'])
+        print('{0:<34s} {1:<18s} {2:>6d} {3:>10.4f} {4:>8s} {5:>8s}'.format(
+            b['name'], b['data'], b['size'], b['time_s'], time_ratio,
+            mem_ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark padova parsing, caching, joining and export.')
+    parser.add_argument('--scales', type=int, nargs='*', default=[710, 2130],
+                        help='numbers of isochrones of the synthetic grids')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs of each benchmark')
+    parser.add_argument('--only', nargs='*',
+                        help='names of the benchmarks to run')
+    parser.add_argument('--output',
+                        help='JSON file to write the results to '
+                             '(default: standard output)')
+    parser.add_argument('--compare',
+                        help='JSON results of a reference run to compare '
+                             'with')
+    args = parser.parse_args()
+    results = run(scales=args.scales, repeat=args.repeat, only=args.only)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    elif args.output is None:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
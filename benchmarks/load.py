@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Load benchmark of CMD requests, through the full fetch, cache and parse
+path, against the stand-in CMD server of :mod:`padova.cmdserver`.
+
+Each request has distinct settings, so that it goes to the server, and
+is cached and parsed into an isochrone set in an empty cache directory.
+Reports the throughput (requests per second) and latency percentiles::
+
+    python benchmarks/load.py --requests 200 --concurrency 8 --latency 0.05
+
+Pass ``--json`` to print the results as JSON.
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import json
+import shutil
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from padova.cmdserver import StandInCMDServer
+from padova.interface import CMDSession, CMDRequest, HostLimiter
+from padova.resultcache import PadovaCache
+from padova.settings import Settings
+
+
+def run(n_requests=100, concurrency=4, latency=0., compress=True):
+    """Run the load benchmark.
+
+    Parameters
+    ----------
+    n_requests : int
+        Number of requests.
+    concurrency : int
+        Number of requests in flight at once.
+    latency : float
+        Server delay before each response (seconds); each request waits
+        for it twice, once per CMD request step.
+    compress : bool
+        Serve gzipped outputs.
+
+    Returns
+    -------
+    results : dict
+        The benchmark settings, ``requests_per_sec``, and the ``p50``,
+        ``p90``, ``p99``, ``max`` and ``mean`` latencies of the requests
+        (``latency_ms``, in milliseconds).
+    """
+    cache_dir = tempfile.mkdtemp(prefix='padova-load-')
+    server = StandInCMDServer(latency=latency, compress=compress,
+                              max_outputs=max(1000, 2 * n_requests))
+    try:
+        with server:
+            HostLimiter.configure(server.url, max_concurrent=concurrency,
+                                  min_interval=0.)
+            session = CMDSession(webserver=server.url, pool_size=concurrency)
+            cache = PadovaCache(cache_dir=cache_dir)
+            # Distinct settings, each served from the bundled isochrones
+            zs = np.linspace(0.001, 0.03, 30)
+            log_ages = np.arange(6.6, 10.1, 0.05)
+            settings = [Settings.load_package_settings(
+                isoc_val='0', isoc_zeta=float(zs[i % len(zs)]),
+                isoc_age=float(10. ** log_ages[(i // len(zs)) %
+                                               len(log_ages)]))
+                for i in range(n_requests)]
+            latencies = []
+            lock = threading.Lock()
+
+            def request(s):
+                start = time.time()
+                CMDRequest(s, session=session, cache=cache).isochrone_set
+                with lock:
+                    latencies.append(time.time() - start)
+
+            pool = ThreadPool(concurrency)
+            start = time.time()
+            pool.map(request, settings)
+            elapsed = time.time() - start
+            pool.close()
+            pool.join()
+            session.close()
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    latencies = np.array(latencies) * 1000.
+    return {'requests': n_requests,
+            'concurrency': concurrency,
+            'server_latency_s': latency,
+            'compress': compress,
+            'elapsed_s': elapsed,
+            'requests_per_sec': n_requests / elapsed,
+            'latency_ms': {'p50': float(np.percentile(latencies, 50)),
+                           'p90': float(np.percentile(latencies, 90)),
+                           'p99': float(np.percentile(latencies, 99)),
+                           'max': float(latencies.max()),
+                           'mean': float(latencies.mean())}}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load benchmark of CMD requests against a stand-in '
+                    'CMD server.')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='number of requests')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='number of requests in flight at once')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='server delay before each response (seconds)')
+    parser.add_argument('--no-compress', dest='compress',
+                        action='store_false',
+                        help='serve uncompressed outputs')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+    results = run(n_requests=args.requests, concurrency=args.concurrency,
+                  latency=args.latency, compress=args.compress)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print('{0:d} requests, {1:d} concurrent: {2:.1f} requests/s'.format(
+        results['requests'], results['concurrency'],
+        results['requests_per_sec']))
+    print('latency (ms): ' + ', '.join(
+        '{0} {1:.1f}'.format(k, results['latency_ms'][k])
+        for k in ('p50', 'p90', 'p99', 'max', 'mean')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+asyncio interface to the Padova group's CMD web interface for isochrones.
+
+This module requires Python 3.7 or later. Both steps of a CMD request (the
+form submission and the download of the ``outputNNN.dat`` file) run on the
+event loop over :mod:`asyncio` streams, while cache access and table parsing
+run in an executor so that they never block the loop::
+
+    from padova.settings import Settings
+    from padova.asyncinterface import fetch_isochrones
+
+    settings = Settings.load_package_settings(isoc_age=1e9)
+    isochrone_set = await fetch_isochrones(settings)
+
+Requests share the per-host limits of :class:`padova.interface.HostLimiter`:
+at most ``max_concurrent`` requests per event loop are in flight to a
+server, and requests start at least ``min_interval`` seconds apart, also
+counting threaded requests made with :mod:`padova.cmd`.
+"""
+
+import asyncio
+import re
+import threading
+import weakref
+import zlib
+from io import StringIO
+from urllib.parse import urljoin, urlsplit
+
+from padova.interface import WEBSERVER, CMDErrorParser, HostLimiter
+from padova.resultcache import PadovaCache
+from padova.utils import compression_type
+from padova.isocdata import IsochroneSet
+
+
+# Semaphores bounding concurrent requests to each host, per event loop
+_semaphores = weakref.WeakKeyDictionary()
+
+
+class AsyncCMDClient(object):
+    """Request isochrones from CMD without blocking the event loop.
+
+    Parameters
+    ----------
+    webserver : str
+        Base URL of the CMD server.
+    cache : :class:`padova.resultcache.PadovaCache`
+        Cache of CMD results. Defaults to the user's padova cache.
+    executor : :class:`concurrent.futures.Executor`
+        Executor for cache access and parsing. Defaults to the event loop's
+        default executor.
+    timeout : tuple
+        ``(connect, read)`` timeouts of each HTTP exchange (seconds). The
+        read timeout bounds the whole response, and an
+        :class:`asyncio.TimeoutError` is raised if it is exceeded.
+    max_redirects : int
+        Maximum number of HTTP redirects followed by each exchange.
+    """
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, webserver=WEBSERVER, cache=None, executor=None,
+                 timeout=(10., 300.), max_redirects=5):
+        super(AsyncCMDClient, self).__init__()
+        self._webserver = webserver
+        if cache is None:
+            cache = PadovaCache()
+        self._cache = cache
+        self._executor = executor
+        self._timeout = timeout
+        self._max_redirects = max_redirects
+
+    @classmethod
+    def default(cls):
+        """The client shared by calls to :func:`fetch_isochrones`."""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    async def _run(self, func, *args):
+        """Run a blocking function in the executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def fetch(self, settings):
+        """Raw CMD output for `settings`, from the cache or the server.
+
+        Parameters
+        ----------
+        settings : :class:`padova.settings.Settings`
+            A settings instance loaded with user settings.
+        """
+        # Only one client, thread or process requests the same settings at
+        # once; the others wait for the cached result
+        lock = self._cache.lock(settings)
+        await self._run(lock.acquire)
+        try:
+            if await self._run(self._cache.__contains__, settings):
+                return await self._run(self._cache.__getitem__, settings)
+            r = await self._request(settings)
+            await self._run(self._cache.__setitem__, settings, r)
+        finally:
+            lock.release()
+        return r
+
+    async def fetch_isochrones(self, settings):
+        """The :class:`padova.isocdata.IsochroneSet` for `settings`.
+
+        Parameters
+        ----------
+        settings : :class:`padova.settings.Settings`
+            A settings instance loaded with user settings.
+        """
+        if await self._run(self._cache.has_isochrone_set, settings):
+            return await self._run(self._cache.get_isochrone_set, settings)
+        r = await self.fetch(settings)
+        lock = self._cache.lock(settings, '.npy')
+        await self._run(lock.acquire)
+        try:
+            if await self._run(self._cache.has_isochrone_set, settings):
+                return await self._run(self._cache.get_isochrone_set,
+                                       settings)
+            isoc_set = await self._run(_parse_isochrone_set, r)
+            await self._run(self._cache.set_isochrone_set, settings,
+                            isoc_set)
+        finally:
+            lock.release()
+        return isoc_set
+
+    def _semaphore(self):
+        """The semaphore bounding requests to the CMD server on this loop.
+        """
+        limiter = HostLimiter.for_host(self._webserver)
+        loop = asyncio.get_running_loop()
+        semaphores = _semaphores.setdefault(loop, {})
+        if self._webserver not in semaphores:
+            semaphores[self._webserver] = asyncio.Semaphore(
+                limiter.max_concurrent)
+        return semaphores[self._webserver]
+
+    async def _request(self, settings):
+        """Request isochromes from CMD."""
+        async with self._semaphore():
+            wait = HostLimiter.for_host(self._webserver).reserve_start()
+            if wait > 0.:
+                await asyncio.sleep(wait)
+            q = settings.query
+            c = await self._http('POST', self._webserver + '/cgi-bin/cmd',
+                                 q.encode('utf8'))
+            c = c.decode('utf8')
+            # Find the output dataset URL in the HTML that CMD returns
+            fname = re.findall(r'output\d+', c)
+            if len(fname) == 0:
+                message = 'Server Response is incorrect'
+                if "errorwarning" in c:
+                    p = CMDErrorParser()
+                    p.feed(c)
+                    message = '\n'.join([message] + p.data).strip()
+                raise RuntimeError(message)
+            url = '{0}/~lgirardi/tmp/{1}.dat'.format(self._webserver,
+                                                     fname[0])
+            r = await self._http('GET', url)
+        # Decompress the data if necessary
+        if compression_type(r, stream=True) is not None:
+            r = zlib.decompress(r, 15 + 32)
+        return r.decode('utf8')
+
+    async def _http(self, method, url, body=None):
+        """Make an HTTP request, following redirects, and return the
+        response body.
+        """
+        for i in range(self._max_redirects + 1):
+            status, headers, content = await self._exchange(method, url,
+                                                            body)
+            if status in (301, 302, 303, 307, 308) \
+                    and 'location' in headers:
+                url = urljoin(url, headers['location'])
+                if status == 303 or (status in (301, 302)
+                                     and method == 'POST'):
+                    method, body = 'GET', None
+                continue
+            if status != 200:
+                raise RuntimeError(
+                    'Server Response is incorrect: {0:d}'.format(status))
+            return content
+        raise RuntimeError('Too many redirects from {0}'.format(url))
+
+    async def _exchange(self, method, url, body=None):
+        """Make a single HTTP/1.0 request.
+
+        Returns
+        -------
+        status : int
+            HTTP status code.
+        headers : dict
+            Response headers, with lower-case names.
+        content : bytes
+            Response body.
+        """
+        connect_timeout, read_timeout = self._timeout
+        parts = urlsplit(url)
+        https = parts.scheme == 'https'
+        port = parts.port or (443 if https else 80)
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, port, ssl=https or None),
+            connect_timeout)
+        try:
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            lines = ['{0} {1} HTTP/1.0'.format(method, path),
+                     'Host: {0}'.format(parts.netloc)]
+            if body is not None:
+                lines.append('Content-Type: application/x-www-form-urlencoded')
+                lines.append('Content-Length: {0:d}'.format(len(body)))
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+            if body is not None:
+                writer.write(body)
+            return await asyncio.wait_for(_read_response(reader, writer),
+                                          read_timeout)
+        finally:
+            writer.close()
+
+
+async def _read_response(reader, writer):
+    """Read the status, headers and body of an HTTP response."""
+    await writer.drain()
+    status = (await reader.readline()).split()
+    if len(status) < 2 or not status[1].isdigit():
+        raise RuntimeError('Server Response is incorrect: {0}'.format(
+            b' '.join(status).decode('latin-1')))
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()  # CRLF after each chunk
+        content = b''.join(chunks)
+    elif 'content-length' in headers:
+        content = await reader.readexactly(int(headers['content-length']))
+    else:
+        # Without a length the body ends when the server closes
+        content = await reader.read()
+    return int(status[1]), headers, content
+
+
+def _parse_isochrone_set(r):
+    return IsochroneSet(StringIO(r))
+
+
+async def fetch_isochrones(settings, **kwargs):
+    """Request isochrones from CMD without blocking the event loop.
+
+    Parameters
+    ----------
+    settings : :class:`padova.settings.Settings`
+        A settings instance loaded with user settings.
+    kwargs :
+        Arguments for :class:`AsyncCMDClient`. Without arguments, the
+        shared :meth:`AsyncCMDClient.default` client is used.
+
+    Returns
+    -------
+    isochrone_set : :class:`padova.isocdata.IsochroneSet`
+        The requested isochrones.
+    """
+    if len(kwargs) > 0:
+        client = AsyncCMDClient(**kwargs)
+    else:
+        client = AsyncCMDClient.default()
+    return await client.fetch_isochrones(settings)
@@ -4,7 +4,94 @@
 Tools for reading CMD-interface tables outputs.
 """
 
-from collections import deque
+from collections import OrderedDict, deque
+
+import numpy as np
+
+
+# Characters that numpy.genfromtxt strips from column names; we strip the same
+# set so that column names are unchanged from earlier versions of padova.
+_DELETECHARS = set(r"""~!@#$%^&*()-=+~\|]}[{';: /?.>,<""" + '"')
+
+# numpy.loadtxt is implemented in C from numpy 1.23; before that it is slower
+# than converting columns of split lines.
+_FAST_LOADTXT = tuple(int(v) for v in np.__version__.split('.')[:2]) \
+    >= (1, 23)
+
+# Number of rows used to spot columns holding labels or blanks
+_N_PROBE = 100
+
+
+def sanitize_colname(name):
+    """Strip characters from a CMD column name that are awkward in a
+    structured array field name, e.g. ``log(age/yr)`` becomes ``logageyr``.
+    """
+    return ''.join(c for c in name if c not in _DELETECHARS)
+
+
+def column_layout(dt, n_rows):
+    """Layout of a columnar buffer: the columns of a table of dtype `dt`
+    and `n_rows` rows, stored one after the other.
+
+    Returns
+    -------
+    offsets : list
+        Byte offset of each column in the buffer. Columns are aligned to
+        their item size.
+    n_bytes : int
+        Size of the buffer.
+    """
+    dt = np.dtype(dt)
+    offsets = []
+    n_bytes = 0
+    for name in dt.names:
+        itemsize = dt[name].itemsize
+        n_bytes += -n_bytes % itemsize
+        offsets.append(n_bytes)
+        n_bytes += itemsize * n_rows
+    return offsets, n_bytes
+
+
+def column_views(buffer, dt, n_rows):
+    """Columns of a columnar buffer (see :func:`column_layout`).
+
+    Parameters
+    ----------
+    buffer : :class:`numpy.ndarray`
+        The buffer, a ``uint8`` array (which may be memory-mapped).
+    dt : :class:`numpy.dtype`
+        Structured dtype of the table, giving the column names and types.
+    n_rows : int
+        Number of rows of the table.
+
+    Returns
+    -------
+    columns : :class:`collections.OrderedDict`
+        Arrays of each column, views of the buffer, by name.
+    """
+    dt = np.dtype(dt)
+    offsets, n_bytes = column_layout(dt, n_rows)
+    if len(buffer) != n_bytes:
+        raise ValueError('Buffer of {0:d} bytes does not match {1:d} rows of '
+                         '{2}'.format(len(buffer), n_rows, dt))
+    return OrderedDict(
+        (name, buffer[o:o + dt[name].itemsize * n_rows].view(dt[name]))
+        for name, o in zip(dt.names, offsets))
+
+
+def empty_columns(dt, n_rows):
+    """Allocate a columnar buffer for a table of dtype `dt`.
+
+    Returns
+    -------
+    buffer : :class:`numpy.ndarray`
+        The ``uint8`` buffer.
+    columns : :class:`collections.OrderedDict`
+        Uninitialized columns, views of the buffer (see
+        :func:`column_views`).
+    """
+    buffer = np.empty(column_layout(dt, n_rows)[1], dtype=np.uint8)
+    return buffer, column_views(buffer, dt, n_rows)
 
 
 class BaseReader(object):
@@ -14,14 +101,29 @@ class BaseReader(object):
         self._f = f  # file handle
         self._read()
 
-    def _prescan_table(self, n_header_lines):
-        """Find lines where individual isochrones start."""
-        header_lines = []
+    def _scan_table(self, n_header_lines):
+        """Read the table in a single pass, splitting header and data lines.
+
+        Each data block is annotated with the ``start`` and ``end`` file
+        line indices of its data, and with ``row0`` and ``row1``, the slice
+        of the block's rows in ``data_lines``.
 
+        Returns
+        -------
+        header_lines : list
+            Global header lines.
+        data_blocks : list
+            List of dicts describing each data block.
+        data_lines : list
+            All data lines in the file, in order.
+        """
+        header_lines = []
         data_blocks = []
+        data_lines = []
         hdeque = deque()
         self._f.seek(0)
         block = None
+        i = -1
         for i, line in enumerate(self._f):
             if line.startswith('#'):
                 # This is a header line
@@ -29,21 +131,173 @@ class BaseReader(object):
                     block = {}
                     if len(data_blocks) > 0:
                         data_blocks[-1]['end'] = i - 1
+                        data_blocks[-1]['row1'] = len(data_lines)
                 hdeque.append(line.lstrip('#').strip())
-            elif block is not None:
-                # This is a data line;
-                # Close the block
-                block['start'] = i
-                block['header_lines'] = [hdeque.pop()
-                                         for j in xrange(n_header_lines)][::-1]
-                data_blocks.append(block)
-
-                # Treat excess header lines as a global header
-                while len(hdeque) > 0:
-                    header_lines.append(hdeque.popleft())
-
-                block = None
+            elif not line.strip():
+                continue
+            else:
+                if block is not None:
+                    # First data line of a block; close the block's header
+                    block['start'] = i
+                    block['row0'] = len(data_lines)
+                    block['header_lines'] = [hdeque.pop()
+                                             for j in range(n_header_lines)]
+                    block['header_lines'].reverse()
+                    data_blocks.append(block)
+
+                    # Treat excess header lines as a global header
+                    while len(hdeque) > 0:
+                        header_lines.append(hdeque.popleft())
+
+                    block = None
+                data_lines.append(line)
+        if len(data_blocks) == 0:
+            raise ValueError('No data blocks found in table')
         data_blocks[-1]['end'] = i
-        n_lines = i + 1
+        data_blocks[-1]['row1'] = len(data_lines)
+        return header_lines, data_blocks, data_lines
+
+    def _prescan_table(self, f, n_header_lines):
+        """Find the data blocks of a table without parsing them.
+
+        Like :meth:`_scan_table`, but for binary files (or memory maps):
+        each data block is annotated with the byte offsets of its data,
+        ``start`` and ``end``, its number of rows, ``n_rows``, and its
+        first data line, ``first_row``.
+
+        Returns
+        -------
+        header_lines : list
+            Global header lines.
+        data_blocks : list
+            List of dicts describing each data block.
+        """
+        header_lines = []
+        data_blocks = []
+        hdeque = deque()
+        f.seek(0)
+        block = None
+        pos = 0
+        for line in iter(f.readline, b''):
+            if line.startswith(b'#'):
+                if block is None:
+                    block = {}
+                    if len(data_blocks) > 0:
+                        data_blocks[-1]['end'] = pos
+                hdeque.append(line.decode('utf-8').lstrip('#').strip())
+            elif line.strip():
+                if block is not None:
+                    block['start'] = pos
+                    block['n_rows'] = 0
+                    block['first_row'] = line.decode('utf-8')
+                    block['header_lines'] = [hdeque.pop()
+                                             for j in range(n_header_lines)]
+                    block['header_lines'].reverse()
+                    data_blocks.append(block)
+                    while len(hdeque) > 0:
+                        header_lines.append(hdeque.popleft())
+                    block = None
+                if len(data_blocks) > 0:
+                    data_blocks[-1]['n_rows'] += 1
+            pos += len(line)
+        if len(data_blocks) == 0:
+            raise ValueError('No data blocks found in table')
+        data_blocks[-1]['end'] = pos
+        return header_lines, data_blocks
+
+    @staticmethod
+    def _parse_data(lines, dt, delimiter='\t', labels=None, out=None,
+                    usecols=None):
+        """Convert data lines into a structured array of dtype `dt`.
+
+        Lines are split on `delimiter` (``None`` for any whitespace); each
+        line must have at least one field per column, and extra trailing
+        fields are ignored. Numeric columns are converted in bulk. Columns
+        with blank fields or text labels (such as the ``stage`` column of
+        CMD 2.5 outputs) are converted value by value, with ``-1`` for
+        invalid integers and ``nan`` for invalid floats, as with
+        :func:`numpy.genfromtxt`. If a `labels` dict is given, the raw
+        strings of those columns are stored in it, keyed by column name.
+
+        If `out` is given, a mapping of column names to arrays of one item
+        per line (such as the columns of :func:`empty_columns`), the
+        columns are converted into it, and it is returned.
+
+        If `usecols` is given, the fields of `dt` are read from those
+        (0-based) columns of the lines, and other columns are not
+        converted; by default the lines have one column per field.
+        """
+        dt = np.dtype(dt)
+        names = dt.names
+        if usecols is None:
+            usecols = range(len(names))
+        usecols = dict(zip(names, usecols))
+        n_cols = max(usecols.values()) + 1 if len(names) > 0 else 0
+        rows = [line.split(delimiter) for line in lines]
+        # Skip the empty field if lines start with a delimiter
+        skip = 0
+        if delimiter is not None and len(rows) > 0 \
+                and not rows[0][0].strip():
+            skip = 1
+        lengths = np.array([len(parts) for parts in rows]) - skip
+        short = np.flatnonzero(lengths < n_cols)
+        if len(short) > 0:
+            i = short[0]
+            raise ValueError('Expected {0:d} fields in data row {1:d}, '
+                             'found {2:d}: {3!r}'.format(
+                                 n_cols, i, lengths[i], lines[i]))
+
+        data = out if out is not None else np.empty(len(rows), dtype=dt)
+        remaining = list(names)
+        if _FAST_LOADTXT and len(rows) > 0:
+            # Columns with labels or blanks in the first rows are left to
+            # the value-by-value conversion; loadtxt parses the rest in C.
+            numeric = [name for name in names
+                       if _is_numeric([parts[usecols[name] + skip]
+                                       for parts in rows[:_N_PROBE]],
+                                      dt[name].type)]
+            try:
+                parsed = np.loadtxt(
+                    lines, delimiter=delimiter, comments=None, ndmin=1,
+                    dtype=[(name, dt[name]) for name in numeric],
+                    usecols=[usecols[name] + skip for name in numeric])
+            except ValueError:
+                # A label further down a column; convert column by column
+                pass
+            else:
+                for name in numeric:
+                    data[name][...] = parsed[name]
+                remaining = [name for name in names if name not in numeric]
+
+        for name in remaining:
+            j = usecols[name] + skip
+            column = [parts[j] for parts in rows]
+            typ = dt[name].type
+            try:
+                data[name][...] = np.array(column, dtype=typ)
+            except ValueError:
+                # Convert each distinct string once; label columns have few
+                converted = dict((v, _convert(v, typ)) for v in set(column))
+                data[name][...] = [converted[v] for v in column]
+                if labels is not None:
+                    labels[name] = column
+        return data
+
+
+def _is_numeric(values, typ):
+    """``True`` if all `values` can be converted to `typ`."""
+    try:
+        np.array(values, dtype=typ)
+    except ValueError:
+        return False
+    return True
+
 
-        return header_lines, data_blocks, n_lines
+def _convert(value, typ):
+    """Convert a single table value, using a fill value if it is invalid."""
+    try:
+        return typ(value)
+    except ValueError:
+        if issubclass(typ, np.integer):
+            return -1
+        return np.nan
@@ -6,8 +6,68 @@ Python interface to the Padova group's CMD web interface for isochrones.
 
 from __future__ import print_function, unicode_literals, division
 
+from collections import OrderedDict
+
+import numpy as np
+
 from padova.settings import Settings
 from padova.interface import CMDRequest
+from padova.resultcache import PadovaCache
+from padova.isocdata import IsochroneSet, concatenate_isochrone_sets
+
+
+def _grid_nodes(start, stop, step):
+    """Values of the nodes of a grid.
+
+    Parameters
+    ----------
+    start, stop, step : float
+        Grid specification; nodes are at ``start + i * step`` up to and
+        including `stop`.
+
+    Returns
+    -------
+    nodes : list
+        Node values, rounded to remove floating point noise.
+    """
+    n_nodes = int(np.floor((stop - start) / step + 1e-6)) + 1
+    nodes = np.round(start + step * np.arange(n_nodes), 10)
+    return [float(v) for v in nodes]
+
+
+def _node_runs(indices, chunk_size=None):
+    """Group sorted node indices into runs of consecutive nodes.
+
+    Parameters
+    ----------
+    indices : list
+        Sorted node indices.
+    chunk_size : int
+        Maximum number of nodes per run. ``None`` for no limit.
+
+    Returns
+    -------
+    runs : list
+        List of ``(first, last)`` node indices of each run.
+    """
+    runs = []
+    for i in indices:
+        if len(runs) > 0 and runs[-1][1] == i - 1 and \
+                (chunk_size is None or i - runs[-1][0] < chunk_size):
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    return [tuple(run) for run in runs]
+
+
+def _node_isochrone_set(isoc_set, i):
+    """A one-isochrone set with isochrone `i` of `isoc_set`."""
+    o = isoc_set.offsets
+    columns = OrderedDict((name, c[o[i]:o[i + 1]])
+                          for name, c in isoc_set.columns.items())
+    return IsochroneSet.from_columns(columns, [0, o[i + 1] - o[i]],
+                                     [isoc_set.metas[i]],
+                                     isoc_set.header_lines)
 
 
 class IsochroneRequest(CMDRequest):
@@ -19,24 +79,137 @@ class IsochroneRequest(CMDRequest):
         The metallicity, fraction of metals in stellar composition.
     log_age : float
         The age, :math:`\log_{10} (A/\mathrm{yr})`.
+    session : :class:`padova.interface.CMDSession`
+        Optional session for requests to the CMD server.
     kwargs :
         Keyword arguments, see TODO
     """
-    def __init__(self, z=0.0, log_age=9., **kwargs):
+    def __init__(self, z=0.0, log_age=9., session=None, **kwargs):
         kwargs['isoc_val'] = "0"  # declare single isochrone request
         kwargs['isoc_zeta'] = z
         kwargs['isoc_age'] = 10. ** log_age
         s = Settings.load_package_settings(**kwargs)
-        super(IsochroneRequest, self).__init__(s)
+        super(IsochroneRequest, self).__init__(s, session=session)
 
     @property
     def isochrone(self):
         """The :class:`padova.isocdata.Isochrone` instance, an Astropy Table.
         """
-        return self.isochrone_set.isochrones[0]
+        return self.isochrone_set[0]
+
+
+class GridRequest(CMDRequest):
+    """Baseclass of requests for a grid of isochrones, cached node by node.
+
+    Each node of the grid is cached as a one-isochrone set, keyed by the
+    settings of a grid request spanning only that node. Nodes already
+    cached by any grid request with otherwise equal settings are reused, and
+    CMD is only asked for the runs of missing nodes. Extending a grid thus
+    only downloads the new nodes.
+
+    Processes starting the same grid request at once share the work: one
+    fetches and assembles the grid while the others wait, then read it from
+    the cache.
+
+    Subclasses set :attr:`start_key`, :attr:`stop_key` and
+    :attr:`step_key`, the settings keys of the grid's range.
+
+    Parameters
+    ----------
+    kwargs : dict
+        User settings of the whole grid request.
+    nodes : list
+        Values of the grid nodes.
+    chunk_size : int
+        If set, missing nodes are fetched in concurrent chunks of up to
+        `chunk_size` nodes each (see :class:`padova.interface.CMDRequest`).
+    n_workers : int
+        Number of threads fetching chunks.
+    session : :class:`padova.interface.CMDSession`
+        Optional session for requests to the CMD server.
+    """
+    start_key = None
+    stop_key = None
+    step_key = None
+
+    def __init__(self, kwargs, nodes, chunk_size=None, n_workers=4,
+                 session=None):
+        settings = Settings.load_package_settings(**kwargs)
+        cache = PadovaCache()
+        self._kwargs = kwargs
+        self._nodes = nodes
+        self._node_settings = [self._range_settings(v, v) for v in nodes]
+        # Node entries are read, or written, while assembling the grid
+        for s in self._node_settings:
+            cache.pin(s)
+        # One process assembles the grid while the others wait for it
+        with cache.lock(settings, '.grid'):
+            if cache.has_isochrone_set(settings):
+                # Chunks are only needed if the raw output is asked for
+                missing = range(len(nodes))
+            else:
+                missing = [i for i, s in enumerate(self._node_settings)
+                           if not cache.has_isochrone_set(s)]
+            self._runs = _node_runs(list(missing), chunk_size)
+            self._complete_chunks = len(missing) == len(nodes)
+            chunks = [self._range_settings(nodes[i0], nodes[i1])
+                      for i0, i1 in self._runs]
+            super(GridRequest, self).__init__(settings, chunks=chunks,
+                                              n_workers=n_workers,
+                                              session=session, cache=cache)
+            if not self._cache.has_isochrone_set(self.settings):
+                self._isochrone_set = self._assemble()
+                self._cache.set_isochrone_set(self.settings,
+                                              self._isochrone_set)
+
+    def _range_settings(self, start, stop):
+        """Settings of a grid request from node `start` to node `stop`.
+
+        Single-node requests use the default step, so that they are cached
+        under the same key whatever the step of the grid.
+        """
+        kwargs = dict(self._kwargs)
+        kwargs[self.start_key] = start
+        kwargs[self.stop_key] = stop
+        if start == stop:
+            del kwargs[self.step_key]
+        return Settings.load_package_settings(**kwargs)
+
+    def _assemble(self):
+        """Cache the nodes of the fetched chunks, and concatenate the
+        isochrones of all nodes.
+        """
+        node_sets = [None] * len(self._nodes)
+        for j, (i0, i1) in enumerate(self._runs):
+            with self._open_output(self._chunks[j]) as f:
+                isoc_set = IsochroneSet(f)
+            if len(isoc_set) != i1 - i0 + 1:
+                raise RuntimeError(
+                    'CMD returned {0:d} isochrones for {1:d} grid '
+                    'nodes'.format(len(isoc_set), i1 - i0 + 1))
+            for k in range(len(isoc_set)):
+                node_set = _node_isochrone_set(isoc_set, k)
+                self._cache.set_isochrone_set(self._node_settings[i0 + k],
+                                              node_set)
+                node_sets[i0 + k] = node_set
+        for i, node_set in enumerate(node_sets):
+            if node_set is None:
+                node_sets[i] = self._cache.get_isochrone_set(
+                    self._node_settings[i])
+        return concatenate_isochrone_sets(node_sets)
+
+    @property
+    def data(self):
+        """Raw CMD output. If some nodes were served from the cache, the
+        output of the whole grid is requested from CMD.
+        """
+        if self._r is None and not self._complete_chunks:
+            with self._open_output(self.settings) as f:
+                self._r = f.read()
+        return super(GridRequest, self).data
 
 
-class AgeGridRequest(CMDRequest):
+class AgeGridRequest(GridRequest):
     """Request a grid of single-Z isochrones spanning an age range.
 
     Parameters
@@ -49,22 +222,37 @@ class AgeGridRequest(CMDRequest):
         Oldest isochrone, :math:`\log_{10} (A/\mathrm{yr})`.
     delta_log_age : float
         Isochrone age step size, in log-years.
+    chunk_size : int
+        If set, the grid is fetched in concurrent chunks of `chunk_size`
+        ages each (see :class:`padova.interface.CMDRequest`).
+    n_workers : int
+        Number of threads fetching chunks.
+    session : :class:`padova.interface.CMDSession`
+        Optional session for requests to the CMD server.
     kwargs :
         Keyword arguments, see TODO
     """
+    start_key = 'isoc_lage0'
+    stop_key = 'isoc_lage1'
+    step_key = 'isoc_dlage'
+
     def __init__(self, z=0.0,
                  min_log_age=6.6, max_log_age=10.13, delta_log_age=0.05,
+                 chunk_size=None, n_workers=4, session=None,
                  **kwargs):
         kwargs['isoc_val'] = "1"  # declare age grid request
         kwargs['isoc_lage0'] = min_log_age
         kwargs['isoc_lage1'] = max_log_age
         kwargs['isoc_dlage'] = delta_log_age
         kwargs['isoc_zeta0'] = z
-        s = Settings.load_package_settings(**kwargs)
-        super(AgeGridRequest, self).__init__(s)
+        nodes = _grid_nodes(min_log_age, max_log_age, delta_log_age)
+        super(AgeGridRequest, self).__init__(kwargs, nodes,
+                                             chunk_size=chunk_size,
+                                             n_workers=n_workers,
+                                             session=session)
 
 
-class MetallicityGridRequest(CMDRequest):
+class MetallicityGridRequest(GridRequest):
     """Request a grid of single-age isochrones spanning a metallicity range.
 
     Parameters
@@ -77,16 +265,31 @@ class MetallicityGridRequest(CMDRequest):
         The maximum metallicity of the grid (fraction of composition).
     delta_z : float
         The metallicity step size (fraction of composition).
+    chunk_size : int
+        If set, the grid is fetched in concurrent chunks of `chunk_size`
+        metallicities each (see :class:`padova.interface.CMDRequest`).
+    n_workers : int
+        Number of threads fetching chunks.
+    session : :class:`padova.interface.CMDSession`
+        Optional session for requests to the CMD server.
     kwargs :
         Keyword arguments, see TODO
     """
+    start_key = 'isoc_z0'
+    stop_key = 'isoc_z1'
+    step_key = 'isoc_dz'
+
     def __init__(self, log_age=9.,
                  min_z=0.0001, max_z=0.03, delta_z=0.0001,
+                 chunk_size=None, n_workers=4, session=None,
                  **kwargs):
         kwargs['isoc_val'] = "2"  # declare Z grid request
         kwargs['isoc_age0'] = 10. ** log_age
         kwargs['isoc_z0'] = min_z
         kwargs['isoc_z1'] = max_z
         kwargs['isoc_dz'] = delta_z
-        s = Settings.load_package_settings(**kwargs)
-        super(MetallicityGridRequest, self).__init__(s)
+        nodes = _grid_nodes(min_z, max_z, delta_z)
+        super(MetallicityGridRequest, self).__init__(kwargs, nodes,
+                                                     chunk_size=chunk_size,
+                                                     n_workers=n_workers,
+                                                     session=session)
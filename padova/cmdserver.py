@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+This :mod:`cmdserver` module runs a local stand-in for the CMD web server,
+to exercise and load-test CMD requests without the network.
+
+The stand-in speaks the same two-step protocol as CMD: a form submission to
+``/cgi-bin/cmd`` is answered with an HTML page naming an ``outputNNN.dat``
+file (like ``data/cmd_isoc_output.html``), which is then downloaded from
+``/~lgirardi/tmp/``. Outputs are built from the isochrones of the bundled
+``data/isocz0120.dat`` table, optionally gzipped::
+
+    from padova.cmdserver import StandInCMDServer
+    from padova.interface import CMDSession, HostLimiter
+
+    with StandInCMDServer(latency=0.1) as server:
+        HostLimiter.configure(server.url, min_interval=0.)
+        session = CMDSession(webserver=server.url)
+        r = IsochroneRequest(z=0.012, log_age=9., session=session)
+
+The server can also be run from the command line,
+``python -m padova.cmdserver --port 8000``.
+"""
+
+import argparse
+import gzip
+import io
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from pkg_resources import resource_string
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+
+class StandInCMDServer(object):
+    """A local HTTP server that answers CMD requests from bundled data.
+
+    Form submissions select isochrones of the bundled table (metallicity
+    ``Z = 0.012``) according to the ``isoc_val`` setting:
+
+    - ``0``: the isochrone closest to ``isoc_age``.
+    - ``1``: the isochrones from ``isoc_lage0`` to ``isoc_lage1``; the step
+      is that of the table (0.05 dex).
+    - ``2``: the isochrone closest to ``isoc_age``, repeated for each
+      metallicity from ``isoc_z0`` to ``isoc_z1`` in steps of ``isoc_dz``,
+      with its header relabelled.
+
+    Requests selecting no isochrone get a CMD error page.
+
+    Parameters
+    ----------
+    host : str
+        Address to listen on.
+    port : int
+        Port to listen on; ``0`` picks a free port.
+    latency : float
+        Delay before each response (seconds), to mimic the time CMD takes
+        to compute and serve outputs.
+    compress : bool
+        Serve gzipped outputs, as CMD does.
+    max_outputs : int
+        Number of outputs kept available for download.
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0., compress=True,
+                 max_outputs=1000):
+        super(StandInCMDServer, self).__init__()
+        self.latency = latency
+        self.compress = compress
+        self.max_outputs = max_outputs
+        self.n_posts = 0
+        self.n_gets = 0
+        self._outputs = OrderedDict()
+        self._payloads = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._header, self._blocks = _isochrone_blocks()
+        self._page = resource_string('padova', 'data/cmd_isoc_output.html')
+        self._httpd = _ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.standin = self
+
+    @property
+    def url(self):
+        """Base URL of the server, to use as a CMD ``webserver``."""
+        host, port = self._httpd.server_address[:2]
+        return 'http://{0}:{1:d}'.format(host, port)
+
+    def start(self):
+        """Serve requests from a background thread."""
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the server's socket."""
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+
+    def serve_forever(self):
+        """Serve requests from this thread until interrupted."""
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def submit(self, form):
+        """Answer a CMD form submission.
+
+        Parameters
+        ----------
+        form : dict
+            The submitted settings.
+
+        Returns
+        -------
+        page : bytes
+            The HTML result page.
+        """
+        try:
+            key = _output_key(form)
+        except (KeyError, ValueError) as e:
+            return _error_page('Invalid settings: {0}'.format(e))
+        with self._lock:
+            self.n_posts += 1
+            payload = self._payloads.get(key)
+        if payload is None:
+            payload = self._build_output(key)
+            if payload is None:
+                return _error_page('No isochrones in the requested range')
+            with self._lock:
+                self._payloads[key] = payload
+                _trim(self._payloads, 100)
+        with self._lock:
+            name = 'output{0:012d}'.format(self.n_posts)
+            self._outputs[name] = payload
+            _trim(self._outputs, self.max_outputs)
+        return self._page.replace(b'output657220915964',
+                                  name.encode('ascii'))
+
+    def output(self, name):
+        """The payload of output `name` (e.g. ``'output000000000001'``), or
+        ``None`` if it is unknown or expired.
+        """
+        with self._lock:
+            self.n_gets += 1
+            return self._outputs.get(name)
+
+    def _build_output(self, key):
+        """Build (and compress) the CMD output table for an output key."""
+        kind, values = key[0], key[1:]
+        ages = sorted(self._blocks)
+        if kind == 1:
+            lage0, lage1 = values
+            blocks = [self._blocks[a] for a in ages
+                      if lage0 - 1e-6 <= a <= lage1 + 1e-6]
+        else:
+            log_age = values[0]
+            block = self._blocks[min(ages, key=lambda a: abs(a - log_age))]
+            if kind == 0:
+                blocks = [block]
+            else:
+                z0, z1, dz = values[1:]
+                n = int(round((z1 - z0) / dz)) + 1 if dz > 0 else 1
+                blocks = [re.sub(r'Z = [0-9.]+',
+                                 'Z = {0:.5f}'.format(z0 + i * dz), block,
+                                 count=1)
+                          for i in range(n) if z0 + i * dz <= z1 + 1e-9]
+        if len(blocks) == 0:
+            return None
+        text = (self._header + ''.join(blocks)).encode('utf-8')
+        if self.compress:
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as gz:
+                gz.write(text)
+            text = buf.getvalue()
+        return text
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        standin = self.server.standin
+        if not self.path.rstrip('/').endswith('/cgi-bin/cmd'):
+            self._respond(404, b'Not found')
+            return
+        form = dict((k, v[0]) for k, v in
+                    parse_qs(body.decode('latin-1')).items())
+        page = standin.submit(form)
+        self._respond(200, page, 'text/html; charset=iso-8859-1')
+
+    def do_GET(self):
+        standin = self.server.standin
+        m = re.search(r'/~lgirardi/tmp/(output\d+)\.dat$', self.path)
+        payload = standin.output(m.group(1)) if m is not None else None
+        if payload is None:
+            self._respond(404, b'Not found')
+            return
+        self._respond(200, payload, 'application/octet-stream')
+
+    def _respond(self, code, body, content_type='text/plain'):
+        latency = self.server.standin.latency
+        if latency > 0.:
+            time.sleep(latency)
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _isochrone_blocks():
+    """Split the bundled isochrone table into its global header and one
+    text block per isochrone, keyed by log age.
+    """
+    text = resource_string('padova', 'data/isocz0120.dat').decode('utf-8')
+    header, body = text.split('#\tIsochrone', 1)
+    blocks = {}
+    for block in body.split('#\tIsochrone'):
+        block = '#\tIsochrone' + block
+        first_row = block.splitlines()[2]
+        blocks[round(float(first_row.split('\t')[1]), 2)] = block
+    return header, blocks
+
+
+def _output_key(form):
+    """Hashable description of the output requested by a CMD form."""
+    kind = int(form.get('isoc_val', 0))
+    if kind == 1:
+        return (kind, float(form['isoc_lage0']), float(form['isoc_lage1']))
+    log_age = math.log10(float(form.get('isoc_age', 1e9)))
+    if kind == 2:
+        return (kind, log_age, float(form['isoc_z0']),
+                float(form['isoc_z1']), float(form['isoc_dz']))
+    return (0, log_age)
+
+
+def _error_page(message):
+    """A CMD result page reporting an error."""
+    return ('<html><body><p class="errorwarning">{0}</p></body>'
+            '</html>'.format(message)).encode('latin-1')
+
+
+def _trim(d, n):
+    """Drop the oldest items of an ordered dict beyond `n`."""
+    while len(d) > n:
+        d.popitem(last=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve CMD requests from bundled padova data.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='delay before each response (seconds)')
+    parser.add_argument('--no-compress', dest='compress',
+                        action='store_false',
+                        help='serve uncompressed outputs')
+    args = parser.parse_args()
+    server = StandInCMDServer(host=args.host, port=args.port,
+                              latency=args.latency, compress=args.compress)
+    print('Serving CMD requests at {0}'.format(server.url))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -12,93 +12,528 @@ import sys
 
 if sys.version_info[0] > 2:
     py3k = True
-    from urllib.parse import urlencode
-    from urllib import request
-    from urllib.request import urlopen
-    from io import StringIO
     from html import parser
 else:
     py3k = False
-    from urllib import urlencode
-    from urllib2 import urlopen
-    from StringIO import StringIO
     import HTMLParser as parser
 
+import io
 import zlib
 import re
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
 
 from padova.resultcache import PadovaCache
 from padova.utils import compression_type
-from padova.isocdata import IsochroneSet
+from padova.isocdata import IsochroneSet, concatenate_isochrone_sets
 
 
-class CMDRequest(object):
-    """Python interface to the Padova group's CMD web interface for isochrones.
+WEBSERVER = 'http://stev.oapd.inaf.it'
+
+
+class HostLimiter(object):
+    """Bound the number of concurrent requests to a web server, and the
+    rate at which they start.
+
+    Use :meth:`for_host` to get the limiter shared by all requests to a
+    server in this process, and :meth:`configure` to change its limits.
 
     Parameters
     ----------
-    settings : :class:`padova.settings.Settings`
-        A settings instance loaded with user settings.
+    max_concurrent : int
+        Maximum number of requests in flight at once.
+    min_interval : float
+        Minimum time between the start of consecutive requests (seconds).
     """
-    def __init__(self, settings):
-        super(CMDRequest, self).__init__()
-        self._cache = PadovaCache()
-        self.settings = settings
-        if self.settings in self._cache:
-            # Get request from the cache
-            # print("Reading from cache")
-            self._r = self._cache[self.settings]
-        else:
-            # Call API and cache it
-            self._r = self._request()
-            self._cache[self.settings] = self._r
-        self._isochrone_set = None
+    max_concurrent = 2
+    min_interval = 1.0
 
-    def _request(self):
-        """Request isochromes from CMD."""
-        webserver = 'http://stev.oapd.inaf.it'
-        # FIXME convert to log
-        # print('Requesting from {0}...'.format(webserver))
-        url = webserver + '/cgi-bin/cmd'
-        q = urlencode(self.settings.settings)
+    _limiters = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, max_concurrent=None, min_interval=None):
+        super(HostLimiter, self).__init__()
+        if max_concurrent is None:
+            max_concurrent = HostLimiter.max_concurrent
+        if min_interval is None:
+            min_interval = HostLimiter.min_interval
+        self.max_concurrent = max_concurrent
+        self.min_interval = min_interval
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._last_start = 0.
+
+    @classmethod
+    def for_host(cls, host):
+        """The limiter shared by all requests to `host`."""
+        with cls._registry_lock:
+            if host not in cls._limiters:
+                cls._limiters[host] = cls()
+            return cls._limiters[host]
+
+    @classmethod
+    def configure(cls, host, max_concurrent=None, min_interval=None):
+        """Replace the limiter of `host` with one with new limits."""
+        with cls._registry_lock:
+            cls._limiters[host] = cls(max_concurrent=max_concurrent,
+                                      min_interval=min_interval)
+
+    def reserve_start(self):
+        """Reserve the next start time of a request to the host.
+
+        Returns
+        -------
+        wait : float
+            Time until the reserved start (seconds). The caller must wait
+            this long before starting its request.
+        """
+        with self._lock:
+            now = time.time()
+            start = max(now, self._last_start + self.min_interval)
+            self._last_start = start
+        return start - now
+
+    def __enter__(self):
+        self._semaphore.acquire()
+        wait = self.reserve_start()
+        if wait > 0.:
+            time.sleep(wait)
+        return self
+
+    def __exit__(self, *args):
+        self._semaphore.release()
+
+
+class CMDSession(object):
+    """Reusable HTTP session for CMD requests.
+
+    The session keeps a pool of keep-alive connections to the CMD server.
+    Requests that fail transiently (connection, timeout and transfer errors,
+    HTTP 5xx or 429 responses, or a CMD page without an output file) are
+    retried with exponential backoff, within an optional total deadline.
+    Each attempt holds a :class:`HostLimiter` slot for the server; the slot
+    is released while waiting to retry.
+
+    Downloads are streamed: gzipped outputs are decompressed on the fly,
+    and :meth:`download` writes the output to a file as it arrives.
+
+    Parameters
+    ----------
+    webserver : str
+        Base URL of the CMD server.
+    timeout : float or tuple
+        Timeout of each HTTP request, or a ``(connect, read)`` tuple of
+        timeouts (seconds).
+    max_retries : int
+        Number of times a failed request is retried.
+    backoff_factor : float
+        The ``n``-th retry waits ``backoff_factor * 2 ** (n - 1)`` seconds.
+    deadline : float
+        Maximum total time for a request, including retries (seconds).
+        ``None`` for no limit.
+    pool_size : int
+        Number of keep-alive connections kept open to the server.
+    """
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, webserver=WEBSERVER, timeout=(10., 300.),
+                 max_retries=3, backoff_factor=2., deadline=None,
+                 pool_size=4):
+        super(CMDSession, self).__init__()
+        self.webserver = webserver
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.deadline = deadline
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    @classmethod
+    def default(cls):
+        """The session shared by requests that are not given a session."""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def close(self):
+        """Close the session's pooled connections."""
+        self._session.close()
+
+    def fetch(self, settings):
+        """Submit the CMD form for `settings` and download the resulting
+        dataset.
+
+        Parameters
+        ----------
+        settings : :class:`padova.settings.Settings`
+            A settings instance loaded with user settings.
+
+        Returns
+        -------
+        r : str
+            The CMD output table.
+        """
+        f = io.BytesIO()
+        self.download(settings, f)
+        r = f.getvalue()
         if py3k:
-            req = request.Request(url, q.encode('utf8'))
-            c = urlopen(req).read().decode('utf8')
-        else:
-            c = urlopen(url, q).read()
+            r = r.decode('utf8')
+        return r
+
+    def download(self, settings, f):
+        """Submit the CMD form for `settings` and stream the resulting
+        dataset, decompressed, into a file.
+
+        Parameters
+        ----------
+        settings : :class:`padova.settings.Settings`
+            A settings instance loaded with user settings.
+        f : file
+            Binary file to write the CMD output table to. The output of a
+            failed attempt is truncated before retrying.
+
+        Returns
+        -------
+        n_bytes : int
+            Size of the output table.
+        """
+        start = time.time()
+        n_retries = 0
+        while True:
+            try:
+                with HostLimiter.for_host(self.webserver):
+                    return self._download(settings, f, start)
+            except _TransientError as e:
+                f.seek(0)
+                f.truncate()
+                wait = self.backoff_factor * 2 ** n_retries
+                n_retries += 1
+                remaining = self._remaining(start, wait)
+                if n_retries > self.max_retries or \
+                        (remaining is not None and remaining <= 0.):
+                    raise RuntimeError(
+                        'Server Response is incorrect after {0:d} attempts: '
+                        '{1}'.format(n_retries, e))
+                time.sleep(wait)
+
+    def _remaining(self, start, wait=0.):
+        """Time left before the deadline, after waiting `wait` seconds."""
+        if self.deadline is None:
+            return None
+        return self.deadline - (time.time() - start) - wait
+
+    def _timeout(self, start):
+        remaining = self._remaining(start)
+        if remaining is None:
+            return self.timeout
+        if remaining <= 0.:
+            raise _TransientError('deadline exceeded')
+        if isinstance(self.timeout, tuple):
+            return tuple(min(t, remaining) for t in self.timeout)
+        return min(self.timeout, remaining)
+
+    def _get(self, start, method, url, **kwargs):
+        """Make an HTTP request, classifying failures as transient or not.
+        """
+        try:
+            resp = self._session.request(method, url,
+                                         timeout=self._timeout(start),
+                                         **kwargs)
+        except _PERMANENT_ERRORS:
+            raise
+        except requests.RequestException as e:
+            raise _TransientError(e)
+        if resp.status_code >= 500 or resp.status_code == 429:
+            raise _TransientError('HTTP {0:d}'.format(resp.status_code))
+        if resp.status_code != 200:
+            raise RuntimeError('Server Response is incorrect: HTTP '
+                               '{0:d}'.format(resp.status_code))
+        if not kwargs.get('stream', False):
+            _check_length(resp, len(resp.content))
+        return resp
+
+    def _download(self, settings, f, start):
+        url = self.webserver + '/cgi-bin/cmd'
+        q = settings.query
+        c = self._get(start, 'POST', url, data=q,
+                      headers={'Content-Type':
+                               'application/x-www-form-urlencoded'}).text
         # Find the output dataset URL in the HTML that CMD returns
         aa = re.compile('output\d+')
         fname = aa.findall(c)
-        if len(fname) > 0:
-            url = '{0}/~lgirardi/tmp/{1}.dat'.format(webserver, fname[0])
-            # FIXME convert to log
-            # print('Downloading data...{0}'.format(url))
-            bf = urlopen(url)
-            r = bf.read()
-            # Decompress the data if necessary
-            typ = compression_type(r, stream=True)
-            if typ is not None:
-                r = zlib.decompress(bytes(r), 15 + 32)
-            return r
-        else:
-            # print(c)
-            print(url + q)
+        if len(fname) == 0:
             if "errorwarning" in c:
                 p = CMDErrorParser()
                 p.feed(c)
-                print('\n', '\n'.join(p.data).strip())
-            raise RuntimeError('Server Response is incorrect')
+                raise RuntimeError('\n'.join(['Server Response is incorrect']
+                                             + p.data).strip())
+            raise _TransientError('no output file in the CMD response')
+        url = '{0}/~lgirardi/tmp/{1}.dat'.format(self.webserver, fname[0])
+        # FIXME convert to log
+        # print('Downloading data...{0}'.format(url))
+        resp = self._get(start, 'GET', url, stream=True)
+        try:
+            return _copy_output(resp, f)
+        finally:
+            resp.close()
+
+
+class _TransientError(Exception):
+    """A failed CMD request that is worth retrying."""
+    pass
+
+
+# Size of the pieces of downloads read at once (bytes)
+_CHUNK_SIZE = 256 * 1024
+
+
+def _check_length(resp, n_bytes):
+    """Check that a response body of `n_bytes` is complete."""
+    length = resp.headers.get('Content-Length')
+    if length is not None and 'Content-Encoding' not in resp.headers \
+            and n_bytes < int(length):
+        # Older urllib3 versions do not check the length themselves
+        raise _TransientError('incomplete response from {0}'.format(resp.url))
+
+
+def _copy_output(resp, f):
+    """Stream a downloaded CMD output into the binary file `f`,
+    decompressing it on the fly if it is compressed.
+
+    Returns
+    -------
+    n_bytes : int
+        Number of (decompressed) bytes written.
+    """
+    decompressor = None
+    head = b''
+    n_read = 0
+    n_bytes = 0
+    try:
+        for piece in resp.iter_content(_CHUNK_SIZE):
+            n_read += len(piece)
+            if head is not None:
+                # Look for a compression signature in the first bytes
+                head += piece
+                if len(head) < 4:
+                    continue
+                if compression_type(head, stream=True) is not None:
+                    decompressor = zlib.decompressobj(15 + 32)
+                piece, head = head, None
+            if decompressor is not None:
+                piece = decompressor.decompress(piece)
+            f.write(piece)
+            n_bytes += len(piece)
+        _check_length(resp, n_read)
+        if head:
+            # Outputs shorter than a compression signature
+            f.write(head)
+            n_bytes += len(head)
+        if decompressor is not None:
+            piece = decompressor.flush()
+            f.write(piece)
+            n_bytes += len(piece)
+            # Python 2 decompressors cannot tell a truncated stream
+            if not getattr(decompressor, 'eof', True):
+                raise _TransientError('incomplete compressed output from '
+                                      '{0}'.format(resp.url))
+    except zlib.error as e:
+        raise _TransientError(e)
+    except requests.RequestException as e:
+        raise _TransientError(e)
+    return n_bytes
+
+
+# Request errors that retrying cannot fix
+_PERMANENT_ERRORS = (requests.exceptions.URLRequired,
+                     requests.exceptions.MissingSchema,
+                     requests.exceptions.InvalidSchema,
+                     requests.exceptions.InvalidURL,
+                     requests.exceptions.InvalidHeader,
+                     requests.exceptions.TooManyRedirects)
+
+
+class CMDRequest(object):
+    """Python interface to the Padova group's CMD web interface for isochrones.
+
+    Parameters
+    ----------
+    settings : :class:`padova.settings.Settings`
+        A settings instance loaded with user settings.
+    chunks : list
+        Optional list of :class:`padova.settings.Settings`, one for each
+        sub-range of a grid request. Chunks are fetched concurrently and
+        cached individually, and their isochrones are stitched into a single
+        :class:`padova.isocdata.IsochroneSet`. If some chunks fail, a
+        repeated request only fetches the missing chunks.
+    n_workers : int
+        Number of threads fetching chunks. Requests to the CMD server are
+        further limited by :class:`HostLimiter`.
+    session : :class:`CMDSession`
+        Session for requests to the CMD server. Defaults to a session shared
+        by all requests (see :meth:`CMDSession.default`).
+    cache : :class:`padova.resultcache.PadovaCache`
+        Cache of CMD results. Defaults to the user's padova cache.
+
+    Notes
+    -----
+    CMD outputs are streamed into the cache as they download, and parsed
+    from the cached files, so whole outputs are only held in memory when
+    :attr:`data` is read.
+    """
+    def __init__(self, settings, chunks=None, n_workers=4, session=None,
+                 cache=None):
+        super(CMDRequest, self).__init__()
+        if cache is None:
+            cache = PadovaCache()
+        self._cache = cache
+        if session is None:
+            session = CMDSession.default()
+        self._session = session
+        # Frozen, so that the cache keys of the request cannot change
+        self.settings = settings.freeze()
+        if chunks is not None:
+            chunks = [s.freeze() for s in chunks]
+        self._chunks = chunks
+        self._n_workers = n_workers
+        self._isochrone_set = None
+        self._r = None
+        self._fetched = set()
+        # Cache writes by this request must not evict its own entries
+        self._cache.pin(self.settings)
+        for s in self._chunks or []:
+            self._cache.pin(s)
+        if self._chunks is not None:
+            if not self._cache.has_isochrone_set(self.settings):
+                self._fetch_chunks()
+        elif self._cache.has_isochrone_set(self.settings):
+            # The parsed isochrones are cached; raw output is read on demand
+            pass
+        elif self.settings not in self._cache:
+            # Call API and cache it
+            self._request()
+
+    def _fetch_chunks(self):
+        """Fetch the chunks that are not cached yet, concurrently.
+
+        Fetched chunks are streamed into the cache, where this request's
+        pins protect them from eviction until they are assembled.
+        """
+        missing = [i for i, s in enumerate(self._chunks)
+                   if i not in self._fetched and s not in self._cache]
+        if len(missing) == 0:
+            return
+        pool = ThreadPool(min(self._n_workers, len(missing)))
+        results = [(i, pool.apply_async(self._request,
+                                        (self._chunks[i],)))
+                   for i in missing]
+        pool.close()
+        errors = []
+        for i, result in results:
+            try:
+                result.get()
+                self._fetched.add(i)
+            except Exception as e:
+                errors.append(e)
+        pool.join()
+        if len(errors) > 0:
+            err = RuntimeError(
+                '{0:d} of {1:d} chunks failed; completed chunks are '
+                'cached. First error: {2!r}'.format(
+                    len(errors), len(self._chunks), errors[0]))
+            err.__cause__ = errors[0]
+            err.errors = errors
+            raise err
+
+    def _open_output(self, settings):
+        """Open the cached raw output of `settings`, requesting it again if
+        it was evicted (e.g. by another process).
+        """
+        try:
+            return self._cache.open(settings)
+        except KeyError:
+            self._request(settings)
+            return self._cache.open(settings)
+
+    def _chunk_text(self, i):
+        """Raw CMD output of chunk `i`."""
+        with self._open_output(self._chunks[i]) as f:
+            return f.read()
+
+    def _chunk_isochrone_set(self, i):
+        return self._parsed_isochrone_set(self._chunks[i])
+
+    def _parsed_isochrone_set(self, settings):
+        """The isochrone set of `settings`, from the cache or parsed from
+        the raw output by one process while the others wait.
+        """
+        with self._cache.lock(settings, '.npy'):
+            if self._cache.has_isochrone_set(settings):
+                return self._cache.get_isochrone_set(settings)
+            with self._open_output(settings) as f:
+                isoc_set = IsochroneSet(f)
+            self._cache.set_isochrone_set(settings, isoc_set)
+        return isoc_set
+
+    def _request(self, settings=None):
+        """Request isochromes from CMD, streaming the output into the
+        cache.
+
+        Only one process at a time requests the same settings; the others
+        wait for it, and use its cached result.
+        """
+        if settings is None:
+            settings = self.settings
+        with self._cache.lock(settings):
+            if settings in self._cache:
+                # Fetched by another process while this one waited
+                return
+            # FIXME convert to log
+            # print('Requesting from {0}...'.format(
+            #     self._session.webserver))
+            with self._cache.writer(settings) as f:
+                self._session.download(settings, f)
 
     @property
     def isochrone_set(self):
         """IsochroneSet table with the isochrones."""
         if self._isochrone_set is None:
-            f = StringIO(self._r)
-            self._isochrone_set = IsochroneSet(f)
+            if self._cache.has_isochrone_set(self.settings):
+                # Memory-map the parsed isochrones from the cache
+                self._isochrone_set = self._cache.get_isochrone_set(
+                    self.settings)
+            elif self._chunks is not None:
+                self._isochrone_set = concatenate_isochrone_sets(
+                    [self._chunk_isochrone_set(i)
+                     for i in range(len(self._chunks))])
+                self._cache.set_isochrone_set(self.settings,
+                                              self._isochrone_set)
+            else:
+                self._isochrone_set = self._parsed_isochrone_set(
+                    self.settings)
         return self._isochrone_set
 
     @property
     def data(self):
+        """Raw CMD output. For chunked requests, this is the concatenated
+        output of all chunks.
+        """
+        if self._r is None:
+            if self._chunks is not None:
+                self._fetch_chunks()
+                self._r = ''.join(self._chunk_text(i)
+                                  for i in range(len(self._chunks)))
+            else:
+                with self._open_output(self.settings) as f:
+                    self._r = f.read()
         return self._r
 
 
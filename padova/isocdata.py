@@ -5,25 +5,81 @@ This :mod:`isocdata` module helps to read Padova isochrone table files,
 and split them into individual isochrones.
 """
 
+import json
+import mmap
+import multiprocessing
 import os
+import struct
+import threading
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 from astropy.table import Table, join
 
-from padova.basereader import BaseReader
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+from padova.basereader import (BaseReader, sanitize_colname, column_layout,
+                               column_views, empty_columns)
+
+
+# Names of the columns of isochrone tables that are not bandpasses
+_NON_MAG_NAMES = ['log(age/yr)', 'M_ini', 'M_act', 'logL/Lo', 'logTe',
+                  'logG', 'mbol', 'C/O', 'CO', 'M_hec', 'period', 'pmode',
+                  'logMdot',
+                  'int_IMF', 'stage',
+                  'Z', 'logageyr', 'logLLo']
 
 
 class IsochroneSet(BaseReader):
     """Reads an isochrone table (output from the Padova CMD interface).
 
+    The rows of all isochrones are stored column by column: each column is
+    a contiguous array, and all columns share a single buffer
+    (:attr:`columns` and :attr:`buffer`). :attr:`offsets` index the rows of
+    each isochrone. Operations on whole grids can run on the columns
+    directly; an :class:`Isochrone` table is only built when an isochrone
+    is accessed, as a view of its rows in the columns.
+
+    In lazy mode, the table is only scanned for the positions of its
+    isochrones, and each isochrone is parsed when it is first accessed.
+    Reading whole columns (:attr:`columns`, :attr:`data`, :attr:`buffer`
+    or :attr:`metas`) parses the remaining isochrones.
+
     Parameters
     ----------
     fname :
         File handle of dataset to read
+    lazy : bool
+        Parse isochrones when they are first accessed. The file must be
+        opened in binary mode, and stay open while isochrones are parsed
+        (unless it is memory-mapped).
+    memory_map : bool
+        In lazy mode, memory-map the file, so that parsing an isochrone
+        reads only its part of the file.
+    columns : list
+        Names of the columns to read (such as ``['M_ini', 'J', 'Ks']``);
+        other columns are not parsed. All columns are read by default.
+    compact : bool
+        Store magnitudes as ``float32`` and the ``stage`` and ``pmode``
+        columns as ``int8``, rather than as ``float64`` and ``int64``.
+    n_processes : int
+        Parse the isochrones in a pool of `n_processes` processes, in
+        chunks of consecutive isochrones (ignored in lazy mode). The file
+        must be a binary file, or a text file over one, as for `lazy`.
     """
-    def __init__(self, f):
+    def __init__(self, f, lazy=False, memory_map=False, columns=None,
+                 compact=False, n_processes=None):
         self._isochrones = []
+        self._lazy = lazy
+        self._memory_map = memory_map
+        self._colnames = columns
+        self._compact = compact
+        self._n_processes = n_processes
         super(IsochroneSet, self).__init__(f)
         self._current = 0
 
@@ -31,73 +87,688 @@ class IsochroneSet(BaseReader):
         return self
 
     def next(self):
-        try:
-            isoc = self._isochrones[self._current]
-            self._current += 1
-        except IndexError:
+        if self._current >= len(self._isochrones):
             self._current = 0
             raise StopIteration
+        isoc = self[self._current]
+        self._current += 1
         return isoc
 
+    __next__ = next  # Python 3
+
     def __getitem__(self, index):
-        return self._isochrones[index]
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        isoc = self._isochrones[index]
+        if isoc is None:
+            isoc = self._make_isochrone(index)
+            self._isochrones[index] = isoc
+        return isoc
 
     def __len__(self):
         return len(self._isochrones)
 
     @property
     def isochrones(self):
-        return self._isochrones
+        self._parse_all()
+        return [self[i] for i in range(len(self))]
+
+    @classmethod
+    def from_array(cls, data, offsets, metas, header_lines):
+        """Build an isochrone set from already-parsed data.
+
+        Parameters
+        ----------
+        data : :class:`numpy.ndarray`
+            Structured array with the rows of every isochrone, in order. The
+            rows are copied into the set's columns.
+        offsets : array-like
+            Row offsets of the isochrones in `data`; isochrone ``i`` spans
+            rows ``offsets[i]`` to ``offsets[i + 1]``.
+        metas : list
+            Metadata dict (e.g., ``Z`` and ``Age``) for each isochrone.
+        header_lines : list
+            Global header lines of the CMD output.
+        """
+        return cls.from_columns(OrderedDict((name, data[name])
+                                            for name in data.dtype.names),
+                                offsets, metas, header_lines)
+
+    @classmethod
+    def from_columns(cls, columns, offsets, metas, header_lines):
+        """Build an isochrone set from already-parsed columns.
+
+        Parameters
+        ----------
+        columns : :class:`collections.OrderedDict`
+            Array of each column, with the rows of every isochrone, in
+            order. The columns are copied into the set's buffer.
+        offsets : array-like
+            Row offsets of the isochrones in the columns.
+        metas : list
+            Metadata dict (e.g., ``Z`` and ``Age``) for each isochrone.
+        header_lines : list
+            Global header lines of the CMD output.
+        """
+        dt = np.dtype([(str(name), np.asarray(c).dtype)
+                       for name, c in columns.items()])
+        n_rows = len(next(iter(columns.values()))) if len(columns) else 0
+        buffer, views = empty_columns(dt, n_rows)
+        for name, column in columns.items():
+            views[name][...] = column
+        return cls.from_buffer(buffer, dt, offsets, metas, header_lines)
+
+    @classmethod
+    def from_buffer(cls, buffer, dt, offsets, metas, header_lines):
+        """Build an isochrone set on a columnar buffer, without copying it.
+
+        Parameters
+        ----------
+        buffer : :class:`numpy.ndarray`
+            ``uint8`` array holding the columns, as laid out by
+            :func:`padova.basereader.column_layout`. It may be
+            memory-mapped.
+        dt : :class:`numpy.dtype`
+            Structured dtype giving the names and types of the columns.
+        offsets : array-like
+            Row offsets of the isochrones; ``offsets[-1]`` is the number of
+            rows.
+        metas : list
+            Metadata dict (e.g., ``Z`` and ``Age``) for each isochrone.
+        header_lines : list
+            Global header lines of the CMD output.
+        """
+        instance = cls.__new__(cls)
+        instance._f = None
+        instance._current = 0
+        instance._header_lines = list(header_lines)
+        instance._build(buffer, dt, offsets, metas)
+        return instance
+
+    def to_shared_memory(self, name=None):
+        """Publish the set in a shared memory block, which other processes
+        attach to with :meth:`from_shared_memory` (Python 3.8+).
+
+        The block holds the set's columnar buffer, with its columns,
+        offsets and metadata. It lives until the returned block is
+        unlinked, which the publishing process should do once the other
+        processes are done::
+
+            shm = isoc_set.to_shared_memory()
+            try:
+                pool.map(fit, [(shm.name, i) for i in range(n)])
+            finally:
+                shm.close()
+                shm.unlink()
+
+        Parameters
+        ----------
+        name : str
+            Name of the block; a unique name by default.
+
+        Returns
+        -------
+        shm : :class:`multiprocessing.shared_memory.SharedMemory`
+            The shared memory block.
+        """
+        if shared_memory is None:
+            raise RuntimeError('Shared memory requires Python 3.8 or later')
+        index = OrderedDict([
+            ('columns', [[n, self.dtype[n].str] for n in self.dtype.names]),
+            ('offsets', [int(i) for i in self.offsets]),
+            ('metas', self.metas),
+            ('header_lines', self.header_lines)])
+        index = json.dumps(index).encode('utf-8')
+        start = _shared_buffer_start(len(index))
+        buffer = self.buffer
+        shm = shared_memory.SharedMemory(name=name, create=True,
+                                         size=max(1, start + len(buffer)))
+        shm.buf[:_SHARED_HEADER.size] = _SHARED_HEADER.pack(len(index))
+        shm.buf[_SHARED_HEADER.size:_SHARED_HEADER.size + len(index)] = index
+        np.frombuffer(shm.buf, dtype=np.uint8, count=len(buffer),
+                      offset=start)[...] = buffer
+        return shm
+
+    @classmethod
+    def from_shared_memory(cls, name):
+        """Attach to an isochrone set published in shared memory by
+        :meth:`to_shared_memory`, without copying its columns.
+
+        The block stays open while the set, or any isochrone or column
+        of it, is in use.
+
+        Parameters
+        ----------
+        name : str
+            Name of the shared memory block.
+        """
+        if shared_memory is None:
+            raise RuntimeError('Shared memory requires Python 3.8 or later')
+        try:
+            # The publishing process owns the block
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13
+            shm = shared_memory.SharedMemory(name=name)
+        size = _SHARED_HEADER.unpack(bytes(shm.buf[:_SHARED_HEADER.size]))[0]
+        index = json.loads(
+            bytes(shm.buf[_SHARED_HEADER.size:_SHARED_HEADER.size + size])
+            .decode('utf-8'), object_pairs_hook=OrderedDict)
+        dt = np.dtype([(str(n), str(typ)) for n, typ in index['columns']])
+        n_bytes = column_layout(dt, index['offsets'][-1])[1]
+        buffer = np.asarray(_SharedBuffer(shm, _shared_buffer_start(size),
+                                          n_bytes))
+        return cls.from_buffer(buffer, dt, index['offsets'], index['metas'],
+                               index['header_lines'])
+
+    @property
+    def columns(self):
+        """Array of each column with the rows of all isochrones in the set,
+        by name. The arrays are contiguous views of :attr:`buffer`.
+        """
+        self._parse_all()
+        return self._columns
+
+    @property
+    def buffer(self):
+        """The ``uint8`` array holding all :attr:`columns` (see
+        :func:`padova.basereader.column_layout`). For sub-sets that are
+        views of the columns of another set (see :meth:`between`), this is
+        a copy of their rows.
+        """
+        if self._buffer is None:
+            buffer, columns = empty_columns(self._dtype, self._offsets[-1])
+            for name, column in self.columns.items():
+                columns[name][...] = column
+            return buffer
+        self._parse_all()
+        return self._buffer
+
+    @property
+    def dtype(self):
+        """Structured dtype of the rows of the set."""
+        return self._dtype
+
+    @property
+    def data(self):
+        """Structured array with the rows of all isochrones in the set.
+
+        The array is a copy assembled from :attr:`columns`; work on the
+        columns to avoid copying the set.
+        """
+        data = np.empty(self._offsets[-1], dtype=self._dtype)
+        for name, column in self.columns.items():
+            data[name] = column
+        return data
+
+    @property
+    def offsets(self):
+        """Row offsets of each isochrone in :attr:`columns` (length
+        ``n + 1``).
+        """
+        return self._offsets
+
+    @property
+    def metas(self):
+        """List of metadata dicts of each isochrone, without the header."""
+        self._parse_all()
+        return self._metas
+
+    @property
+    def header_lines(self):
+        """Global header lines of the CMD output."""
+        return self._header_lines
+
+    @property
+    def log_ages(self):
+        """Log age, :math:`\\log_{10} (A/\\mathrm{yr})`, of each isochrone."""
+        return self._log_ages
+
+    @property
+    def zs(self):
+        """Metallicity of each isochrone."""
+        return self._zs
+
+    def select(self, log_age, z=None):
+        """The isochrone of age `log_age` and metallicity `z`.
+
+        Ages are compared rounded to :math:`10^{-6}` dex. The isochrone is
+        found by bisection in the set's (Z, age) index.
+
+        Parameters
+        ----------
+        log_age : float
+            The age, :math:`\\log_{10} (A/\\mathrm{yr})`.
+        z : float
+            The metallicity. May be omitted for sets of a single
+            metallicity.
+
+        Returns
+        -------
+        isochrone : :class:`Isochrone`
+            The isochrone.
+
+        Raises
+        ------
+        KeyError
+            If the set has no isochrone of this age and metallicity.
+        """
+        lo, hi = self._z_range(self._index_z(z))
+        k = _find(self._sorted_ages, _log_age_key(log_age), lo, hi)
+        if k is None:
+            raise KeyError('No isochrone of log age {0} and Z = {1}'.format(
+                log_age, z))
+        return self[int(self._order[k])]
+
+    def nearest(self, log_age, z=None):
+        """The isochrone closest to age `log_age` and metallicity `z`.
+
+        The closest metallicity (in log Z) is found first, then the closest
+        age of that metallicity.
+
+        Parameters
+        ----------
+        log_age : float
+            The age, :math:`\\log_{10} (A/\\mathrm{yr})`.
+        z : float
+            The metallicity. May be omitted for sets of a single
+            metallicity.
+
+        Returns
+        -------
+        isochrone : :class:`Isochrone`
+            The closest isochrone.
+        """
+        if z is None:
+            z = self._single_z()
+        log_zs = np.log10(self._z_nodes)
+        j = _nearest(log_zs, np.log10(z), 0, len(log_zs))
+        lo, hi = self._z_bounds[j], self._z_bounds[j + 1]
+        k = _nearest(self._sorted_ages, log_age, lo, hi)
+        return self[int(self._order[k])]
+
+    def between(self, log_age=None, z=None):
+        """The isochrones in a range of ages and metallicities.
+
+        Parameters
+        ----------
+        log_age : tuple
+            ``(min, max)`` log ages, inclusive. All ages if ``None``.
+        z : tuple
+            ``(min, max)`` metallicities, inclusive. All metallicities if
+            ``None``.
+
+        Returns
+        -------
+        isochrone_set : :class:`IsochroneSet`
+            The isochrones in the range, in their order in this set. If
+            they are adjacent in this set (e.g. an age range of a single
+            metallicity), the sub-set's columns are views of this set's
+            columns; otherwise their rows are copied.
+        """
+        if log_age is None:
+            age_min, age_max = -np.inf, np.inf
+        else:
+            age_min, age_max = (_log_age_key(a) for a in log_age)
+        j0, j1 = 0, len(self._z_nodes)
+        if z is not None:
+            j0 = int(np.searchsorted(self._z_nodes, _z_key(z[0]), 'left'))
+            j1 = int(np.searchsorted(self._z_nodes, _z_key(z[1]), 'right'))
+        indices = []
+        for j in range(j0, j1):
+            lo, hi = self._z_bounds[j], self._z_bounds[j + 1]
+            ages = self._sorted_ages[lo:hi]
+            k0 = lo + int(np.searchsorted(ages, age_min, 'left'))
+            k1 = lo + int(np.searchsorted(ages, age_max, 'right'))
+            indices.append(self._order[k0:k1])
+        indices = np.sort(np.concatenate(indices)) if len(indices) > 0 \
+            else np.zeros(0, dtype=np.int64)
+        return self._subset(indices)
+
+    def export_for_starfish(self, output_dir, bands=None, n_workers=4):
+        """Export all isochrones in a format useful for StarFISH `mklib`.
+
+        The files are the same as those written by
+        :meth:`Isochrone.export_for_starfish` for each isochrone, but the
+        columns of the whole set are formatted at once, and the files are
+        written concurrently.
+
+        Parameters
+        ----------
+        output_dir : str
+            Directory where the isochrone files will be saved, as
+            ``<output_dir>/zNNNN_tt.tt`` (see
+            :meth:`Isochrone.export_for_starfish`).
+        bands : list
+            List of bands to include in isochrone output. Defaults to all
+            the bands of the isochrones.
+        n_workers : int
+            Number of threads writing files.
+
+        Returns
+        -------
+        paths : list
+            Paths of the isochrone files, in the order of the isochrones.
+        """
+        if len(self) == 0:
+            return []
+        if bands is None:
+            bands = self[0].filter_names
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        paths = [os.path.join(output_dir, "z%s_%s" % (_z_code(meta['Z']),
+                                                      _age_code(meta['Age'])))
+                 for meta in self._metas]
+        # The astropy writer formats M_ini with str(), and bands with %8.6f
+        columns = [np.asarray(self.columns['M_ini']).astype(str)]
+        columns += [np.char.mod("%8.6f", np.asarray(self.columns[name]))
+                    for name in bands]
+        o = self._offsets
+
+        def write(i):
+            _write_fixed_width(paths[i], [c[o[i]:o[i + 1]] for c in columns])
+
+        pool = ThreadPool(max(1, min(n_workers, len(self))))
+        try:
+            pool.map(write, range(len(self)))
+        finally:
+            pool.close()
+            pool.join()
+        return paths
 
     def _read(self):
-        """Read isochrone table and create Isochrone instances."""
+        """Read isochrone table and create Isochrone instances.
+
+        The table is read in a single pass; block boundaries come from the
+        header lines preceding each isochrone, and all numbers are converted
+        in one bulk operation into preallocated columns.
+        """
+        if self._lazy:
+            self._read_lazy()
+            return
+        if self._n_processes is not None and self._n_processes > 1:
+            self._read_parallel()
+            return
         self._isochrones = []
-        self._header_lines, blocks, n_lines = self._prescan_table(2)
+        self._header_lines, blocks, lines = self._scan_table(2)
+
+        dt, usecols = self._table_dtype(blocks[0]['header_lines'][-1])
+        buffer, columns = empty_columns(dt, len(lines))
+        labels = {}
+        self._parse_data(lines, dt, labels=labels, out=columns,
+                         usecols=usecols)
+        offsets = [block['row0'] for block in blocks]
+        offsets.append(blocks[-1]['row1'])
+        metas = [self._parse_meta(block['header_lines'][0])
+                 for block in blocks]
+        if 'stage' in labels:
+            for block, meta in zip(blocks, metas):
+                meta['stages'] = self._parse_stages(
+                    labels['stage'][block['row0']:block['row1']])
+        log_ages = None
+        colnames = self._parse_colnames(blocks[0]['header_lines'][-1])
+        if 'logageyr' in colnames and 'logageyr' not in dt.names:
+            # Ages of isochrones read without their logageyr column
+            j = colnames.index('logageyr')
+            log_ages = [float(lines[block['row0']].split()[j])
+                        for block in blocks]
+        self._build(buffer, dt, offsets, metas, log_ages=log_ages)
 
-        # Load the entire dataset
+    def _read_lazy(self):
+        """Scan the isochrone table for the positions of its isochrones;
+        their rows are parsed by :meth:`_parse_blocks` when accessed.
+        """
+        # Text files of Python 3 wrap the binary file
+        f = getattr(self._f, 'buffer', self._f)
+        if self._memory_map:
+            f = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._header_lines, blocks = self._prescan_table(f, 2)
+        dt, usecols = self._table_dtype(blocks[0]['header_lines'][-1])
+        offsets = np.concatenate([[0], np.cumsum([b['n_rows']
+                                                  for b in blocks])])
+        metas = [self._parse_meta(block['header_lines'][0])
+                 for block in blocks]
+        log_ages = None
         colnames = self._parse_colnames(blocks[0]['header_lines'][-1])
-        # skip first column because it's a blank tab
-        usecols = [i + 1 for i, c in enumerate(colnames)]
+        if 'logageyr' in colnames:
+            j = colnames.index('logageyr')
+            log_ages = [float(b['first_row'].split()[j]) for b in blocks]
+        # Pages of the buffer are only allocated as isochrones are parsed
+        buffer = np.empty(column_layout(dt, offsets[-1])[1], dtype=np.uint8)
+        self._build(buffer, dt, offsets, metas, log_ages=log_ages)
+        self._source = f
+        self._usecols = usecols
+        self._blocks = blocks
+        self._parsed = np.zeros(len(blocks), dtype=bool)
+        self._source_lock = threading.Lock()
+
+    def _read_parallel(self):
+        """Read the isochrone table, parsing chunks of consecutive
+        isochrones in a process pool.
+        """
+        self._read_lazy()
+        n_chunks = min(len(self), 4 * self._n_processes)
+        chunks = [(c[0], c[-1] + 1)
+                  for c in np.array_split(np.arange(len(self)), n_chunks)]
+        tasks = [(self._block_text(i0, i1), self._dtype, self._usecols)
+                 for i0, i1 in chunks]
+        pool = multiprocessing.Pool(self._n_processes)
+        try:
+            # Results come back in the order of the chunks
+            results = pool.imap(_parse_chunk, tasks)
+            for (i0, i1), (data, labels) in zip(chunks, results):
+                o = self._offsets
+                for name, column in self._columns.items():
+                    column[o[i0]:o[i1]] = data[name]
+                self._store_blocks(i0, i1, labels)
+        finally:
+            pool.close()
+            pool.join()
+        self._parsed = None
+        self._source = None
+
+    def _block_text(self, i0, i1):
+        """Text of the isochrones `i0` to `i1` (excluded) of a lazy set."""
+        with self._source_lock:
+            self._source.seek(self._blocks[i0]['start'])
+            return self._source.read(self._blocks[i1 - 1]['end']
+                                     - self._blocks[i0]['start'])
+
+    def _parse_blocks(self, i0, i1):
+        """Parse the rows of isochrones `i0` to `i1` (excluded) of a lazy
+        set into its columns.
+        """
+        lines = _data_lines(self._block_text(i0, i1))
+        o = self._offsets
+        out = OrderedDict((name, c[o[i0]:o[i1]])
+                          for name, c in self._columns.items())
+        labels = {}
+        self._parse_data(lines, self._dtype, labels=labels, out=out,
+                         usecols=self._usecols)
+        self._store_blocks(i0, i1, labels)
+
+    def _store_blocks(self, i0, i1, labels):
+        """Record the stages of isochrones `i0` to `i1` (excluded), parsed
+        with stage `labels`, and mark them as parsed.
+        """
+        o = self._offsets
+        if 'stage' in labels:
+            for i in range(i0, i1):
+                self._metas[i]['stages'] = self._parse_stages(
+                    labels['stage'][o[i] - o[i0]:o[i + 1] - o[i0]])
+        if self._parsed is not None:
+            self._parsed[i0:i1] = True
+
+    def _parse_all(self, indices=None):
+        """Parse the isochrones of a lazy set that are not parsed yet, of
+        all isochrones or only of those at `indices`.
+        """
+        if self._parsed is None or self._parsed.all():
+            return
+        missing = np.flatnonzero(~self._parsed)
+        if indices is not None:
+            missing = np.intersect1d(missing, indices)
+        if len(missing) == 0:
+            return
+        # Parse runs of consecutive isochrones at once
+        breaks = np.flatnonzero(np.diff(missing) > 1) + 1
+        for run in np.split(missing, breaks):
+            self._parse_blocks(run[0], run[-1] + 1)
+
+    def _table_dtype(self, colnames_line):
+        """Structured dtype of the columns to read from an isochrone table.
+
+        Returns
+        -------
+        dt : :class:`numpy.dtype`
+            Structured dtype of the columns to read, in table order.
+        usecols : list
+            Index of each of those columns in the table.
+        """
+        colnames = self._parse_colnames(colnames_line)
+        if self._colnames is not None:
+            unknown = [n for n in self._colnames if n not in colnames]
+            if len(unknown) > 0:
+                raise ValueError('Unknown isochrone columns: {0}'.format(
+                    ', '.join(unknown)))
+        int_type = np.int8 if self._compact else np.int64
         dt = []
-        for cname in colnames:
+        usecols = []
+        for j, cname in enumerate(colnames):
+            if self._colnames is not None and cname not in self._colnames:
+                continue
             if cname == 'stage':
-                dt.append((cname, np.int))
+                dt.append((cname, int_type))
             elif cname == 'pmode':
-                dt.append((cname, np.int))
+                dt.append((cname, int_type))
+            elif self._compact and cname not in _NON_MAG_NAMES:
+                dt.append((cname, np.float32))
             else:
-                dt.append((cname, np.float))
-        self._f.seek(0)
-        data = np.genfromtxt(self._f,
-                             dtype=np.dtype(dt),
-                             delimiter='\t',
-                             autostrip=True,
-                             comments='#',
-                             usecols=usecols)
-
-        # Find where age or metallicity changed
-        age_diffs = np.diff(data['logageyr'])
-        z_diffs = np.diff(data['Z'])
-        changed = np.where((age_diffs >= 0.0001) | (z_diffs >= 0.000001))[0]
-        changed += 1  # needed to get indexes right below
-        assert len(changed) + 1 == len(blocks)
-
-        # Do this so we can iterate all blocks uniformly
-        changed = np.concatenate([[0], changed, [len(data) + 1]])
-
-        # Build individual isochrone tables
-        for i, (idx0, block) in enumerate(zip(changed[:-1], blocks)):
-            idx1 = changed[i + 1]
-            isoc_data = data[idx0:idx1]
-            meta = self._parse_meta(block['header_lines'][0])
-            meta['header'] = self._header_lines
-            tbl = Isochrone(isoc_data, meta=meta)
-            isoc = Isochrone(tbl)
-            self._isochrones.append(isoc)
+                dt.append((cname, np.float64))
+            usecols.append(j)
+        return np.dtype(dt), usecols
+
+    def _build(self, buffer, dt, offsets, metas, columns=None,
+               log_ages=None):
+        """Index the isochrones in the columnar `buffer`, or in `columns`
+        (views of the columns of another set) if given.
+
+        :class:`Isochrone` instances are only created when first accessed,
+        since building a table costs more than parsing its rows.
+        """
+        self._offsets = np.asarray(offsets, dtype=np.int64)
+        self._buffer = buffer
+        self._dtype = np.dtype(dt)
+        if columns is None:
+            columns = column_views(buffer, self._dtype, self._offsets[-1])
+        self._columns = columns
+        self._metas = metas
+        self._isochrones = [None] * len(metas)
+        self._parsed = None
+        self._build_index(log_ages)
+
+    def _build_index(self, log_ages=None):
+        """Sort the isochrones by metallicity, then age, for bisection.
+
+        Parameters
+        ----------
+        log_ages : list
+            Log age of each isochrone; by default, from the columns.
+        """
+        from_columns = log_ages is None
+        if from_columns:
+            log_ages = np.log10([float(m['Age']) for m in self._metas])
+        else:
+            log_ages = np.asarray(log_ages, dtype=np.float64)
+        if from_columns and 'logageyr' in self._columns:
+            # More precise than the ages in the isochrone headers
+            starts = self._offsets[:-1]
+            filled = starts < self._offsets[1:]
+            log_ages[filled] = self._columns['logageyr'][starts[filled]]
+        self._log_ages = np.round(log_ages, 6)
+        self._zs = np.array([_z_key(m['Z']) for m in self._metas])
+        self._order = np.lexsort((self._log_ages, self._zs))
+        self._sorted_ages = self._log_ages[self._order]
+        sorted_zs = self._zs[self._order]
+        self._z_nodes, starts = np.unique(sorted_zs, return_index=True)
+        self._z_bounds = np.append(starts, len(sorted_zs))
+
+    def _single_z(self):
+        if len(self._z_nodes) != 1:
+            raise ValueError('z is required for sets of several '
+                             'metallicities')
+        return self._z_nodes[0]
+
+    def _index_z(self, z):
+        return self._single_z() if z is None else _z_key(z)
+
+    def _z_range(self, z):
+        """Range of the isochrones of metallicity `z` in (Z, age) order."""
+        j = int(np.searchsorted(self._z_nodes, z))
+        if j == len(self._z_nodes) or self._z_nodes[j] != z:
+            return 0, 0
+        return self._z_bounds[j], self._z_bounds[j + 1]
+
+    def _subset(self, indices):
+        """Set of the isochrones `indices` (sorted), viewing this set's
+        columns if they are adjacent.
+        """
+        self._parse_all(indices)
+        metas = [self._metas[i] for i in indices]
+        o = self._offsets
+        if len(indices) == 0:
+            return IsochroneSet.from_columns(
+                OrderedDict((n, c[:0]) for n, c in self._columns.items()),
+                [0], metas, self._header_lines)
+        i0, i1 = indices[0], indices[-1] + 1
+        if i1 - i0 == len(indices):
+            instance = IsochroneSet.__new__(IsochroneSet)
+            instance._f = None
+            instance._current = 0
+            instance._header_lines = self._header_lines
+            columns = OrderedDict((n, c[o[i0]:o[i1]])
+                                  for n, c in self._columns.items())
+            instance._build(None, self._dtype, o[i0:i1 + 1] - o[i0], metas,
+                            columns=columns)
+            return instance
+        rows = np.concatenate([np.arange(o[i], o[i + 1]) for i in indices])
+        lengths = o[indices + 1] - o[indices]
+        return IsochroneSet.from_columns(
+            OrderedDict((n, c[rows]) for n, c in self._columns.items()),
+            np.concatenate([[0], np.cumsum(lengths)]), metas,
+            self._header_lines)
+
+    def _make_isochrone(self, index):
+        """Create an Isochrone as a view of its rows in :attr:`columns`."""
+        index = range(len(self._metas))[index]
+        if self._parsed is not None and not self._parsed[index]:
+            self._parse_blocks(index, index + 1)
+        start, stop = self._offsets[index], self._offsets[index + 1]
+        meta = OrderedDict(self._metas[index])
+        meta['header'] = self._header_lines
+        return Isochrone([c[start:stop] for c in self._columns.values()],
+                         names=list(self._columns), meta=meta, copy=False)
 
     def _parse_colnames(self, header):
         header = header.replace('\t', ' ')
         parts = header.split()
-        return parts
+        return [sanitize_colname(p) for p in parts]
+
+    def _parse_stages(self, column):
+        """Find the rows labelled with an evolutionary stage (such as
+        ``TO`` or ``RGBt``) in the ``stage`` column of an isochrone.
+
+        Returns
+        -------
+        stages : list
+            ``[row, label]`` pairs, in row order.
+        """
+        stages = []
+        for i, value in enumerate(column):
+            parts = value.split()
+            if len(parts) > 0 and parts[0][0].isalpha():
+                stages.append([i, parts[0]])
+        return stages
 
     def _parse_meta(self, header):
         header = header.replace('\t', ' ')
@@ -132,16 +803,14 @@ class Isochrone(Table):
         """Code string for the metallicity. This is a 4-digit code for the
         metallicity (with leading zeros). E.g. ``z=0.012`` will be ``0120``.
         """
-        z_str = "%.4f" % self.z
-        z_str = z_str[2:]
-        return z_str
+        return _z_code(self.z)
 
     @property
     def age_code(self):
         """Code string for the age. This is in format ``tt.tt`, giving the
         log age.
         """
-        return "%05.2f" % np.log10(self.age)
+        return _age_code(self.age)
 
     @property
     def info(self):
@@ -162,12 +831,7 @@ class Isochrone(Table):
     @property
     def non_mag_names(self):
         """A list of all column names that are not bandpasses."""
-        possible = ['log(age/yr)', 'M_ini', 'M_act', 'logL/Lo', 'logTe',
-                    'logG', 'mbol', 'C/O', 'M_hec', 'period', 'pmode',
-                    'logMdot',
-                    'int_IMF', 'stage',
-                    'Z', 'logageyr', 'logLLo']
-        return [n for n in possible if n in self.colnames]
+        return [n for n in _NON_MAG_NAMES if n in self.colnames]
 
     def export_for_starfish(self, output_dir, bands=None):
         """Export the isochrone in a format useful for StarFISH `mklib`.
@@ -209,6 +873,136 @@ class Isochrone(Table):
                 bookend=False)
 
 
+# Size of the index of an isochrone set in shared memory
+_SHARED_HEADER = struct.Struct('<Q')
+
+
+def _shared_buffer_start(index_size):
+    """Offset of the columnar buffer in a shared memory block, after its
+    header and index, aligned for any column type.
+    """
+    start = _SHARED_HEADER.size + index_size
+    return start + -start % 64
+
+
+class _SharedBuffer(object):
+    """``uint8`` array interface to part of a shared memory block.
+
+    Arrays made from it keep it, and so the block, alive: the block is
+    closed once no array views it.
+    """
+    def __init__(self, shm, offset, size):
+        self._shm = shm
+        address = np.frombuffer(shm.buf, dtype=np.uint8).ctypes.data
+        self.__array_interface__ = {'shape': (size,), 'typestr': '|u1',
+                                    'data': (address + offset, False),
+                                    'version': 3}
+
+
+def _data_lines(text):
+    """Data lines of the `text` (bytes) of consecutive isochrones."""
+    return [line for line in text.decode('utf-8').splitlines()
+            if line.strip() and not line.startswith('#')]
+
+
+def _parse_chunk(task):
+    """Parse the `text` of consecutive isochrones into an array of dtype
+    `dt`, reading columns `usecols`; run in worker processes.
+
+    Returns
+    -------
+    data : :class:`numpy.ndarray`
+        Structured array of the rows.
+    labels : dict
+        Raw strings of label columns, see :meth:`BaseReader._parse_data`.
+    """
+    text, dt, usecols = task
+    labels = {}
+    data = BaseReader._parse_data(_data_lines(text), dt, labels=labels,
+                                  usecols=usecols)
+    return data, labels
+
+
+def _log_age_key(log_age):
+    """Log age rounded as in the (Z, age) index of isochrone sets."""
+    return round(float(log_age), 6)
+
+
+def _z_key(z):
+    """Metallicity rounded as in the (Z, age) index of isochrone sets."""
+    return round(float(z), 10)
+
+
+def _find(values, x, lo, hi):
+    """Index of `x` in the sorted ``values[lo:hi]``, or ``None``."""
+    k = lo + int(np.searchsorted(values[lo:hi], x))
+    if k < hi and values[k] == x:
+        return k
+    return None
+
+
+def _nearest(values, x, lo, hi):
+    """Index of the value closest to `x` in the sorted ``values[lo:hi]``.
+    """
+    k = lo + int(np.searchsorted(values[lo:hi], x))
+    if k == hi or (k > lo and x - values[k - 1] <= values[k] - x):
+        return k - 1
+    return k
+
+
+def _z_code(z):
+    """4-digit metallicity code of StarFISH isochrone file names."""
+    return ("%.4f" % z)[2:]
+
+
+def _age_code(age):
+    """``tt.tt`` log age code of StarFISH isochrone file names."""
+    return "%05.2f" % np.log10(age)
+
+
+def _write_fixed_width(path, columns):
+    """Write columns of strings as a table with right-justified columns
+    separated by a space, as the astropy ``fixed_width_no_header`` writer.
+    """
+    widths = [max(int(np.char.str_len(c).max()), 1) for c in columns]
+    row = ' '.join('%{0:d}s'.format(w) for w in widths) + '\n'
+    values = np.column_stack(columns).ravel().tolist()
+    with open(path, 'w') as f:
+        f.write(row * len(columns[0]) % tuple(values))
+
+
+def concatenate_isochrone_sets(isochrone_sets):
+    """Concatenate isochrone sets with the same columns into one set.
+
+    The expected use of this function is to stitch together the isochrones
+    of a grid that was requested from CMD in several chunks.
+
+    Parameters
+    ----------
+    isochrone_sets : list
+        List of :class:`IsochroneSet` instances, in the order their
+        isochrones should appear.
+
+    Returns
+    -------
+    isochrone_set : :class:`IsochroneSet`
+        The concatenated isochrone set. Its header is the header of the
+        first set.
+    """
+    offsets = [0]
+    metas = []
+    for s in isochrone_sets:
+        offsets.extend(s.offsets[1:] - s.offsets[0] + offsets[-1])
+        metas.extend(s.metas)
+    dt = isochrone_sets[0].dtype
+    buffer, columns = empty_columns(dt, offsets[-1])
+    for name in dt.names:
+        np.concatenate([s.columns[name][s.offsets[0]:s.offsets[-1]]
+                        for s in isochrone_sets], out=columns[name])
+    return IsochroneSet.from_buffer(buffer, dt, offsets, metas,
+                                    isochrone_sets[0].header_lines)
+
+
 def join_isochrone_sets(left_set, right_set,
                         right_bands=None, left_bands=None):
     """Join two isochrone sets
@@ -216,6 +1010,13 @@ def join_isochrone_sets(left_set, right_set,
     The expected use of this function is to combine filter sets (`photsys`)
     in two isochrone requests that otherwise have the same settings.
 
+    The sets are joined column-wise in a single pass over their
+    :attr:`IsochroneSet.columns`: each row of the left set is matched
+    to the row of the right set with the same isochrone age and metallicity
+    and the same ``M_ini``, as with a left join of each pair of isochrones
+    (see :func:`join_isochrones`). Rows of an isochrone with equal ``M_ini``
+    are matched in order. The rows keep the order of the left set.
+
     Parameters
     ----------
     left_set : :class:`IsochroneSet`
@@ -230,16 +1031,92 @@ def join_isochrone_sets(left_set, right_set,
 
     Returns
     -------
-    left_set : :class:`IsochroneSet`
-        The joined-and-modified left isochrone set
+    joined_set : :class:`IsochroneSet`
+        The joined isochrone set, with the offsets, metadata and header of
+        the left set. Bands of left rows without a match on the right are
+        ``nan`` (``-1`` for integer columns).
+
+    Raises
+    ------
+    ValueError
+        If the ages and metallicities of the isochrones of the two sets do
+        not match.
     """
-    itr = enumerate(zip(left_set.isochrones, right_set.isochrones))
-    for i, (left_isoc, right_isoc) in itr:
-        new_isoc = join_isochrones(left_isoc, right_isoc,
-                                   right_bands=right_bands,
-                                   left_bands=left_bands)
-        left_set._isochrones[i] = new_isoc
-    return left_set
+    if len(left_set) == 0 or len(right_set) == 0:
+        raise ValueError('Cannot join empty isochrone sets')
+    left = left_set.columns
+    right = right_set.columns
+    left_isoc, right_isoc = left_set[0], right_set[0]
+
+    # Columns of the joined set, in the order of join_isochrones()
+    if right_bands is None:
+        right_bands = right_isoc.filter_names
+    if left_bands is None:
+        left_bands = left_isoc.filter_names
+    removed = set(left_isoc.filter_names) - set(left_bands)
+    removed.update(right_bands)
+    left_names = [n for n in left if n not in removed]
+    dt = [(n, left[n].dtype) for n in left_names]
+    dt += [(n, right[n].dtype) for n in right_bands]
+    dt = np.dtype(dt)
+
+    # Isochrone of the right set with the age and metallicity of each
+    # isochrone of the left set
+    right_nodes = dict((_node_key(meta), i)
+                       for i, meta in enumerate(right_set.metas))
+    node_map = []
+    for meta in left_set.metas:
+        i = right_nodes.get(_node_key(meta))
+        if i is None:
+            raise ValueError('No isochrone of Z = {0} and age {1:g} yr in '
+                             'the right set'.format(meta['Z'], meta['Age']))
+        node_map.append(i)
+    node_map = np.asarray(node_map, dtype=np.int64)
+
+    # Integer (isochrone, M_ini, occurrence of M_ini) keys of the rows of
+    # both sets
+    masses = np.unique(np.concatenate([left['M_ini'], right['M_ini']]))
+    left_keys = np.repeat(node_map, np.diff(left_set.offsets)) \
+        * len(masses) + np.searchsorted(masses, left['M_ini'])
+    right_keys = np.repeat(np.arange(len(right_set), dtype=np.int64),
+                           np.diff(right_set.offsets)) \
+        * len(masses) + np.searchsorted(masses, right['M_ini'])
+    left_occ, right_occ = _occurrences(left_keys), _occurrences(right_keys)
+    n_occ = max(left_occ.max(), right_occ.max()) + 1
+    left_keys = left_keys * n_occ + left_occ
+    right_keys = right_keys * n_occ + right_occ
+    order = np.argsort(right_keys)
+    sorted_keys = right_keys[order]
+    pos = np.minimum(np.searchsorted(sorted_keys, left_keys),
+                     len(sorted_keys) - 1)
+    matched = sorted_keys[pos] == left_keys
+    rows = order[pos]
+
+    buffer, data = empty_columns(dt, len(left_keys))
+    for name in left_names:
+        data[name][...] = left[name]
+    for name in right_bands:
+        column = right[name][rows]
+        fill = -1 if column.dtype.kind in 'iu' else np.nan
+        data[name][...] = np.where(matched, column, fill)
+    return IsochroneSet.from_buffer(buffer, dt, left_set.offsets,
+                                    [OrderedDict(m) for m in left_set.metas],
+                                    left_set.header_lines)
+
+
+def _occurrences(keys):
+    """Number of earlier occurrences of each key in `keys`."""
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    occ = np.empty(len(keys), dtype=np.int64)
+    occ[order] = np.arange(len(keys)) - np.searchsorted(sorted_keys,
+                                                        sorted_keys)
+    return occ
+
+
+def _node_key(meta):
+    """Grid node of an isochrone, from its metadata."""
+    return (round(float(meta['Z']), 10), round(np.log10(meta['Age']), 6))
 
 
 def join_isochrones(left_isoc, right_isoc, right_bands=None, left_bands=None):
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+This :mod:`isocinterp` module interpolates isochrones between the nodes of
+a grid of isochrones, so that isochrones of any age and metallicity inside
+the grid can be made without requests to CMD.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from padova.isocdata import Isochrone
+
+
+class IsochroneInterpolator(object):
+    """Interpolate isochrones between the nodes of an isochrone grid.
+
+    Isochrones are aligned by evolutionary phase. Each node isochrone is
+    split at its primary evolutionary points (the ``stage`` labels listed
+    in :attr:`primary_stages`, such as the turn-off ``TO``), and each phase
+    is resampled at `points_per_phase` equivalent evolutionary points
+    (EEPs), evenly spaced in path length along the track in the
+    (:attr:`track_columns`) plane. The EEPs of the bracketing nodes are then
+    interpolated linearly in log age and log Z.
+
+    Only the primary points present in all bracketing isochrones are used.
+    Without ``stage`` labels, a single phase spans each isochrone.
+
+    Parameters
+    ----------
+    isochrone_set : :class:`padova.isocdata.IsochroneSet`
+        Isochrones at the grid nodes. Their ages and metallicities must form
+        a rectangular grid, such as the output of an age grid request, of a
+        metallicity grid request, or a concatenation of age grids of
+        several metallicities.
+    points_per_phase : int
+        Number of EEPs per evolutionary phase.
+    """
+    primary_stages = ['TO', 'RGBb', 'RGBt', 'BHeb', 'EHeb']
+    track_columns = ('logTe', 'logLLo')
+
+    def __init__(self, isochrone_set, points_per_phase=50):
+        super(IsochroneInterpolator, self).__init__()
+        columns = isochrone_set.columns
+        self._dtype = isochrone_set.dtype
+        self._float_names = [n for n in columns
+                             if columns[n].dtype.kind == 'f']
+        self._other_names = [n for n in columns
+                             if n not in self._float_names]
+        for name in self.track_columns:
+            if name not in self._float_names:
+                raise ValueError('Isochrones lack a {0} column'.format(name))
+        self._values = np.column_stack([columns[n].astype(np.float64)
+                                        for n in self._float_names])
+        self._others = columns
+        self._offsets = np.asarray(isochrone_set.offsets)
+        self._metas = isochrone_set.metas
+        self._header_lines = isochrone_set.header_lines
+        self._points_per_phase = points_per_phase
+        self._eeps = {}
+
+        if 'logageyr' in columns:
+            # More precise than the ages in the isochrone headers
+            log_ages = columns['logageyr'][self._offsets[:-1]]
+        else:
+            log_ages = np.log10([m['Age'] for m in self._metas])
+        log_ages = [round(float(a), 6) for a in log_ages]
+        zs = [float(m['Z']) for m in self._metas]
+        self.log_ages = np.unique(log_ages)
+        self.zs = np.unique(zs)
+        self._index = dict(((a, z), i)
+                           for i, (a, z) in enumerate(zip(log_ages, zs)))
+        if len(self._index) != len(self._metas) or \
+                len(self._index) != len(self.log_ages) * len(self.zs):
+            raise ValueError('Isochrones do not form a rectangular grid of '
+                             'ages and metallicities')
+
+    def __call__(self, log_age, z=None):
+        """Interpolate the isochrone of age `log_age` and metallicity `z`.
+
+        Parameters
+        ----------
+        log_age : float
+            The age, :math:`\\log_{10} (A/\\mathrm{yr})`.
+        z : float
+            The metallicity, fraction of metals in stellar composition. May
+            be omitted for grids of a single metallicity.
+
+        Returns
+        -------
+        isochrone : :class:`padova.isocdata.Isochrone`
+            The interpolated isochrone, sampled at EEPs. Its ``stages``
+            metadata gives the rows of the primary evolutionary points.
+        """
+        if z is None:
+            if len(self.zs) > 1:
+                raise ValueError('z is required for grids of several '
+                                 'metallicities')
+            z = self.zs[0]
+        age_weights = _bracket(self.log_ages, log_age, 'log_age')
+        z_weights = _bracket(np.log10(self.zs), np.log10(z), 'z')
+        nodes = [(self._index[(self.log_ages[i], self.zs[j])], wi * wj)
+                 for i, wi in age_weights for j, wj in z_weights]
+        stages = self._common_stages([i for i, w in nodes])
+
+        values = 0.
+        for i, w in nodes:
+            values = values + w * self._resample(i, stages)[0]
+        data = np.empty(len(values), dtype=self._dtype)
+        for k, name in enumerate(self._float_names):
+            data[name] = values[:, k]
+        if len(self._other_names) > 0:
+            # Integer columns are taken from the nearest node
+            i = max(nodes, key=lambda node: node[1])[0]
+            rows = np.round(self._resample(i, stages)[1]).astype(int)
+            for name in self._other_names:
+                others = self._others[name][self._offsets[i]:
+                                            self._offsets[i + 1]]
+                data[name] = others[rows]
+
+        meta = OrderedDict()
+        meta['Z'] = float(z)
+        meta['Age'] = float(10. ** log_age)
+        meta['stages'] = [[(k + 1) * self._points_per_phase, stage]
+                          for k, stage in enumerate(stages)]
+        meta['header'] = self._header_lines
+        return Isochrone(data, meta=meta, copy=False)
+
+    def _stage_rows(self, i):
+        """Rows of the first occurrence of each stage label of isochrone
+        `i`.
+        """
+        rows = {}
+        for row, label in self._metas[i].get('stages', []):
+            rows.setdefault(label, row)
+        return rows
+
+    def _common_stages(self, indices):
+        """Primary stages labelled in all isochrones `indices`."""
+        stage_rows = [self._stage_rows(i) for i in indices]
+        return [s for s in self.primary_stages
+                if all(s in rows for rows in stage_rows)]
+
+    def _resample(self, i, stages):
+        """Resample isochrone `i` at EEPs, with phases split at `stages`.
+
+        Returns
+        -------
+        values : :class:`numpy.ndarray`
+            Values of the float columns at each EEP.
+        positions : :class:`numpy.ndarray`
+            Fractional row of each EEP in the isochrone.
+        """
+        key = (i, tuple(stages))
+        if key in self._eeps:
+            return self._eeps[key]
+        rows = self._values[self._offsets[i]:self._offsets[i + 1]]
+        n = len(rows)
+        x = rows[:, self._float_names.index(self.track_columns[0])]
+        y = rows[:, self._float_names.index(self.track_columns[1])]
+        path = np.concatenate([[0.], np.cumsum(np.hypot(np.diff(x),
+                                                        np.diff(y)))])
+
+        stage_rows = self._stage_rows(i)
+        bounds = [0] + [stage_rows[s] for s in stages] + [n - 1]
+        bounds = np.maximum.accumulate(bounds)
+        positions = []
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            if path[b] > path[a]:
+                targets = np.linspace(path[a], path[b],
+                                      self._points_per_phase, endpoint=False)
+                positions.append(np.interp(targets, path[a:b + 1],
+                                           np.arange(a, b + 1)))
+            else:
+                positions.append(np.linspace(a, b, self._points_per_phase,
+                                             endpoint=False))
+        positions.append([n - 1])
+        positions = np.concatenate(positions)
+
+        lo = np.floor(positions).astype(int)
+        hi = np.minimum(lo + 1, n - 1)
+        w = (positions - lo)[:, np.newaxis]
+        values = rows[lo] * (1. - w) + rows[hi] * w
+        self._eeps[key] = (values, positions)
+        return values, positions
+
+
+def _bracket(grid, x, name):
+    """Indices and linear weights of the grid nodes bracketing `x`."""
+    tol = 1e-6
+    if x < grid[0] - tol or x > grid[-1] + tol:
+        raise ValueError('{0} {1} is outside of the grid ({2} to {3})'.format(
+            name, x, grid[0], grid[-1]))
+    j = int(np.searchsorted(grid, x))
+    if j < len(grid) and abs(grid[j] - x) <= tol:
+        return [(j, 1.)]
+    if j > 0 and abs(grid[j - 1] - x) <= tol:
+        return [(j - 1, 1.)]
+    w = (x - grid[j - 1]) / (grid[j] - grid[j - 1])
+    return [(j - 1, 1. - w), (j, w)]
@@ -4,8 +4,6 @@
 Read/represent luminosity function tables.
 """
 
-import linecache
-
 import numpy as np
 from astropy.table import Table
 
@@ -22,80 +20,58 @@ class LFTable(BaseReader):
         table file.
     lfs : list
         List of :class:`LuminosityFunction` instances in the table.
-    
+
     Parameters
     ----------
 
-    fname : str
-        Filename of LF table to read (either a .dat or a .dat.gz).
+    f :
+        File handle of the LF table to read.
     """
-    def __init__(self, fname):
-        super(LFTable, self).__init__(fname)
+    def __init__(self, f):
+        super(LFTable, self).__init__(f)
 
     def _read(self):
         """Read isochrone table and create LuminosityFunction instances."""
-        start_indices = self._prescan_table()
-        print "start_indices",
-        print start_indices
-        self._lf_specs = self._read_lf_specs(start_indices)
-        self.metadata = self._read_metadata(0, start_indices[0])
-        self.lfs = self._read_lfs(start_indices)
-        linecache.clearcache()
-
-    def _read_lfs(self, start_indices):
-        """Extract isochrones from the table, creating individual
-        :class:`Isochrone` instances.
+        self.metadata, blocks, lines = self._scan_table(2)
+        self._lf_specs = self._read_lf_specs(blocks)
+        self.lfs = self._read_lfs(blocks, lines)
+
+    def _read_lfs(self, blocks, lines):
+        """Extract luminosity functions from the table, creating individual
+        :class:`LuminosityFunction` instances.
         """
+        # All LFs in a table share the same columns, so parse them at once
+        colnames = blocks[0]['header_lines'][-1].split()
+        dt = [(cname, np.float64) for cname in colnames]
+        data = self._parse_data(lines, dt, delimiter=None)
+
         lfs = []
-        for i, (start_index, meta) in enumerate(
-                zip(start_indices, self._lf_specs)):
-            if i < len(start_indices) - 1:
-                end_index = start_indices[i + 1]
-            else:
-                end_index = self._linecount()
-            isoc = self._read_lf(start_index, end_index, meta)
-            lfs.append(isoc)
+        for block, meta in zip(blocks, self._lf_specs):
+            tbl = Table(data[block['row0']:block['row1']],
+                        meta={"header": self.metadata,
+                              "Z": meta['Z'],
+                              'age': meta['age']},
+                        copy=False)
+            lfs.append(LuminosityFunction(tbl))
         return lfs
 
-    def _read_lf_specs(self, start_indices):
+    def _read_lf_specs(self, blocks):
         """Produce a list of the age and metallicity specifications for
         each isochone in the table.
         """
         specs = []
-        for i in start_indices:
-            line = linecache.getline(self.fname, i + 1).rstrip().split()
-            z = float(line[7])
-            age = float(line[10])
+        for block in blocks:
+            parts = block['header_lines'][0].replace('=', ' ').split()
+            z = float(parts[parts.index('Z') + 1])
+            age = float(parts[parts.index('Age') + 1])
             specs.append({"Z": z, "age": age})
         return specs
 
-    def _read_lf(self, start_index, end_index, meta):
-        """Read a single LF, between `start_index` and `end_index`."""
-        header = self._read_header(start_index)
-        # build datatype for structured array
-        dt = [(cname, np.float) for cname in header]
-        data = np.empty(end_index - start_index - 2, dtype=np.dtype(dt))
-        for j, i in enumerate(xrange(start_index + 2, end_index)):
-            parts = linecache.getline(self.fname, i + 1).rstrip('\n').split()
-            for val, (cname, typ) in zip(parts, dt):
-                if typ == np.float:
-                    data[cname][j] = float(val)
-                elif typ == np.int:
-                    data[cname][j] = int(val)
-                else:
-                    data[cname][j] = val
-        tbl = Table(data,
-                meta={"header": self.metadata,
-                      "Z": meta['Z'],
-                      'age': meta['age']})
-        lf = LuminosityFunction(tbl)
-        return lf
-
 
 class LuminosityFunction(object):
     """Holds a single luminosity function (single age, metallicity) for
     several bandpasses.
-    
+
     Parameters
     ----------
 
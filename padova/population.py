@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+This :mod:`population` module draws synthetic stellar populations from an
+isochrone, sampling initial masses from the IMF and interpolating the
+magnitudes of each star along the isochrone::
+
+    from padova.population import PopulationSampler
+
+    sampler = PopulationSampler(isochrone)
+    stars = sampler.sample(10 ** 6, random_state=42)
+
+Very large populations can be drawn in chunks of constant size, so that
+memory use does not grow with the number of stars::
+
+    for stars in sampler.iter_sample(10 ** 9, chunk_size=10 ** 6):
+        ...
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+from astropy.table import Table
+
+
+class PopulationSampler(object):
+    """Draw stars from an isochrone by inverse transform sampling of its
+    IMF.
+
+    The ``int_IMF`` column of CMD isochrones is the cumulative number of
+    stars (per unit mass of stars born) up to each row's initial mass. Stars
+    are drawn uniformly in ``int_IMF``; each falls between two rows of the
+    isochrone, and its initial mass and magnitudes are interpolated linearly
+    between them. Evolutionary phases with no rows between them (equal
+    ``int_IMF``) are thus never sampled.
+
+    Parameters
+    ----------
+    isochrone : :class:`padova.isocdata.Isochrone`
+        The isochrone to draw stars from.
+    bands : list
+        Names of the magnitude columns to interpolate. Defaults to all the
+        isochrone's :attr:`padova.isocdata.Isochrone.filter_names`.
+    """
+    def __init__(self, isochrone, bands=None):
+        super(PopulationSampler, self).__init__()
+        if bands is None:
+            bands = isochrone.filter_names
+        self.bands = list(bands)
+        self.colnames = ['M_ini'] + self.bands
+        cdf = np.asarray(isochrone['int_IMF'], dtype=np.float64)
+        if len(cdf) < 2 or np.any(np.diff(cdf) < 0.):
+            raise ValueError('int_IMF must increase along the isochrone')
+        self._cdf = cdf
+        # A row per interpolated quantity, a column per isochrone point
+        self._values = np.vstack(
+            [np.asarray(isochrone[name], dtype=np.float64)
+             for name in self.colnames])
+        self._meta = OrderedDict([('Z', isochrone.meta.get('Z')),
+                                  ('Age', isochrone.meta.get('Age'))])
+
+    @property
+    def n_stars_per_mass(self):
+        """Number of stars on the isochrone per unit mass of stars born
+        (:math:`M_\\odot^{-1}`), the range of ``int_IMF``.
+        """
+        return self._cdf[-1] - self._cdf[0]
+
+    def sample(self, n_stars, random_state=None):
+        """Draw a population of stars.
+
+        Parameters
+        ----------
+        n_stars : int
+            Number of stars to draw.
+        random_state : int or :class:`numpy.random.RandomState`
+            Seed or random number generator. Defaults to numpy's global
+            generator.
+
+        Returns
+        -------
+        stars : :class:`astropy.table.Table`
+            Table of the stars, with the ``M_ini`` column and a column for
+            each of :attr:`bands`.
+        """
+        rng = _random_state(random_state)
+        return self._draw(int(n_stars), rng)
+
+    def iter_sample(self, n_stars, chunk_size=1000000, random_state=None):
+        """Draw a population of stars in chunks.
+
+        Parameters
+        ----------
+        n_stars : int
+            Total number of stars to draw.
+        chunk_size : int
+            Number of stars in each chunk; the last chunk may be smaller.
+        random_state : int or :class:`numpy.random.RandomState`
+            Seed or random number generator. Defaults to numpy's global
+            generator.
+
+        Returns
+        -------
+        chunks : generator
+            Yields :class:`astropy.table.Table` chunks of stars, as returned
+            by :meth:`sample`.
+        """
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be positive')
+        rng = _random_state(random_state)
+        n_stars = int(n_stars)
+        for start in range(0, n_stars, chunk_size):
+            yield self._draw(min(chunk_size, n_stars - start), rng)
+
+    def _draw(self, n, rng):
+        cdf = self._cdf
+        u = cdf[0] + rng.random_sample(n) * (cdf[-1] - cdf[0])
+        # cdf[hi - 1] <= u < cdf[hi], so the interval is never empty
+        hi = np.searchsorted(cdf, u, side='right')
+        np.clip(hi, 1, len(cdf) - 1, out=hi)
+        lo = hi - 1
+        width = cdf[hi] - cdf[lo]
+        w = np.where(width > 0., (u - cdf[lo]) / np.where(width > 0., width,
+                                                             1.), 0.)
+        values = self._values[:, lo]
+        values += (self._values[:, hi] - values) * w
+        return Table(list(values), names=self.colnames,
+                     meta=OrderedDict(self._meta), copy=False)
+
+
+def _random_state(random_state):
+    """A :class:`numpy.random.RandomState` from a seed or generator."""
+    if random_state is None:
+        return np.random.mtrand._rand
+    if isinstance(random_state, np.random.RandomState):
+        return random_state
+    return np.random.RandomState(random_state)
@@ -6,6 +6,36 @@ interfaces. To be used internally.
 """
 
 import os
+import io
+import re
+import sys
+import bz2
+import gzip
+import json
+import time
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+from padova.isocdata import IsochroneSet
+from padova.utils import compression_type
+
+try:
+    import lzma
+except ImportError:
+    # Python 2
+    lzma = None
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 
 
 class PadovaCache(object):
@@ -13,28 +43,665 @@ class PadovaCache(object):
 
     The cache takes :class:`padova.settings.Settings` instances to hash
     results in the cache.
+
+    Besides the raw CMD output, the cache can hold the parsed form of an
+    :class:`padova.isocdata.IsochroneSet`: a ``.npy`` structured array with
+    the rows of all isochrones and a ``.json`` file with the isochrone row
+    offsets and metadata. The array is memory-mapped when read back, so
+    cached isochrone sets are never parsed again.
+
+    The cache can be bounded in size. Each time an entry is read its files
+    are touched, and when an entry is written the least-recently-used
+    entries are evicted until the cache is within `max_bytes` and
+    `max_entries`. The limits default to the :attr:`max_bytes` and
+    :attr:`max_entries` class attributes, so they can be set for all
+    requests with, e.g., ``PadovaCache.max_bytes = 2 * 1024 ** 3``.
+
+    Entries are written to a temporary file in the cache directory, which
+    is renamed into place once complete, so a failed or interrupted write
+    never leaves a partial entry, and readers never see one. Processes
+    sharing the cache coordinate with the file locks of :meth:`lock`. :meth:`writer` lets large results be
+    streamed into the cache without holding them in memory.
+
+    Raw CMD outputs are stored compressed, with gzip by default (see
+    :attr:`compression`), and decompressed transparently when read. The
+    format of each entry is detected when it is read, so entries written
+    with other settings, or uncompressed by earlier versions, are still
+    read. Parsed isochrone sets are stored uncompressed, so that they can
+    be memory-mapped.
+
+    An SQLite index next to the entries (``index.sqlite``) records the
+    settings, photometric system, size and timestamps of each entry, and
+    the metallicity and age of each cached isochrone, so that the cache's
+    contents can be searched with :meth:`query` without opening entries.
+    Cached results can be read with the keys that :meth:`query` returns
+    in place of settings.
+
+    A write never evicts the entry being written, nor entries pinned with
+    :meth:`pin` on this cache instance (such as the chunks of the request
+    being assembled). The cache may exceed its limits while those
+    entries alone are over them.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache. Defaults to ``~/.padova_cache``.
+    max_bytes : int
+        Maximum size of the cache on disk, in bytes. ``None`` for no limit.
+    max_entries : int
+        Maximum number of cached results. ``None`` for no limit.
+    compression : str
+        Compression of new raw entries: ``'gz'``, ``'bz2'``, ``'xz'``
+        (Python 3 only), or ``False`` for none. Defaults to the
+        :attr:`compression` class attribute.
     """
-    def __init__(self):
+    max_bytes = None
+    max_entries = None
+    compression = 'gz'
+
+    # Hit and miss counts of each cache directory in this process
+    _counts = defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+    _entry_pattern = re.compile(r'^([0-9a-f]{32})(\..*)?$')
+
+    _index_name = 'index.sqlite'
+
+    def __init__(self, cache_dir=None, max_bytes=None, max_entries=None,
+                 compression=None):
         super(PadovaCache, self).__init__()
-        self._dir = os.path.expanduser("~/.padova_cache")
+        if cache_dir is None:
+            cache_dir = "~/.padova_cache"
+        self._dir = os.path.expanduser(cache_dir)
         if not os.path.exists(self._dir):
             os.makedirs(self._dir)
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if compression is not None:
+            self.compression = compression
+        if self.compression and self.compression not in _COMPRESSED_FILES:
+            raise ValueError('Unsupported cache compression: {0}'.format(
+                self.compression))
+        self._pinned = set()
+        self._index_path = os.path.join(self._dir, self._index_name)
+        self._index_ready = False
+
+    def _key(self, settings):
+        if isinstance(settings, _string_types):
+            # Already a key, e.g. from query()
+            return settings
+        return str(settings.__hash__())
 
     def _cache_path(self, settings):
-        return os.path.join(self._dir, str(settings.__hash__()))
+        return os.path.join(self._dir, self._key(settings))
+
+    def _isochrone_set_paths(self, settings):
+        p = self._cache_path(settings)
+        return p + '.npy', p + '.json'
+
+    def _touch(self, settings):
+        """Mark the files of an entry as recently used."""
+        p = self._cache_path(settings)
+        for path in (p,) + self._isochrone_set_paths(settings):
+            if os.path.exists(path):
+                os.utime(path, None)
+        with self._index() as conn:
+            conn.execute('UPDATE entries SET accessed = ? WHERE key = ?',
+                         (time.time(), self._key(settings)))
+
+    def _count(self, hit):
+        counts = self._counts[self._dir]
+        if hit:
+            counts['hits'] += 1
+        else:
+            counts['misses'] += 1
+        return hit
 
     def __contains__(self, settings):
-        return os.path.exists(self._cache_path(settings))
+        return self._count(os.path.exists(self._cache_path(settings)))
 
     def __getitem__(self, settings):
-        assert self.__contains__(settings)
-        with open(self._cache_path(settings)) as f:
-            data = f.read()
-        return data
+        with self.open(settings) as f:
+            return f.read()
 
     def __setitem__(self, settings, data):
-        p = self._cache_path(settings)
-        if os.path.exists(p):
-            os.remove(p)
-        with open(p, 'w') as f:
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        with self.writer(settings) as f:
             f.write(data)
+
+    def open(self, settings):
+        """Open the cached raw output of `settings` for reading.
+
+        Returns
+        -------
+        f : file
+            The cached output, opened in text mode.
+        """
+        p = self._cache_path(settings)
+        try:
+            typ = compression_type(p)
+            if typ in _COMPRESSED_FILES:
+                f = _COMPRESSED_FILES[typ](p, 'rb')
+                if sys.version_info[0] > 2:
+                    f = io.TextIOWrapper(f, encoding='utf-8')
+            else:
+                f = open(p)
+        except IOError:
+            raise KeyError(self._key(settings))
+        self._touch(settings)
+        return f
+
+    @contextmanager
+    def writer(self, settings):
+        """Context manager to stream the raw output of `settings` into the
+        cache.
+
+        Yields a binary file to write the (UTF-8 encoded) output to; it is
+        compressed as it is written. The entry is only added to the cache
+        if the ``with`` block completes; if it raises, the partial output
+        is discarded.
+        """
+        with self._atomic_file(self._cache_path(settings),
+                               self.compression) as f:
+            yield f
+        self._record(settings)
+        self._enforce_limits(settings)
+
+    @contextmanager
+    def _atomic_file(self, path, compression=None):
+        """Context manager to write a file of the cache atomically.
+
+        Yields a binary temporary file, optionally compressed, that is
+        renamed to `path` if the ``with`` block completes, and removed
+        otherwise.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir, prefix='.tmp-')
+        try:
+            if compression:
+                os.close(fd)
+                f = _COMPRESSED_FILES[compression](tmp_path, 'wb')
+            else:
+                f = os.fdopen(fd, 'wb')
+            with f:
+                yield f
+            _replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def lock(self, settings, suffix=''):
+        """An exclusive lock on the entry of `settings`, shared by all
+        threads and processes using the cache directory.
+
+        Use it to check for and create an entry in one step, so that only
+        one process computes it while the others wait for the result::
+
+            with cache.lock(settings):
+                if settings not in cache:
+                    cache[settings] = compute(settings)
+
+        The lock is not reentrant: a thread holding it must not acquire it
+        again.
+
+        Parameters
+        ----------
+        settings : :class:`padova.settings.Settings`
+            Settings (or key) of the entry.
+        suffix : str
+            Distinguishes independent locks of an entry, such as ``'.npy'``
+            for its parsed isochrone set.
+
+        Returns
+        -------
+        lock : :class:`FileLock`
+            The (not yet acquired) lock, a context manager.
+        """
+        lock_dir = os.path.join(self._dir, '.locks')
+        if not os.path.exists(lock_dir):
+            try:
+                os.makedirs(lock_dir)
+            except OSError:
+                # Created by another process
+                pass
+        return FileLock(os.path.join(lock_dir,
+                                     self._key(settings) + suffix))
+
+    def pin(self, settings):
+        """Protect the entry of `settings` from eviction by this cache
+        instance's writes and :meth:`prune` calls.
+        """
+        self._pinned.add(self._key(settings))
+
+    def unpin(self, settings):
+        """Undo :meth:`pin`."""
+        self._pinned.discard(self._key(settings))
+
+    def has_isochrone_set(self, settings):
+        """``True`` if a parsed isochrone set is cached for `settings`."""
+        data_path, index_path = self._isochrone_set_paths(settings)
+        # The index is written last, so it marks a complete entry
+        return self._count(os.path.exists(index_path)
+                           and os.path.exists(data_path))
+
+    def get_isochrone_set(self, settings):
+        """Load a cached :class:`padova.isocdata.IsochroneSet`.
+
+        The isochrone columns are memory-mapped copy-on-write; isochrones
+        are views into the mapped columns.
+        """
+        data_path, index_path = self._isochrone_set_paths(settings)
+        try:
+            with open(index_path) as f:
+                index = json.load(f, object_pairs_hook=OrderedDict)
+        except IOError:
+            raise KeyError(self._key(settings))
+        isoc_set = _load_isochrone_set(data_path, index, 'c')
+        self._touch(settings)
+        return isoc_set
+
+    def set_isochrone_set(self, settings, isochrone_set):
+        """Cache the parsed form of an :class:`padova.isocdata.IsochroneSet`.
+        """
+        data_path, index_path = self._isochrone_set_paths(settings)
+        # The index is written last, so it marks a complete entry
+        with self._atomic_file(data_path) as f:
+            np.save(f, np.asarray(isochrone_set.buffer))
+        index = OrderedDict([
+            ('columns', [[name, isochrone_set.dtype[name].str]
+                         for name in isochrone_set.dtype.names]),
+            ('offsets', [int(i) for i in isochrone_set.offsets]),
+            ('metas', isochrone_set.metas),
+            ('header_lines', isochrone_set.header_lines),
+            ('settings', settings.settings),
+            ('photsys', settings['photsys_file'])])
+        with self._atomic_file(index_path) as f:
+            f.write(json.dumps(index).encode('utf-8'))
+        self._record(settings, isochrone_set)
+        self._enforce_limits(settings)
+
+    @contextmanager
+    def _index(self):
+        """Transaction on the SQLite index of the cache.
+
+        The index is created, and filled from the cached entries, on first
+        use. Each transaction has its own connection, so that threads and
+        processes can share the index.
+        """
+        conn = sqlite3.connect(self._index_path, timeout=60.)
+        try:
+            if not self._index_ready:
+                self._create_index(conn)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _create_index(self, conn):
+        # Threads and processes would otherwise race to create the tables
+        with _index_lock, self.lock(self._index_name):
+            if self._index_ready:
+                return
+            with conn:
+                n_tables = conn.execute(
+                    "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'"
+                ).fetchone()[0]
+                if n_tables == 0:
+                    conn.executescript(_INDEX_SCHEMA)
+            self._index_ready = True
+        if n_tables == 0:
+            # A new index of an existing cache
+            self.reindex()
+
+    def _record(self, settings, isochrone_set=None):
+        """Record a written entry in the index.
+
+        Parameters
+        ----------
+        settings : :class:`padova.settings.Settings`
+            Settings of the entry.
+        isochrone_set : :class:`padova.isocdata.IsochroneSet`
+            The isochrone set written to the entry, if any.
+        """
+        key = self._key(settings)
+        with self._index() as conn:
+            self._record_entry(conn, key, json.dumps(settings.settings),
+                               settings['photsys_file'], isochrone_set)
+
+    def _record_entry(self, conn, key, settings_json, photsys,
+                      isochrone_set=None):
+        paths = [self._cache_path(key)] + list(self._isochrone_set_paths(key))
+        n_bytes = sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+        now = time.time()
+        conn.execute('INSERT OR IGNORE INTO entries (key, created) '
+                     'VALUES (?, ?)', (key, now))
+        conn.execute('UPDATE entries SET settings = ?, photsys = ?, '
+                     'raw = ?, n_bytes = ?, accessed = ? WHERE key = ?',
+                     (settings_json, photsys, os.path.exists(paths[0]),
+                      n_bytes, now, key))
+        if isochrone_set is not None:
+            conn.execute('DELETE FROM isochrones WHERE key = ?', (key,))
+            conn.executemany('INSERT INTO isochrones VALUES (?, ?, ?, ?, ?, '
+                             '?)', _isochrone_rows(key,
+                                                   isochrone_set.columns,
+                                                   isochrone_set.offsets,
+                                                   isochrone_set.metas))
+
+    def reindex(self):
+        """Rebuild the index from the cached entries, e.g. after entries
+        were removed by hand.
+
+        Settings of raw entries cached before the index existed are unknown;
+        those of isochrone sets are read from their ``.json`` files.
+        """
+        with self._index() as conn:
+            conn.execute('DELETE FROM entries')
+            conn.execute('DELETE FROM isochrones')
+            for last_access, n_bytes, key, paths in self._entries():
+                data_path, index_path = self._isochrone_set_paths(key)
+                if data_path in paths and index_path in paths:
+                    with open(index_path) as f:
+                        index = json.load(f, object_pairs_hook=OrderedDict)
+                    isoc_set = _load_isochrone_set(data_path, index, 'r')
+                    settings_json = json.dumps(index.get('settings'))
+                    photsys = index.get('photsys')
+                else:
+                    isoc_set, settings_json, photsys = None, None, None
+                self._record_entry(conn, key, settings_json, photsys,
+                                   isoc_set)
+                conn.execute('UPDATE entries SET accessed = ? WHERE key = ?',
+                             (last_access, key))
+
+    def query(self, z_min=None, z_max=None, log_age_min=None,
+              log_age_max=None, photsys=None):
+        """Find cached isochrones.
+
+        All bounds are inclusive and optional. For example, the isochrones
+        with :math:`0.004 \\leq Z \\leq 0.02` in the 2MASS system are
+        ``cache.query(z_min=0.004, z_max=0.02, photsys='2mass')``.
+
+        Parameters
+        ----------
+        z_min, z_max : float
+            Range of metallicities.
+        log_age_min, log_age_max : float
+            Range of ages, :math:`\\log_{10} (A/\\mathrm{yr})`.
+        photsys : str
+            Photometric system, the ``photsys_file`` setting (e.g.
+            ``'2mass'``).
+
+        Returns
+        -------
+        isochrones : list
+            A dict per isochrone, ordered by metallicity and age, with the
+            ``key`` of its cached isochrone set (usable in place of
+            settings, e.g. with :meth:`get_isochrone_set`), its ``index``
+            in the set, ``z``, ``age``, ``log_age``, ``n_rows``,
+            ``photsys``, and the formatted ``settings`` of the request.
+        """
+        conditions = []
+        values = []
+        for column, op, value in (('z', '>=', z_min), ('z', '<=', z_max),
+                                  ('log_age', '>=', log_age_min),
+                                  ('log_age', '<=', log_age_max),
+                                  ('photsys', '=', photsys)):
+            if value is not None:
+                conditions.append('{0} {1} ?'.format(column, op))
+                values.append(value)
+        sql = ('SELECT i.key, i.idx, i.z, i.age, i.log_age, i.n_rows, '
+               'e.photsys, e.settings FROM isochrones AS i '
+               'JOIN entries AS e ON e.key = i.key')
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY i.z, i.log_age, i.key, i.idx'
+        with self._index() as conn:
+            rows = conn.execute(sql, values).fetchall()
+        names = ('key', 'index', 'z', 'age', 'log_age', 'n_rows', 'photsys',
+                 'settings')
+        results = []
+        for row in rows:
+            result = dict(zip(names, row))
+            result['key'] = str(result['key'])
+            if result['settings'] is not None:
+                result['settings'] = json.loads(
+                    result['settings'], object_pairs_hook=OrderedDict)
+            results.append(result)
+        return results
+
+    def _entries(self):
+        """Scan the cache directory.
+
+        Returns
+        -------
+        entries : list
+            List of ``(last_access, n_bytes, key, paths)`` tuples, one per
+            cached result, ordered from least to most recently used.
+        """
+        entries = {}
+        for name in os.listdir(self._dir):
+            m = self._entry_pattern.match(name)
+            if m is None:
+                continue
+            path = os.path.join(self._dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Removed by another process
+                continue
+            entry = entries.setdefault(m.group(1), [0., 0, m.group(1), []])
+            entry[0] = max(entry[0], st.st_mtime)
+            entry[1] += st.st_size
+            entry[3].append(path)
+        return sorted(tuple(entry) for entry in entries.values())
+
+    def _enforce_limits(self, settings):
+        if self.max_bytes is not None or self.max_entries is not None:
+            self.prune(keep=[settings])
+
+    def prune(self, max_bytes=None, max_entries=None, keep=None):
+        """Evict least-recently-used entries until the cache is within
+        its limits.
+
+        Parameters
+        ----------
+        max_bytes : int
+            Maximum size of the cache, in bytes. Defaults to
+            :attr:`max_bytes`.
+        max_entries : int
+            Maximum number of cached results. Defaults to
+            :attr:`max_entries`.
+        keep : list
+            Settings whose entries are not evicted, in addition to those
+            pinned with :meth:`pin`.
+
+        Returns
+        -------
+        n_evicted : int
+            Number of evicted entries.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_entries is None:
+            max_entries = self.max_entries
+        protected = set(self._pinned)
+        if keep is not None:
+            protected.update(self._key(s) for s in keep)
+        entries = self._entries()
+        n_bytes = sum(entry[1] for entry in entries)
+        evicted = []
+        for last_access, size, key, paths in entries:
+            over_bytes = max_bytes is not None and n_bytes > max_bytes
+            over_entries = max_entries is not None \
+                and len(entries) - len(evicted) > max_entries
+            if not (over_bytes or over_entries):
+                break
+            if key in protected:
+                continue
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            n_bytes -= size
+            evicted.append(key)
+        if len(evicted) > 0:
+            with self._index() as conn:
+                for table in ('entries', 'isochrones'):
+                    conn.executemany(
+                        'DELETE FROM {0} WHERE key = ?'.format(table),
+                        [(key,) for key in evicted])
+        return len(evicted)
+
+    def stats(self):
+        """Summarize the cache's contents and its use in this process.
+
+        Returns
+        -------
+        stats : dict
+            With keys ``hits`` and ``misses`` (lookups of cached results in
+            this process), ``entries`` and ``bytes`` (on disk), and the
+            ``max_bytes`` and ``max_entries`` limits.
+        """
+        entries = self._entries()
+        counts = self._counts[self._dir]
+        return {'hits': counts['hits'],
+                'misses': counts['misses'],
+                'entries': len(entries),
+                'bytes': sum(entry[1] for entry in entries),
+                'max_bytes': self.max_bytes,
+                'max_entries': self.max_entries}
+
+
+class FileLock(object):
+    """An exclusive lock on a file, held by at most one thread or process at
+    a time.
+
+    The lock is a context manager, and can also be acquired and released
+    explicitly (also from different threads).
+
+    Parameters
+    ----------
+    path : str
+        Path of the lock file; it is created if needed.
+    """
+    def __init__(self, path):
+        super(FileLock, self).__init__()
+        self.path = path
+        self._f = None
+
+    def acquire(self):
+        """Wait for and take the lock."""
+        f = open(self.path, 'a+b')
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                while True:
+                    try:
+                        f.seek(0)
+                        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except IOError:
+                        time.sleep(0.05)
+        except BaseException:
+            f.close()
+            raise
+        self._f = f
+
+    def release(self):
+        """Release the lock."""
+        f, self._f = self._f, None
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        f.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+if sys.version_info[0] > 2:
+    _string_types = (str,)
+else:
+    _string_types = (basestring,)  # noqa
+
+# Serializes the creation of cache indexes in this process
+_index_lock = threading.Lock()
+
+# Tables of the SQLite index of a cache
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    settings TEXT,
+    photsys TEXT,
+    raw INTEGER,
+    n_bytes INTEGER,
+    created REAL,
+    accessed REAL);
+CREATE TABLE IF NOT EXISTS isochrones (
+    key TEXT,
+    idx INTEGER,
+    z REAL,
+    age REAL,
+    log_age REAL,
+    n_rows INTEGER,
+    PRIMARY KEY (key, idx));
+CREATE INDEX IF NOT EXISTS isochrones_z_age ON isochrones (z, log_age);
+"""
+
+
+def _load_isochrone_set(data_path, index, mmap_mode):
+    """Memory-map a cached isochrone set, given its parsed ``.json``
+    index.
+    """
+    data = np.load(data_path, mmap_mode=mmap_mode)
+    if 'columns' not in index:
+        # Entries cached before isochrone sets were columnar hold a
+        # structured array
+        return IsochroneSet.from_array(data, index['offsets'],
+                                       index['metas'], index['header_lines'])
+    dt = np.dtype([(str(name), str(typ)) for name, typ in index['columns']])
+    return IsochroneSet.from_buffer(data, dt, index['offsets'],
+                                    index['metas'], index['header_lines'])
+
+
+def _isochrone_rows(key, columns, offsets, metas):
+    """Rows of the index's isochrones table for an isochrone set."""
+    rows = []
+    for i, meta in enumerate(metas):
+        if 'logageyr' in columns and offsets[i + 1] > offsets[i]:
+            # More precise than the ages in the isochrone headers
+            log_age = round(float(columns['logageyr'][offsets[i]]), 6)
+        else:
+            log_age = float(np.log10(meta['Age']))
+        rows.append((key, i, float(meta['Z']), float(meta['Age']), log_age,
+                     int(offsets[i + 1] - offsets[i])))
+    return rows
+
+
+def _gzip_file(path, mode):
+    # The default level 9 takes twice as long for 3% smaller entries
+    return gzip.GzipFile(path, mode, compresslevel=6)
+
+
+# File classes of the compressed formats of cache entries, by
+# utils.compression_type name
+_COMPRESSED_FILES = {'gz': _gzip_file, 'bz2': bz2.BZ2File}
+if lzma is not None:
+    _COMPRESSED_FILES['xz'] = lzma.LZMAFile
+
+
+def _replace(src, dst):
+    """Rename `src` to `dst`, atomically replacing `dst` if it exists."""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # Python 2; rename replaces files atomically on POSIX
+        os.rename(src, dst)
@@ -9,6 +9,7 @@ the CMD web api.
 
 import sys
 import os
+import threading
 from collections import OrderedDict
 import hashlib
 
@@ -21,78 +22,174 @@ from pkg_resources import resource_stream
 import pytoml as toml
 
 
-class Settings(object):
-    """Store user settings and validate against the schema for the Padova
-    CMD web app.
+class SettingsSchema(object):
+    """Compiled schema of the settings of the Padova CMD web app.
+
+    The TOML schema is parsed once; keys are sorted (so that hashes of
+    settings are consistent), aliases are indexed, and a validator and
+    the formatted default value of each key are precomputed. Schemas are
+    shared by the :class:`Settings` instances built from them, and package
+    schemas are loaded once per process, see
+    :meth:`load_package_schema`.
 
     Parameters
     ----------
     f : stream-like
         A file stream to the TOML settings file.
-    kwargs :
-        User settings
     """
-    def __init__(self, f, **kwargs):
-        super(Settings, self).__init__()
+    _package_schemas = {}
+    _package_lock = threading.Lock()
+
+    def __init__(self, f):
+        super(SettingsSchema, self).__init__()
         d = toml.load(f)
         # Ordering is import to consistently build a hash for caching
-        self._schema = OrderedDict(sorted(d.items(), key=lambda t: t[0]))
-        self._aliases = self._index_aliases()
-        self._user_settings = {}
+        self.tables = OrderedDict(sorted(d.items(), key=lambda t: t[0]))
+        self.aliases = self._index_aliases()
+        self._validators = dict((k, self._compile_validator(k, table))
+                                for k, table in self.tables.items())
+        self.defaults = OrderedDict((k, table['default'])
+                                    for k, table in self.tables.items())
         # Self-validate
-        self.validate()
-        # Add any user settings
-        self.update(kwargs)
+        for k, v in self.defaults.items():
+            self.validate(k, v)
+        self.formatted_defaults = OrderedDict(
+            (k, self.format_value(k, v)) for k, v in self.defaults.items())
+        self.encoded_defaults = OrderedDict(
+            (k, self.encode_value(k, v))
+            for k, v in self.formatted_defaults.items())
 
     @classmethod
-    def load_package_settings(cls, name="cmd_2_6.toml", **kwargs):
-        """Load a settings file that ships with `Padova`.
+    def load_package_schema(cls, name="cmd_2_6.toml"):
+        """The compiled schema of a settings file that ships with `Padova`,
+        loaded on first use.
 
         Parameters
         ----------
         name : str
             Name of the TOML file.
-        kwargs :
-            User settings
         """
-        f = resource_stream(__name__,
-                            os.path.join("data", "settings", name))
-        return cls(f, **kwargs)
+        with cls._package_lock:
+            if name not in cls._package_schemas:
+                f = resource_stream(__name__,
+                                    os.path.join("data", "settings", name))
+                cls._package_schemas[name] = cls(f)
+            return cls._package_schemas[name]
+
+    def __len__(self):
+        return len(self.tables)
 
     def _index_aliases(self):
         """Build a hash of alias names back to full names."""
         aliases = {}
-        for k, table in self._schema.iteritems():
+        for k, table in self.tables.items():
             if 'alias' in table:
                 aliases[table['alias']] = k
         return aliases
 
-    def _resolve_key(self, k):
-        if k in self._schema:
+    @staticmethod
+    def _compile_validator(k, table):
+        if table['kind'] == 'static':
+            default = table['default']
+
+            def validator(key, v):
+                assert v == default, 'Cannot override {0}'.format(key)
+        elif table['kind'] == 'choices':
+            choices = table['choices']
+
+            def validator(key, v):
+                assert v in choices, '{0}: {1} invalid'.format(key, v)
+        elif table['kind'] == 'range':
+            lo, hi = min(table['range']), max(table['range'])
+
+            def validator(key, v):
+                assert (v >= lo) and (v <= hi), \
+                    '{0}: {1} outside range'.format(key, v)
+        else:
+            validator = None
+        return validator
+
+    def resolve_key(self, k):
+        """Full name of the settings key or alias `k`."""
+        if k in self.tables:
             key = k
-        elif k in self._aliases:
-            key = self._aliases[k]
+        elif k in self.aliases:
+            key = self.aliases[k]
         else:
             raise KeyError('Unknown settings key: {0}'.format(k))
         return key
 
-    def _format_value(self, key, table, v):
+    def validate(self, key, v):
+        """Validate value `v` of the settings key or alias `key`."""
+        validator = self._validators[self.resolve_key(key)]
+        if validator is not None:
+            validator(key, v)
+
+    def format_value(self, key, v):
+        """Format value `v` of settings key `key` for the CMD form."""
+        table = self.tables[key]
         if 'format' in table:
             return table['format'].format(**{key: v})
         else:
             return v
 
+    def encode_value(self, key, v):
+        """URL-encode the ``key=value`` field of formatted value `v`."""
+        return urlencode([(key, v)])
+
+
+class Settings(object):
+    """Store user settings and validate against the schema for the Padova
+    CMD web app.
+
+    The hash of the settings (the key of cached results), their formatted
+    values and the query string of the CMD form are computed once, until
+    the settings change. Only user settings are formatted and encoded;
+    the schema holds the encoded defaults.
+
+    Parameters
+    ----------
+    f : stream-like or :class:`SettingsSchema`
+        A file stream to the TOML settings file, or a compiled schema.
+    kwargs :
+        User settings
+    """
+    def __init__(self, f, **kwargs):
+        super(Settings, self).__init__()
+        if isinstance(f, SettingsSchema):
+            schema = f
+        else:
+            schema = SettingsSchema(f)
+        self.__dict__.update(_schema=schema, _user_settings={})
+        self._changed()
+        # Add any user settings
+        Settings._update(self, kwargs)
+
+    @classmethod
+    def load_package_settings(cls, name="cmd_2_6.toml", **kwargs):
+        """Load a settings file that ships with `Padova`.
+
+        The file is parsed once per process, see
+        :meth:`SettingsSchema.load_package_schema`.
+
+        Parameters
+        ----------
+        name : str
+            Name of the TOML file.
+        kwargs :
+            User settings
+        """
+        return cls(SettingsSchema.load_package_schema(name), **kwargs)
+
+    def _changed(self):
+        """Forget the hash and formatted values of changed settings."""
+        self.__dict__.update(_hash=None, _formatted=None, _query=None)
+
+    def _resolve_key(self, k):
+        return self._schema.resolve_key(k)
+
     def _validate(self, key, v):
-        k = self._resolve_key(key)
-        table = self._schema[k]
-        if table['kind'] == 'static':
-            assert v == table['default'], 'Cannot override {0}'.format(key)
-        elif table['kind'] == 'choices':
-            assert v in table['choices'], '{0}: {1} invalid'.format(key, v)
-        elif table['kind'] == 'range':
-            r = table['range']
-            assert (v >= min(r)) and (v <= max(r)), '{0}: {1} outside range'.\
-                format(key, v)
+        self._schema.validate(key, v)
 
     def validate(self):
         """Validates all settings: defaults or user overrides."""
@@ -103,19 +200,19 @@ class Settings(object):
         # Attempt to add a user's setting as an attribute
         try:
             k = self._resolve_key(name)
-            self._validate(k, value)
-            self._user_settings[k] = value
         except (AttributeError, KeyError):
             super(Settings, self).__setattr__(name, value)
+        else:
+            self._update({k: value})
 
     def __delattr__(self, name):
         # Attempt to delete a user's setting first
         try:
             k = self._resolve_key(name)
-            if k in self._user_settings:
-                del self._user_settings[k]
         except KeyError:
             super(Settings, self).__delattr__(name)
+        else:
+            self._delete(k)
 
     def __len__(self):
         return len(self._schema)
@@ -125,61 +222,121 @@ class Settings(object):
         try:
             return self._user_settings[k]
         except KeyError:
-            return self._schema[k]['default']
+            return self._schema.defaults[k]
 
     def __setitem__(self, key, value):
-        k = self._resolve_key(key)
-        self._validate(k, value)
-        self._user_settings[k] = value
+        self._update({key: value})
 
     def __delitem__(self, key):
         # Only delete user settings
-        k = self._resolve_key(key)
-        if k in self._user_settings:
-            del self._user_settings[k]
+        self._delete(self._resolve_key(key))
 
     def __hash__(self):
         """Build a hash given the current settings."""
-        # String to build hash against
-        q = urlencode(self.settings)
-        m = hashlib.md5()
-        m.update(q)
-        return m.hexdigest()
+        if self._hash is None:
+            # String to build hash against
+            q = self.query
+            m = hashlib.md5()
+            m.update(q.encode('utf-8'))
+            self.__dict__['_hash'] = m.hexdigest()
+        return self._hash
 
     @property
     def defaults(self):
         """A dict of the formatted default settings."""
-        defs = OrderedDict()
-        for k, table in self._schema.iteritems():
-            key = self._resolve_key(k)
-            v = table['default']
-            val = self._format_value(key, table, v)
-            defs[key] = val
-        return defs
+        return OrderedDict(self._schema.formatted_defaults)
 
     @property
     def settings(self):
         """A dict of the formatted settings (including user settings)."""
-        s = OrderedDict()
-        for k, v in self.iteritems():
-            table = self._schema[k]
-            s[k] = self._format_value(k, table, v)
-        return s
+        return OrderedDict(self._formatted_settings())
+
+    @property
+    def query(self):
+        """The URL-encoded query string of the settings for the CMD form."""
+        if self._query is None:
+            encoded = OrderedDict(self._schema.encoded_defaults)
+            for k, v in self._user_settings.items():
+                encoded[k] = self._schema.encode_value(
+                    k, self._schema.format_value(k, v))
+            self.__dict__['_query'] = '&'.join(encoded.values())
+        return self._query
+
+    def _formatted_settings(self):
+        if self._formatted is None:
+            s = OrderedDict(self._schema.formatted_defaults)
+            for k, v in self._user_settings.items():
+                s[k] = self._schema.format_value(k, v)
+            self.__dict__['_formatted'] = s
+        return self._formatted
 
     def iteritems(self):
         """Iterate through all setting key-value pairs.
 
         Note: the values are *unformatted*.
         """
-        for k, table in self._schema.iteritems():
+        for k, v in self._schema.defaults.items():
             if k in self._user_settings:
                 yield k, self._user_settings[k]
             else:
-                yield k, table['default']
+                yield k, v
 
     def update(self, h):
         """Update the user settings with a dict-like."""
-        for k, v in h.iteritems():
+        self._update(h)
+
+    def _update(self, h):
+        for k, v in h.items():
             key = self._resolve_key(k)
             self._validate(key, v)
             self._user_settings[key] = v
+        if len(h) > 0:
+            self._changed()
+
+    def _delete(self, k):
+        if k in self._user_settings:
+            del self._user_settings[k]
+            self._changed()
+
+    def replace(self, **kwargs):
+        """A copy of these settings, of the same class, with the user
+        settings `kwargs` changed. The schema is shared.
+        """
+        user_settings = dict(self._user_settings)
+        user_settings.update(
+            (self._resolve_key(k), v) for k, v in kwargs.items())
+        instance = self.__class__.__new__(self.__class__)
+        instance.__dict__.update(_schema=self._schema,
+                                 _user_settings={})
+        instance._changed()
+        Settings._update(instance, user_settings)
+        return instance
+
+    def copy(self):
+        """A copy of these settings, sharing their schema."""
+        return self.replace()
+
+    def freeze(self):
+        """An immutable :class:`FrozenSettings` copy of these settings."""
+        if isinstance(self, FrozenSettings):
+            return self
+        instance = FrozenSettings.__new__(FrozenSettings)
+        instance.__dict__.update(self.__dict__)
+        instance.__dict__['_user_settings'] = dict(self._user_settings)
+        return instance
+
+
+class FrozenSettings(Settings):
+    """Immutable :class:`Settings`.
+
+    Setting values cannot be changed in place, so frozen settings can be
+    shared safely, e.g. as the keys of pinned cache entries. Use
+    :meth:`replace` to derive new settings.
+    """
+    def _update(self, h):
+        if len(h) > 0:
+            raise TypeError('FrozenSettings cannot be changed; '
+                            'use replace()')
+
+    def _delete(self, k):
+        raise TypeError('FrozenSettings cannot be changed; use replace()')
@@ -19,7 +19,7 @@ def read(filename):
     full_filename = os.path.join(
         os.path.abspath(os.path.dirname(__file__)),
         filename)
-    return unicode(codecs.open(full_filename, encoding='utf-8').read())
+    return codecs.open(full_filename, encoding='utf-8').read()
 
 long_description = '\n\n'.join([read('README.rst'),
                                 read('CHANGES.rst')])
@@ -41,6 +41,7 @@ setup(
         'Intended Audience :: Science/Research',
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
     ],
     keywords='astronomy stellarpopulations',
     packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
@@ -53,7 +54,9 @@ setup(
                    'pytest-cov'],
 
     package_data={
-        'padova': ['data/settings/cmd_2_6.toml'],
+        'padova': ['data/settings/cmd_2_6.toml',
+                   'data/*.dat',
+                   'data/*.html'],
     },
 
     # To provide executable scripts, use entry points in preference to the
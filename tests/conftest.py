@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Shared test configuration and fixtures.
+"""
+
+import gzip
+import io
+import sys
+import threading
+import time
+
+from pkg_resources import resource_filename
+import pytest
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+# padova.asyncinterface requires Python 3.7
+collect_ignore = []
+if sys.version_info < (3, 7):
+    collect_ignore.append('test_asyncinterface.py')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def cmd_server():
+    """Serve the bundled age grid (gzipped) through the two CMD request
+    steps, over keep-alive HTTP/1.1 connections.
+
+    The fixture is a dict describing the server and recording its use:
+
+    - ``url``: base URL of the server.
+    - ``n_fail``: the first ``n_fail`` form submissions get a 503 response.
+    - ``error``: form submissions get the CMD error page.
+    - ``n_truncate``: the first ``n_truncate`` downloads are cut short.
+    - ``posts``: number of form submissions.
+    - ``starts``: times of the successful form submissions.
+    - ``gets``: paths of the downloads.
+    - ``clients``: client addresses, one per connection.
+
+    Paths starting with ``/redirect`` are redirected without the prefix, and
+    requests for paths starting with ``/slow`` are answered after a second.
+    """
+    with open(resource_filename('padova', 'data/isocz0120.dat'), 'rb') as f:
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+            gz.write(f.read())
+        dat = buf.getvalue()
+    state = {'n_fail': 0, 'error': False, 'n_truncate': 0, 'posts': 0,
+             'starts': [], 'gets': [], 'clients': set()}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            state['clients'].add(self.client_address)
+            self.rfile.read(int(self.headers['Content-Length']))
+            if self._redirect(307):
+                return
+            state['posts'] += 1
+            if state['error']:
+                self._respond(200, b'<p class="errorwarning">Bad age</p>')
+            elif state['posts'] <= state['n_fail']:
+                self._respond(503, b'busy')
+            else:
+                state['starts'].append(time.time())
+                self._respond(200, b'<a href=../~lgirardi/tmp/output123.dat>'
+                                   b'output123.dat</a>')
+
+        def do_GET(self):
+            state['clients'].add(self.client_address)
+            if self._redirect(302):
+                return
+            state['gets'].append(self.path)
+            if len(state['gets']) <= state['n_truncate']:
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(dat)))
+                self.end_headers()
+                self.wfile.write(dat[:len(dat) // 2])
+                self.close_connection = True
+            else:
+                self._respond(200, dat)
+
+        def _redirect(self, code):
+            if self.path.startswith('/slow'):
+                time.sleep(1.)
+            if not self.path.startswith('/redirect'):
+                return False
+            self.send_response(code)
+            self.send_header('Location', self.path[len('/redirect'):])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return True
+
+        def _respond(self, code, body):
+            self.send_response(code)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    state['url'] = 'http://127.0.0.1:{0:d}'.format(server.server_port)
+    # No need to be polite to the test server
+    from padova.interface import HostLimiter
+    HostLimiter.configure(state['url'], min_interval=0.)
+    yield state
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for padova.asyncinterface (Python 3.7+), against a local server that
+mimics the two CMD request steps (``cmd_server`` in conftest.py).
+"""
+
+import asyncio
+
+import pytest
+
+
+def test_fetch_isochrones(cmd_server, tmpdir):
+    from padova.asyncinterface import AsyncCMDClient
+    from padova.resultcache import PadovaCache
+    from padova.settings import Settings
+    url = cmd_server['url']
+    client = AsyncCMDClient(webserver=url,
+                            cache=PadovaCache(cache_dir=str(tmpdir)))
+    settings = Settings.load_package_settings()
+
+    loop = asyncio.new_event_loop()
+    try:
+        isoc_set = loop.run_until_complete(client.fetch_isochrones(settings))
+        assert len(isoc_set) == 71
+        assert cmd_server['gets'] == ['/~lgirardi/tmp/output123.dat']
+
+        # The second request is served from the cache
+        isoc_set = loop.run_until_complete(client.fetch_isochrones(settings))
+        assert len(isoc_set) == 71
+        assert cmd_server['posts'] == 1
+        assert len(cmd_server['gets']) == 1
+    finally:
+        loop.close()
+
+
+def test_redirects(cmd_server, tmpdir):
+    from padova.asyncinterface import AsyncCMDClient
+    from padova.resultcache import PadovaCache
+    from padova.settings import Settings
+    url = cmd_server['url']
+    client = AsyncCMDClient(webserver=url + '/redirect',
+                            cache=PadovaCache(cache_dir=str(tmpdir)))
+    settings = Settings.load_package_settings()
+    r = asyncio.run(client.fetch(settings))
+    assert r.startswith('#')
+    assert cmd_server['gets'] == ['/~lgirardi/tmp/output123.dat']
+
+
+def test_timeout(cmd_server, tmpdir):
+    from padova.asyncinterface import AsyncCMDClient
+    from padova.resultcache import PadovaCache
+    from padova.settings import Settings
+    url = cmd_server['url']
+    client = AsyncCMDClient(webserver=url + '/slow',
+                            cache=PadovaCache(cache_dir=str(tmpdir)),
+                            timeout=(1., 0.1))
+    settings = Settings.load_package_settings()
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(client.fetch(settings))
+
+
+def test_rate_limit(cmd_server, tmpdir):
+    from padova.asyncinterface import fetch_isochrones
+    from padova.interface import HostLimiter
+    from padova.resultcache import PadovaCache
+    from padova.settings import Settings
+    url = cmd_server['url']
+    HostLimiter.configure(url, max_concurrent=2, min_interval=0.3)
+    settings = [Settings.load_package_settings(isoc_age=1e9 + i * 1e8)
+                for i in range(3)]
+    cache = PadovaCache(cache_dir=str(tmpdir))
+
+    async def fetch_all():
+        # Separate clients share the host's limits
+        return await asyncio.gather(*[
+            fetch_isochrones(s, webserver=url, cache=cache)
+            for s in settings])
+
+    isoc_sets = asyncio.run(fetch_all())
+    assert [len(s) for s in isoc_sets] == [71, 71, 71]
+    starts = cmd_server['starts']
+    assert len(starts) == 3
+    assert all(t1 - t0 >= 0.25 for t0, t1 in zip(starts[:-1], starts[1:]))
+
+
+def test_default_client(tmpdir, monkeypatch):
+    from padova.asyncinterface import AsyncCMDClient
+    monkeypatch.setenv('HOME', str(tmpdir))
+    monkeypatch.setattr(AsyncCMDClient, '_default', None)
+    assert AsyncCMDClient.default() is AsyncCMDClient.default()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for padova.cmd, using the bundled isocz0120.dat age grid in place of
+the CMD server.
+"""
+
+import numpy as np
+from pkg_resources import resource_filename
+import pytest
+
+
+def _grid_blocks():
+    """Split the bundled age grid into its global header and one text block
+    per isochrone, keyed by log age.
+    """
+    with open(resource_filename('padova', 'data/isocz0120.dat')) as f:
+        text = f.read()
+    header, body = text.split('#\tIsochrone', 1)
+    blocks = {}
+    for block in body.split('#\tIsochrone'):
+        block = '#\tIsochrone' + block
+        first_row = block.splitlines()[2]
+        blocks[round(float(first_row.split('\t')[1]), 2)] = block
+    return header, blocks
+
+
+@pytest.fixture
+def fake_cmd(tmpdir, monkeypatch):
+    """Serve age grid requests from the bundled data, recording the
+    requested ranges. Ranges listed in ``fail`` raise an error.
+    """
+    from padova.interface import CMDRequest
+    monkeypatch.setenv('HOME', str(tmpdir))
+    header, blocks = _grid_blocks()
+    server = {'requests': [], 'fail': []}
+
+    def _request(self, settings=None):
+        if settings is None:
+            settings = self.settings
+        lage0, lage1 = settings['isoc_lage0'], settings['isoc_lage1']
+        server['requests'].append((lage0, lage1))
+        if (lage0, lage1) in server['fail']:
+            raise RuntimeError('Server Response is incorrect')
+        ages = sorted(a for a in blocks if lage0 - 1e-6 <= a <= lage1 + 1e-6)
+        self._cache[settings] = header + ''.join(blocks[a] for a in ages)
+
+    monkeypatch.setattr(CMDRequest, '_request', _request)
+    return server
+
+
+def test_chunked_age_grid(fake_cmd, tmpdir, monkeypatch):
+    from padova.cmd import AgeGridRequest
+    chunked = AgeGridRequest(z=0.012, min_log_age=6.6, max_log_age=10.1,
+                             delta_log_age=0.05, chunk_size=20)
+    assert len(fake_cmd['requests']) == 4
+    # Fetch the whole grid into an empty cache
+    monkeypatch.setenv('HOME', str(tmpdir.mkdir('whole')))
+    whole = AgeGridRequest(z=0.012, min_log_age=6.6, max_log_age=10.1,
+                           delta_log_age=0.05)
+    assert len(fake_cmd['requests']) == 5
+    whole_set = whole.isochrone_set
+    chunked_set = chunked.isochrone_set
+    assert len(chunked_set) == len(whole_set) == 71
+    assert np.array_equal(chunked_set.offsets, whole_set.offsets)
+    assert np.array_equal(np.asarray(chunked_set.data),
+                          np.asarray(whole_set.data))
+    assert [i.age for i in chunked_set] == [i.age for i in whole_set]
+    assert chunked_set[0].info == whole_set[0].info
+
+
+def test_chunk_retry(fake_cmd):
+    from padova.cmd import AgeGridRequest
+    fake_cmd['fail'].append((7.6, 8.55))
+    with pytest.raises(RuntimeError) as excinfo:
+        AgeGridRequest(z=0.012, min_log_age=6.6, max_log_age=10.1,
+                       delta_log_age=0.05, chunk_size=20)
+    assert len(fake_cmd['requests']) == 4
+    assert len(excinfo.value.errors) == 1
+    assert excinfo.value.__cause__ is excinfo.value.errors[0]
+    assert 'Server Response is incorrect' in str(excinfo.value)
+
+    # Only the failed chunk is requested again
+    fake_cmd['fail'] = []
+    r = AgeGridRequest(z=0.012, min_log_age=6.6, max_log_age=10.1,
+                       delta_log_age=0.05, chunk_size=20)
+    assert fake_cmd['requests'][4:] == [(7.6, 8.55)]
+    assert len(r.isochrone_set) == 71
+
+
+def test_cached_isochrone_set(fake_cmd, monkeypatch):
+    from padova.cmd import AgeGridRequest
+    from padova.resultcache import PadovaCache
+    kwargs = dict(z=0.012, min_log_age=6.6, max_log_age=10.1,
+                  delta_log_age=0.05)
+    AgeGridRequest(**kwargs).isochrone_set
+    reads = []
+    cache_open = PadovaCache.open
+
+    def open(self, settings):
+        reads.append(settings)
+        return cache_open(self, settings)
+
+    monkeypatch.setattr(PadovaCache, 'open', open)
+    r = AgeGridRequest(**kwargs)
+    assert len(r.isochrone_set) == 71
+    assert reads == []
+    # The raw output is only read when asked for
+    assert r.data.startswith('#')
+    assert len(reads) == 1
+    assert len(fake_cmd['requests']) == 1
+
+
+def test_chunks_with_cache_limits(fake_cmd, monkeypatch):
+    from padova.cmd import AgeGridRequest
+    from padova.resultcache import PadovaCache
+    monkeypatch.setattr(PadovaCache, 'max_entries', 2)
+    r = AgeGridRequest(z=0.012, min_log_age=6.6, max_log_age=10.1,
+                       delta_log_age=0.05, chunk_size=20)
+    assert len(r.isochrone_set) == 71
+    assert len(r.data.splitlines()) > 10361
+    # Entries of the finished request are evicted by later writes
+    AgeGridRequest(z=0.02, min_log_age=6.6, max_log_age=6.6,
+                   delta_log_age=0.05)
+    assert PadovaCache().stats()['entries'] == 2
+
+
+def test_chunks_fetched_once(fake_cmd, monkeypatch):
+    from padova.cmd import AgeGridRequest
+    from padova.resultcache import PadovaCache
+    reads = []
+    cache_open = PadovaCache.open
+
+    def open(self, settings):
+        reads.append(settings.__hash__())
+        return cache_open(self, settings)
+
+    monkeypatch.setattr(PadovaCache, 'open', open)
+    r = AgeGridRequest(z=0.012, min_log_age=6.6, max_log_age=10.1,
+                       delta_log_age=0.05, chunk_size=20)
+    assert len(r.isochrone_set) == 71
+    assert len(fake_cmd['requests']) == 4
+    # Each fetched chunk is parsed from the cache once
+    assert len(reads) == len(set(reads)) == 4
+
+
+def test_incremental_age_grid(fake_cmd):
+    from padova.cmd import AgeGridRequest
+    AgeGridRequest(z=0.012, min_log_age=9.0, max_log_age=9.5,
+                   delta_log_age=0.05)
+    AgeGridRequest(z=0.012, min_log_age=9.7, max_log_age=10.0,
+                   delta_log_age=0.05)
+    r = AgeGridRequest(z=0.012, min_log_age=8.8, max_log_age=10.1,
+                       delta_log_age=0.05, chunk_size=3)
+    # Only the missing ranges are requested, in chunks of 3 nodes
+    assert fake_cmd['requests'][2:] == [(8.8, 8.9), (8.95, 8.95),
+                                        (9.55, 9.65), (10.05, 10.1)]
+    isoc_set = r.isochrone_set
+    assert len(isoc_set) == 27
+    ages = [round(np.log10(isoc.age), 2) for isoc in isoc_set]
+    assert ages == [round(8.8 + 0.05 * i, 2) for i in range(27)]
+
+    # Nodes are shared by grids with a different step
+    AgeGridRequest(z=0.012, min_log_age=9.0, max_log_age=10.0,
+                   delta_log_age=0.1)
+    assert len(fake_cmd['requests']) == 6
+
+
+def test_grid_node_runs():
+    from padova.cmd import _node_runs
+    assert _node_runs([0, 1, 2, 5, 6, 9]) == [(0, 2), (5, 6), (9, 9)]
+    assert _node_runs([0, 1, 2, 3, 4], chunk_size=2) == [(0, 1), (2, 3),
+                                                         (4, 4)]
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for padova.cmdserver, the stand-in CMD server, through the padova
+request classes.
+"""
+
+import pytest
+
+
+@pytest.fixture
+def standin(tmpdir, monkeypatch):
+    """A running stand-in server, with an empty padova cache."""
+    from padova.cmdserver import StandInCMDServer
+    from padova.interface import HostLimiter
+    monkeypatch.setenv('HOME', str(tmpdir))
+    server = StandInCMDServer()
+    HostLimiter.configure(server.url, min_interval=0.)
+    with server:
+        yield server
+
+
+def test_isochrone_request(standin):
+    from padova.cmd import IsochroneRequest
+    from padova.interface import CMDSession
+    session = CMDSession(webserver=standin.url)
+    r = IsochroneRequest(z=0.012, log_age=9., session=session)
+    assert r.isochrone.meta['Age'] == 1e9
+    assert standin.n_posts == 1
+    assert standin.n_gets == 1
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_grid_requests(standin, compress):
+    from padova.cmd import AgeGridRequest, MetallicityGridRequest
+    from padova.interface import CMDSession
+    standin.compress = compress
+    session = CMDSession(webserver=standin.url)
+    r = AgeGridRequest(z=0.012, min_log_age=8., max_log_age=9.,
+                       delta_log_age=0.05, chunk_size=5, session=session)
+    assert len(r.isochrone_set) == 21
+    assert standin.n_posts == 5
+    r = MetallicityGridRequest(log_age=9., min_z=0.01, max_z=0.02,
+                               delta_z=0.005, session=session)
+    assert [m['Z'] for m in r.isochrone_set.metas] == [0.01, 0.015, 0.02]
+
+
+def test_error_page(standin):
+    from padova.interface import CMDSession
+    from padova.settings import Settings
+    session = CMDSession(webserver=standin.url, backoff_factor=0.01)
+    # Past the oldest bundled isochrone
+    settings = Settings.load_package_settings(isoc_val='1', isoc_lage0=10.12,
+                                              isoc_lage1=10.13)
+    with pytest.raises(RuntimeError) as excinfo:
+        session.fetch(settings)
+    assert 'No isochrones' in str(excinfo.value)
+    assert standin.n_gets == 0
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for padova.interface, against a local server that mimics the two CMD
+request steps (``cmd_server`` in conftest.py).
+"""
+
+from pkg_resources import resource_filename
+import pytest
+
+
+@pytest.fixture
+def settings():
+    from padova.settings import Settings
+    return Settings.load_package_settings()
+
+
+def test_fetch(cmd_server, settings):
+    from padova.interface import CMDSession
+    session = CMDSession(webserver=cmd_server['url'])
+    r = session.fetch(settings)
+    assert r.startswith('# File generated by CMD 2.5')
+    # The form submission and download share a keep-alive connection
+    assert len(cmd_server['clients']) == 1
+
+
+def test_retry(cmd_server, settings):
+    from padova.interface import CMDSession
+    cmd_server['n_fail'] = 2
+    session = CMDSession(webserver=cmd_server['url'], backoff_factor=0.01)
+    r = session.fetch(settings)
+    assert r.startswith('# File generated by CMD 2.5')
+    assert cmd_server['posts'] == 3
+
+
+def test_retries_exhausted(cmd_server, settings):
+    from padova.interface import CMDSession
+    cmd_server['n_fail'] = 10
+    session = CMDSession(webserver=cmd_server['url'], max_retries=2,
+                         backoff_factor=0.01)
+    with pytest.raises(RuntimeError):
+        session.fetch(settings)
+    assert cmd_server['posts'] == 3
+
+
+def test_deadline(cmd_server, settings):
+    from padova.interface import CMDSession
+    cmd_server['n_fail'] = 10
+    session = CMDSession(webserver=cmd_server['url'], backoff_factor=1.,
+                         deadline=0.5)
+    with pytest.raises(RuntimeError):
+        session.fetch(settings)
+    assert cmd_server['posts'] == 1
+
+
+def test_cmd_error_not_retried(cmd_server, settings):
+    from padova.interface import CMDSession
+    cmd_server['error'] = True
+    session = CMDSession(webserver=cmd_server['url'], backoff_factor=0.01)
+    with pytest.raises(RuntimeError) as excinfo:
+        session.fetch(settings)
+    assert 'Bad age' in str(excinfo.value)
+    assert cmd_server['posts'] == 1
+
+
+def test_truncated_download_retried(cmd_server, settings):
+    from padova.interface import CMDSession
+    cmd_server['n_truncate'] = 1
+    session = CMDSession(webserver=cmd_server['url'], backoff_factor=0.01)
+    r = session.fetch(settings)
+    assert r.startswith('# File generated by CMD 2.5')
+    assert len(cmd_server['gets']) == 2
+
+
+def test_backoff_releases_host(cmd_server, settings, monkeypatch):
+    from padova import interface
+    from padova.interface import CMDSession, HostLimiter
+    HostLimiter.configure(cmd_server['url'], max_concurrent=1,
+                          min_interval=0.)
+    limiter = HostLimiter.for_host(cmd_server['url'])
+    released = []
+
+    def sleep(seconds):
+        # Another request could take the host's only slot
+        acquired = limiter._semaphore.acquire(False)
+        if acquired:
+            limiter._semaphore.release()
+        released.append(acquired)
+
+    monkeypatch.setattr(interface.time, 'sleep', sleep)
+    cmd_server['n_fail'] = 1
+    session = CMDSession(webserver=cmd_server['url'], backoff_factor=0.01)
+    session.fetch(settings)
+    assert released == [True]
+
+
+def test_download(cmd_server, settings):
+    import io
+    from padova.interface import CMDSession
+    cmd_server['n_truncate'] = 1
+    session = CMDSession(webserver=cmd_server['url'], backoff_factor=0.01)
+    f = io.BytesIO()
+    n_bytes = session.download(settings, f)
+    # The partial first download is discarded
+    with open(resource_filename('padova', 'data/isocz0120.dat'), 'rb') as g:
+        assert f.getvalue() == g.read()
+    assert n_bytes == len(f.getvalue())
+
+
+def test_request_streams_to_cache(cmd_server, settings, tmpdir):
+    from padova.interface import CMDSession, CMDRequest
+    from padova.resultcache import PadovaCache
+    cache = PadovaCache(cache_dir=str(tmpdir))
+    session = CMDSession(webserver=cmd_server['url'])
+    r = CMDRequest(settings, session=session, cache=cache)
+    # The output is not held in memory
+    assert r._r is None
+    assert len(r.isochrone_set) == 71
+    assert r.data.startswith('# File generated by CMD 2.5')
+    assert not any(p.basename.startswith('.tmp') for p in tmpdir.listdir())
+
+
+def test_single_flight(cmd_server, settings, tmpdir):
+    import threading
+    from padova.interface import CMDSession, CMDRequest, HostLimiter
+    from padova.resultcache import PadovaCache
+    # Slow responses, so that all requests start while the first is running
+    url = cmd_server['url'] + '/slow'
+    HostLimiter.configure(url, max_concurrent=8, min_interval=0.)
+    session = CMDSession(webserver=url)
+    isoc_sets = []
+
+    def request():
+        cache = PadovaCache(cache_dir=str(tmpdir))
+        isoc_sets.append(CMDRequest(settings, session=session,
+                                    cache=cache).isochrone_set)
+
+    threads = [threading.Thread(target=request) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # One request fetched the isochrones while the others waited for it
+    assert cmd_server['posts'] == 1
+    assert len(cmd_server['gets']) == 1
+    assert [len(s) for s in isoc_sets] == [71] * 4
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for padova.isocdata
+"""
+
+import numpy as np
+from pkg_resources import resource_filename
+import pytest
+
+
+@pytest.fixture
+def isoc_path():
+    return resource_filename('padova', 'data/isocz0120.dat')
+
+
+@pytest.fixture
+def isoc_set(isoc_path):
+    from padova.isocdata import IsochroneSet
+    with open(isoc_path) as f:
+        isoc_set = IsochroneSet(f)
+    return isoc_set
+
+
+def test_n_isochrones(isoc_set):
+    assert len(isoc_set) == 71
+    assert sum(len(isoc) for isoc in isoc_set.isochrones) == 10361
+
+
+def test_colnames(isoc_set):
+    isoc = isoc_set[0]
+    assert isoc.colnames[:2] == ['logageyr', 'M_ini']
+    assert isoc.filter_names == ['J', 'H', 'Ks']
+
+
+def test_meta(isoc_set):
+    isoc = isoc_set[0]
+    assert isoc.z == 0.012
+    assert isoc.age == 3.981e6
+    assert isoc.age_code == '06.60'
+    assert np.all(isoc['logageyr'] == 6.6)
+    assert isoc_set[-1].age_code == '10.10'
+
+
+def test_columns(isoc_set):
+    columns = isoc_set.columns
+    assert list(columns) == isoc_set[0].colnames
+    for name, column in columns.items():
+        assert column.flags['C_CONTIGUOUS']
+        assert len(column) == isoc_set.offsets[-1]
+        assert np.array_equal(column, isoc_set.data[name])
+    # Isochrones are views of the columns
+    isoc = isoc_set[1]
+    isoc['J'][0] = 99.
+    assert columns['J'][isoc_set.offsets[1]] == 99.
+
+
+def test_matches_genfromtxt(isoc_set, isoc_path):
+    names = isoc_set[0].colnames
+    dt = [(n, np.int64 if n in ('stage', 'pmode') else np.float64)
+          for n in names]
+    data = np.genfromtxt(isoc_path, dtype=np.dtype(dt), delimiter='\t',
+                         autostrip=True, comments='#',
+                         usecols=range(1, len(names) + 1))
+    parsed = np.concatenate([np.array(isoc) for isoc in isoc_set])
+    for name in names:
+        assert np.array_equal(parsed[name], data[name])
+
+
+def test_short_row(isoc_path, tmpdir):
+    from padova.isocdata import IsochroneSet
+    with open(isoc_path) as f:
+        lines = f.readlines()
+    i = [j for j, line in enumerate(lines) if not line.startswith('#')][5]
+    lines[i] = '\t'.join(lines[i].split('\t')[:5]) + '\n'
+    path = tmpdir.join('short.dat')
+    path.write(''.join(lines))
+    with pytest.raises(ValueError):
+        with open(str(path)) as f:
+            IsochroneSet(f)
+
+
+def test_late_label(isoc_path, tmpdir):
+    from padova.isocdata import IsochroneSet
+    with open(isoc_path) as f:
+        lines = f.readlines()
+    i = [j for j, line in enumerate(lines) if not line.startswith('#')][500]
+    parts = lines[i].split('\t')
+    parts[3] = 'x'  # M_act
+    lines[i] = '\t'.join(parts)
+    path = tmpdir.join('label.dat')
+    path.write(''.join(lines))
+    with open(str(path)) as f:
+        isoc_set = IsochroneSet(f)
+    assert np.isnan(isoc_set.data['M_act'][500])
+    assert np.sum(np.isnan(isoc_set.data['M_act'])) == 1
+
+
+def test_join_isochrone_sets(isoc_path):
+    from padova.isocdata import IsochroneSet, join_isochrone_sets
+    with open(isoc_path) as f:
+        left_set = IsochroneSet(f)
+    with open(isoc_path) as f:
+        right_set = IsochroneSet(f)
+    joined = join_isochrone_sets(left_set, right_set, right_bands=['J'])
+    assert joined[0].colnames[-1] == 'J'
+    n_rows = [len(isoc) for isoc in joined.isochrones]
+    assert list(np.diff(joined.offsets)) == n_rows
+    assert len(joined.data) == sum(n_rows)
+    assert joined.data.dtype.names == tuple(joined[0].colnames)
+    assert joined[-1].age == right_set[-1].age
+
+
+def _reversed_set(isoc_set, bands_offset=0.):
+    """The isochrones of `isoc_set` in reverse order, with `bands_offset`
+    added to their bands.
+    """
+    from collections import OrderedDict
+    from padova.isocdata import IsochroneSet
+    o = isoc_set.offsets
+    blocks = [isoc_set.data[o[i]:o[i + 1]]
+              for i in reversed(range(len(isoc_set)))]
+    data = np.concatenate(blocks)
+    for band in isoc_set[0].filter_names:
+        data[band] += bands_offset
+    offsets = np.concatenate([[0], np.cumsum([len(b) for b in blocks])])
+    metas = [OrderedDict(m) for m in isoc_set.metas[::-1]]
+    return IsochroneSet.from_array(data, offsets, metas,
+                                   isoc_set.header_lines)
+
+
+def test_join_matches_join_isochrones(isoc_set):
+    from padova.isocdata import join_isochrone_sets, join_isochrones
+    right_set = _reversed_set(isoc_set, bands_offset=1.)
+    names = isoc_set.data.dtype.names
+    joined = join_isochrone_sets(isoc_set, right_set, right_bands=['J'])
+    # The left set is not modified
+    assert isoc_set.data.dtype.names == names
+    assert np.array_equal(joined.data['J'], isoc_set.data['J'] + 1.)
+    assert np.array_equal(joined.offsets, isoc_set.offsets)
+    # Isochrones without repeated masses, which an astropy join pairs in
+    # all combinations
+    for i in (0, 35):
+        expected = join_isochrones(isoc_set[i], right_set[-1 - i],
+                                   right_bands=['J'])
+        assert joined[i].colnames == expected.colnames
+        for name in expected.colnames:
+            assert np.array_equal(joined[i][name], expected[name])
+
+
+def test_join_unmatched_rows(isoc_set):
+    from padova.isocdata import join_isochrone_sets
+    right_set = _reversed_set(isoc_set)
+    # Last row of the first isochrone
+    right_set.columns['M_ini'][-1] += 1e-3
+    joined = join_isochrone_sets(isoc_set, right_set)
+    assert joined.data.dtype.names[-3:] == ('J', 'H', 'Ks')
+    assert np.isnan(joined.data['J'][isoc_set.offsets[1] - 1])
+    assert np.sum(np.isnan(joined.data['J'])) == 1
+
+
+def test_join_mismatched_grids(isoc_set):
+    from padova.isocdata import join_isochrone_sets
+    right_set = _reversed_set(isoc_set)
+    right_set.metas[0]['Z'] = 0.019
+    with pytest.raises(ValueError):
+        join_isochrone_sets(isoc_set, right_set, right_bands=['J'])
+
+
+@pytest.mark.parametrize('bands', [None, ['Ks', 'J']])
+def test_set_export_for_starfish(isoc_set, tmpdir, bands):
+    import os
+    paths = isoc_set.export_for_starfish(str(tmpdir.join('set')),
+                                         bands=bands)
+    assert len(paths) == len(isoc_set)
+    assert os.path.basename(paths[-1]) == 'z0120_10.10'
+    # Byte-identical to the files of Isochrone.export_for_starfish
+    for i in (0, 35, 70):
+        isoc_set[i].export_for_starfish(str(tmpdir.join('isoc')),
+                                        bands=bands)
+        name = os.path.basename(paths[i])
+        with open(paths[i], 'rb') as f:
+            exported = f.read()
+        with open(str(tmpdir.join('isoc', name)), 'rb') as f:
+            assert exported == f.read()
+
+
+@pytest.fixture
+def grid_set(isoc_set):
+    """Isochrones of the bundled table at two metallicities, Z-major."""
+    from collections import OrderedDict
+    from padova.isocdata import concatenate_isochrone_sets, IsochroneSet
+    other = IsochroneSet.from_columns(
+        isoc_set.columns, isoc_set.offsets,
+        [OrderedDict(m, Z=0.019) for m in isoc_set.metas],
+        isoc_set.header_lines)
+    return concatenate_isochrone_sets([isoc_set, other])
+
+
+def test_select(grid_set):
+    isoc = grid_set.select(9.3, z=0.019)
+    assert isoc.z == 0.019
+    assert isoc.age_code == '09.30'
+    with pytest.raises(KeyError):
+        grid_set.select(9.31, z=0.019)
+    with pytest.raises(KeyError):
+        grid_set.select(9.3, z=0.02)
+    # z is required for several metallicities
+    with pytest.raises(ValueError):
+        grid_set.select(9.3)
+
+
+def test_nearest(grid_set, isoc_set):
+    isoc = grid_set.nearest(9.32, z=0.017)
+    assert (isoc.z, isoc.age_code) == (0.019, '09.30')
+    assert isoc_set.nearest(5.).age_code == '06.60'
+    assert isoc_set.nearest(9.33).age_code == '09.35'
+
+
+def test_between(grid_set):
+    # An age range of one metallicity views the set's columns
+    subset = grid_set.between(log_age=(9., 9.5), z=(0.015, 0.02))
+    assert len(subset) == 11
+    assert all(isoc.z == 0.019 for isoc in subset.isochrones)
+    assert np.shares_memory(subset.columns['J'], grid_set.columns['J'])
+    assert subset[0].age_code == '09.00'
+    assert np.array_equal(subset.data, np.concatenate(
+        [np.array(grid_set.select(a, 0.019)) for a in subset.log_ages]))
+    # Across metallicities the rows are copied
+    subset = grid_set.between(log_age=(9., 9.5))
+    assert len(subset) == 22
+    assert [isoc.z for isoc in subset][10:12] == [0.012, 0.019]
+    assert len(subset.between(z=(0.001, 0.005))) == 0
+
+
+@pytest.mark.parametrize('memory_map', [False, True])
+def test_lazy(isoc_path, isoc_set, memory_map):
+    from padova.isocdata import IsochroneSet
+    with open(isoc_path, 'rb') as f:
+        lazy_set = IsochroneSet(f, lazy=True, memory_map=memory_map)
+        # Only the positions of the isochrones are known
+        assert lazy_set._parsed.sum() == 0
+        assert len(lazy_set) == 71
+        assert np.array_equal(lazy_set.log_ages, isoc_set.log_ages)
+        isoc = lazy_set.select(9.)
+        assert lazy_set._parsed.sum() == 1
+        assert np.array_equal(np.array(isoc), np.array(isoc_set.select(9.)))
+        assert len(lazy_set.between(log_age=(9.5, 9.6))) == 3
+        assert lazy_set._parsed.sum() == 4
+        if not memory_map:
+            assert np.array_equal(lazy_set.data, isoc_set.data)
+    # Memory-mapped files are parsed after they are closed
+    assert np.array_equal(lazy_set.data, isoc_set.data)
+    assert lazy_set.metas == isoc_set.metas
+    assert lazy_set._parsed.all()
+
+
+def test_projected_columns(isoc_path, isoc_set):
+    from padova.isocdata import IsochroneSet
+    with open(isoc_path) as f:
+        projected = IsochroneSet(f, columns=['Ks', 'M_ini'])
+    # Columns keep the table order
+    assert projected.dtype.names == ('M_ini', 'Ks')
+    assert np.array_equal(projected.columns['Ks'], isoc_set.columns['Ks'])
+    # Isochrones are still indexed by their precise log age
+    assert np.array_equal(projected.log_ages, isoc_set.log_ages)
+    assert projected.select(9.).filter_names == ['Ks']
+    with pytest.raises(ValueError):
+        with open(isoc_path) as f:
+            IsochroneSet(f, columns=['M_ini', 'V'])
+
+
+def test_compact(isoc_path, isoc_set):
+    from padova.isocdata import IsochroneSet
+    with open(isoc_path) as f:
+        compact_set = IsochroneSet(f, compact=True)
+    assert compact_set.dtype['J'] == np.float32
+    assert compact_set.dtype['stage'] == np.int8
+    assert compact_set.dtype['M_ini'] == np.float64
+    assert len(compact_set.buffer) < len(isoc_set.buffer)
+    assert np.allclose(compact_set.columns['J'], isoc_set.columns['J'])
+    assert np.array_equal(compact_set.columns['stage'],
+                          isoc_set.columns['stage'])
+    assert compact_set.metas == isoc_set.metas
+
+
+def test_parallel(isoc_path, isoc_set):
+    from padova.isocdata import IsochroneSet
+    with open(isoc_path) as f:
+        parallel_set = IsochroneSet(f, n_processes=2, columns=['M_ini', 'J',
+                                                               'stage'])
+    assert np.array_equal(parallel_set.offsets, isoc_set.offsets)
+    for name in parallel_set.dtype.names:
+        assert np.array_equal(parallel_set.columns[name],
+                              isoc_set.columns[name])
+    assert parallel_set.metas == isoc_set.metas
+    assert parallel_set.select(9.).age == 1e9
+
+
+def _shared_column_sum(task):
+    """Sum a column of an isochrone set attached from shared memory."""
+    from padova.isocdata import IsochroneSet
+    name, column = task
+    isoc_set = IsochroneSet.from_shared_memory(name)
+    return float(np.nansum(isoc_set.columns[column]))
+
+
+def test_shared_memory(isoc_set):
+    import gc
+    import multiprocessing
+    from padova.isocdata import IsochroneSet, shared_memory
+    if shared_memory is None:
+        pytest.skip('shared memory requires Python 3.8')
+    shm = isoc_set.to_shared_memory()
+    try:
+        shared_set = IsochroneSet.from_shared_memory(shm.name)
+        assert np.array_equal(shared_set.data, isoc_set.data)
+        assert shared_set.metas == isoc_set.metas
+        assert shared_set.header_lines == isoc_set.header_lines
+        # Isochrones outlive the set they view
+        isoc = shared_set.select(9.)
+        del shared_set
+        gc.collect()
+        assert np.array_equal(np.array(isoc), np.array(isoc_set.select(9.)))
+        del isoc
+
+        pool = multiprocessing.Pool(2)
+        try:
+            sums = pool.map(_shared_column_sum, [(shm.name, 'J')] * 2)
+        finally:
+            pool.close()
+            pool.join()
+        assert sums == [float(np.nansum(isoc_set.columns['J']))] * 2
+    finally:
+        shm.close()
+        shm.unlink()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for padova.isocinterp
+"""
+
+import numpy as np
+from pkg_resources import resource_filename
+import pytest
+
+
+@pytest.fixture(scope='module')
+def isoc_set():
+    from padova.isocdata import IsochroneSet
+    with open(resource_filename('padova', 'data/isocz0120.dat')) as f:
+        isoc_set = IsochroneSet(f)
+    return isoc_set
+
+
+@pytest.fixture(scope='module')
+def interpolator(isoc_set):
+    from padova.isocinterp import IsochroneInterpolator
+    return IsochroneInterpolator(isoc_set, points_per_phase=20)
+
+
+def test_stage_labels(isoc_set):
+    assert isoc_set[0].meta['stages'][0] == [35, 'TO']
+    assert isoc_set[-1].meta['stages'][-1] == [143, 'LTP']
+
+
+def test_grid(interpolator):
+    assert len(interpolator.log_ages) == 71
+    assert interpolator.log_ages[0] == 6.6
+    assert list(interpolator.zs) == [0.012]
+
+
+def test_node(isoc_set, interpolator):
+    isoc = interpolator(9.0)
+    node = isoc_set[48]
+    assert isoc.colnames == node.colnames
+    assert isoc.z == 0.012
+    assert [s for r, s in isoc.meta['stages']] == \
+        ['TO', 'RGBb', 'RGBt', 'BHeb', 'EHeb']
+    # Primary points and the ends of the isochrone are node rows
+    stages = dict((s, r) for r, s in node.meta['stages'])
+    for row, stage in isoc.meta['stages']:
+        assert isoc['logTe'][row] == node['logTe'][stages[stage]]
+    assert isoc['M_ini'][0] == node['M_ini'][0]
+    assert isoc['M_ini'][-1] == node['M_ini'][-1]
+
+
+def test_between_nodes(isoc_set, interpolator):
+    isoc = interpolator(9.025)
+    assert np.allclose(isoc['logageyr'], 9.025)
+    assert np.isclose(isoc.age, 10. ** 9.025)
+    to = isoc.meta['stages'][0][0]
+    to_te = [node['logTe'][dict((s, r) for r, s
+                                in node.meta['stages'])['TO']]
+             for node in (isoc_set[48], isoc_set[49])]
+    assert np.isclose(isoc['logTe'][to], np.mean(to_te))
+    # Evolution is monotonic in initial mass
+    assert np.all(np.diff(isoc['M_ini']) >= 0.)
+
+
+def test_outside_grid(interpolator):
+    with pytest.raises(ValueError):
+        interpolator(10.5)
+    with pytest.raises(ValueError):
+        interpolator(9.0, z=0.02)
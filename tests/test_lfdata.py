@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for padova.lfdata
+"""
+
+import numpy as np
+from pkg_resources import resource_filename
+import pytest
+
+
+@pytest.fixture
+def lf_table():
+    from padova.lfdata import LFTable
+    with open(resource_filename('padova', 'data/lf_0019.dat')) as f:
+        lf_table = LFTable(f)
+    return lf_table
+
+
+def test_n_lfs(lf_table):
+    assert len(lf_table.lfs) == 36
+    assert all(len(lf.table) == 200 for lf in lf_table.lfs)
+
+
+def test_specs(lf_table):
+    lf = lf_table.lfs[0]
+    assert lf.z == 0.019
+    assert lf.age == 3.98e6
+    assert np.all(lf.table['age/yr'] == lf.age)
+    assert lf_table.lfs[-1].age_code == '10.10'
+
+
+def test_filter_names(lf_table):
+    lf = lf_table.lfs[0]
+    assert lf.filter_names == ['u*', "g'", "r'", "i'", "z'"]
+    assert lf.info[0].startswith('File generated by CMD 2.5')
+
+
+def test_single_lf():
+    from padova.lfdata import LFTable
+    with open(resource_filename('padova', 'data/lf_1gyr_0019.dat')) as f:
+        lf_table = LFTable(f)
+    assert len(lf_table.lfs) == 1
+    assert lf_table.lfs[0].age == 1e9
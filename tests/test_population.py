@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for padova.population
+"""
+
+import numpy as np
+from pkg_resources import resource_filename
+import pytest
+
+
+@pytest.fixture(scope='module')
+def isochrone():
+    from padova.isocdata import IsochroneSet
+    with open(resource_filename('padova', 'data/isocz0120.dat')) as f:
+        isoc_set = IsochroneSet(f)
+    return isoc_set[30]
+
+
+def test_sample(isochrone):
+    from padova.population import PopulationSampler
+    sampler = PopulationSampler(isochrone)
+    stars = sampler.sample(100000, random_state=1)
+    assert len(stars) == 100000
+    assert stars.colnames == ['M_ini', 'J', 'H', 'Ks']
+    assert stars.meta['Z'] == isochrone.z
+    m = np.asarray(isochrone['M_ini'])
+    assert stars['M_ini'].min() >= m[0]
+    assert stars['M_ini'].max() <= m[-1]
+    for band in ('J', 'H', 'Ks'):
+        assert np.all(np.isfinite(stars[band]))
+
+    # The fraction of stars below a mass follows int_IMF
+    cdf = np.asarray(isochrone['int_IMF'])
+    i = 20
+    expected = (cdf[i] - cdf[0]) / (cdf[-1] - cdf[0])
+    fraction = np.mean(stars['M_ini'] < m[i])
+    assert abs(fraction - expected) < 0.01
+
+
+def test_interpolation(isochrone):
+    from padova.population import PopulationSampler
+    sampler = PopulationSampler(isochrone, bands=['Ks'])
+    stars = sampler.sample(1000, random_state=2)
+    assert stars.colnames == ['M_ini', 'Ks']
+    # On the main sequence, magnitudes follow the isochrone's mass relation
+    m = np.asarray(isochrone['M_ini'])
+    ms = stars['M_ini'] < m[10]
+    assert np.allclose(stars['Ks'][ms],
+                       np.interp(stars['M_ini'][ms], m[:11],
+                                 np.asarray(isochrone['Ks'])[:11]))
+
+
+def test_iter_sample(isochrone):
+    from padova.population import PopulationSampler
+    sampler = PopulationSampler(isochrone)
+    chunks = list(sampler.iter_sample(2500, chunk_size=1000,
+                                      random_state=3))
+    assert [len(c) for c in chunks] == [1000, 1000, 500]
+    # Same stars as drawing at once from the same random state
+    stars = sampler.sample(2500, random_state=3)
+    assert np.all(np.concatenate([c['M_ini'] for c in chunks])
+                  == stars['M_ini'])
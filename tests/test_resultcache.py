@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for padova.resultcache
+"""
+
+import os
+
+import numpy as np
+from pkg_resources import resource_filename
+import pytest
+
+
+@pytest.fixture
+def settings():
+    from padova.settings import Settings
+    return Settings.load_package_settings()
+
+
+@pytest.fixture
+def cache(tmpdir):
+    from padova.resultcache import PadovaCache
+    # Uncompressed, so that entry sizes are known
+    return PadovaCache(cache_dir=str(tmpdir), compression=False)
+
+
+@pytest.fixture
+def isoc_set():
+    from padova.isocdata import IsochroneSet
+    with open(resource_filename('padova', 'data/isocz0120.dat')) as f:
+        isoc_set = IsochroneSet(f)
+    return isoc_set
+
+
+def test_text_roundtrip(cache, settings):
+    assert settings not in cache
+    cache[settings] = 'isochrones'
+    assert settings in cache
+    assert cache[settings] == 'isochrones'
+
+
+@pytest.mark.parametrize('compression', ['gz', 'bz2', 'xz', False])
+def test_compression(tmpdir, settings, compression):
+    from padova.resultcache import PadovaCache, lzma
+    from padova.utils import compression_type
+    if compression == 'xz' and lzma is None:
+        pytest.skip('lzma requires Python 3')
+    cache = PadovaCache(cache_dir=str(tmpdir), compression=compression)
+    with open(resource_filename('padova', 'data/isocz0120.dat')) as f:
+        text = f.read()
+    cache[settings] = text
+    assert cache[settings] == text
+    path = cache._cache_path(settings)
+    assert compression_type(path) == (compression or None)
+    if compression:
+        assert os.path.getsize(path) < len(text) / 3
+
+    # Entries are read whatever the compression of the reading cache
+    assert PadovaCache(cache_dir=str(tmpdir), compression='bz2')[settings] \
+        == text
+
+
+def test_uncompressed_entry(tmpdir, settings):
+    from padova.resultcache import PadovaCache
+    cache = PadovaCache(cache_dir=str(tmpdir))
+    # Entries written by earlier versions are plain text files
+    with open(cache._cache_path(settings), 'w') as f:
+        f.write('isochrones')
+    assert cache[settings] == 'isochrones'
+
+
+def test_unknown_compression(tmpdir):
+    from padova.resultcache import PadovaCache
+    with pytest.raises(ValueError):
+        PadovaCache(cache_dir=str(tmpdir), compression='zip')
+
+
+def test_writer(cache, settings, tmpdir):
+    with cache.writer(settings) as f:
+        f.write(b'iso')
+        # The entry only appears once complete
+        assert settings not in cache
+        f.write(b'chrones')
+    assert cache[settings] == 'isochrones'
+
+    with pytest.raises(IOError):
+        with cache.writer(settings) as f:
+            f.write(b'partial')
+            raise IOError('connection lost')
+    # A failed write keeps the previous entry and leaves no temporary file
+    assert cache[settings] == 'isochrones'
+    assert not any(p.basename.startswith('.tmp') for p in tmpdir.listdir())
+
+
+def _locked_increment(cache_dir, settings):
+    """Increment a counter file while holding the cache lock."""
+    import time
+    from padova.resultcache import PadovaCache
+    cache = PadovaCache(cache_dir=cache_dir)
+    path = os.path.join(cache_dir, 'counter')
+    with cache.lock(settings):
+        with open(path) as f:
+            n = int(f.read())
+        time.sleep(0.05)
+        with open(path, 'w') as f:
+            f.write(str(n + 1))
+
+
+def test_lock(cache, settings, tmpdir):
+    import multiprocessing
+    tmpdir.join('counter').write('0')
+    processes = [multiprocessing.Process(target=_locked_increment,
+                                         args=(str(tmpdir), settings))
+                 for i in range(4)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    # No increment was lost
+    assert tmpdir.join('counter').read() == '4'
+
+
+def test_isochrone_set_roundtrip(cache, settings, isoc_set):
+    assert not cache.has_isochrone_set(settings)
+    cache.set_isochrone_set(settings, isoc_set)
+    assert cache.has_isochrone_set(settings)
+
+    cached_set = cache.get_isochrone_set(settings)
+    assert isinstance(cached_set.buffer, np.memmap)
+    assert len(cached_set) == len(isoc_set)
+    assert np.array_equal(cached_set.offsets, isoc_set.offsets)
+    for cached, isoc in zip(cached_set.isochrones, isoc_set.isochrones):
+        assert cached.z == isoc.z
+        assert cached.age == isoc.age
+        assert cached.info == isoc.info
+        assert cached.colnames == isoc.colnames
+        assert np.array_equal(np.array(cached), np.array(isoc))
+
+
+def test_structured_isochrone_set(cache, settings, isoc_set):
+    import json
+    # Entries cached before isochrone sets were columnar
+    cache.set_isochrone_set(settings, isoc_set)
+    data_path, index_path = cache._isochrone_set_paths(settings)
+    np.save(data_path, isoc_set.data)
+    with open(index_path) as f:
+        index = json.load(f)
+    del index['columns']
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    cached_set = cache.get_isochrone_set(settings)
+    assert np.array_equal(cached_set.data, isoc_set.data)
+
+
+def _fill(cache, n):
+    """Cache `n` results with increasing access times."""
+    from padova.settings import Settings
+    settings = []
+    for i in range(n):
+        s = Settings.load_package_settings(isoc_age=1e9 + i * 1e8)
+        cache[s] = 'x' * 100
+        t = 1000. + i
+        os.utime(cache._cache_path(s), (t, t))
+        settings.append(s)
+    return settings
+
+
+def test_prune_entries(cache):
+    settings = _fill(cache, 4)
+    # Reading the oldest entry makes it the most recently used
+    cache[settings[0]]
+    assert cache.prune(max_entries=2) == 2
+    assert settings[0] in cache
+    assert settings[1] not in cache
+    assert settings[2] not in cache
+    assert settings[3] in cache
+
+
+def test_prune_bytes(cache):
+    settings = _fill(cache, 4)
+    assert cache.prune(max_bytes=250) == 2
+    assert cache.stats()['bytes'] == 200
+    assert settings[3] in cache
+
+
+def test_limits_on_write(tmpdir):
+    from padova.resultcache import PadovaCache
+    cache = PadovaCache(cache_dir=str(tmpdir), max_entries=2)
+    _fill(cache, 3)
+    assert cache.stats()['entries'] == 2
+
+
+def test_stats(cache, settings):
+    stats = cache.stats()
+    assert stats['entries'] == 0
+    assert stats['bytes'] == 0
+    settings in cache
+    cache[settings] = 'isochrones'
+    settings in cache
+    stats = cache.stats()
+    assert stats['hits'] == stats['misses'] == 1
+    assert stats['entries'] == 1
+    assert stats['bytes'] == len('isochrones')
+
+
+def test_missing_entry(cache, settings):
+    with pytest.raises(KeyError):
+        cache[settings]
+    with pytest.raises(KeyError):
+        cache.get_isochrone_set(settings)
+
+
+def test_oversized_entry(tmpdir, settings):
+    from padova.resultcache import PadovaCache
+    cache = PadovaCache(cache_dir=str(tmpdir), max_bytes=10)
+    cache[settings] = 'x' * 100
+    assert settings in cache
+
+
+def test_pin(tmpdir):
+    from padova.resultcache import PadovaCache
+    cache = PadovaCache(cache_dir=str(tmpdir), max_entries=1)
+    settings = _fill(cache, 1)
+    cache.pin(settings[0])
+    settings += _fill(cache, 2)
+    assert settings[0] in cache
+    assert cache.stats()['entries'] == 2
+    cache.unpin(settings[0])
+    assert cache.prune() == 1
+    assert settings[0] not in cache
+
+
+def test_isochrone_set_stats(cache, settings, isoc_set):
+    cache.has_isochrone_set(settings)
+    cache.set_isochrone_set(settings, isoc_set)
+    cache.has_isochrone_set(settings)
+    stats = cache.stats()
+    assert stats['hits'] == stats['misses'] == 1
+
+
+def test_query(cache, isoc_set):
+    from padova.settings import Settings
+    settings = Settings.load_package_settings(photsys_file='2mass')
+    cache.set_isochrone_set(settings, isoc_set)
+    other = Settings.load_package_settings(photsys_file='ubvrijhk')
+    cache.set_isochrone_set(other, isoc_set)
+    cache[other] = 'isochrones'
+
+    found = cache.query(z_min=0.004, z_max=0.02, photsys='2mass')
+    assert len(found) == 71
+    assert [r['index'] for r in found] == list(range(71))
+    assert found[0]['log_age'] == 6.6
+    assert found[0]['z'] == 0.012
+    assert found[0]['n_rows'] == len(isoc_set[0])
+    assert found[0]['settings'] == settings.settings
+    assert len(cache.query(z_max=0.01)) == 0
+    found = cache.query(log_age_min=9., log_age_max=9.1)
+    assert [r['log_age'] for r in found] == [9., 9., 9.05, 9.05, 9.1, 9.1]
+
+    # Cached sets can be read by key
+    record = found[0]
+    isoc = cache.get_isochrone_set(record['key'])[record['index']]
+    assert isoc.age == record['age']
+
+    # Evicted entries leave the index
+    cache.prune(max_entries=1, keep=[other])
+    assert len(cache.query(photsys='2mass')) == 0
+    assert len(cache.query()) == 71
+
+
+def test_reindex(cache, settings, isoc_set, tmpdir):
+    from padova.resultcache import PadovaCache
+    cache.set_isochrone_set(settings, isoc_set)
+    cache[settings] = 'isochrones'
+    tmpdir.join('index.sqlite').remove()
+    # A new index is filled from the cached entries
+    rebuilt = PadovaCache(cache_dir=str(tmpdir))
+    found = rebuilt.query(photsys=settings['photsys_file'])
+    assert len(found) == 71
+    assert found[0]['settings'] == settings.settings
@@ -15,3 +15,63 @@ def settings():
 
 def test_alias(settings):
     assert settings['photsys'] == settings['photsys_file']
+
+
+def test_schema_shared(settings):
+    from padova.settings import Settings
+    other = Settings.load_package_settings(isoc_age=2e9)
+    assert other._schema is settings._schema
+    assert other['isoc_age'] == 2e9
+    assert settings['isoc_age'] != 2e9
+
+
+def test_hash(settings):
+    h = settings.__hash__()
+    settings['isoc_age'] = 2e9
+    assert settings.__hash__() != h
+    del settings['isoc_age']
+    assert settings.__hash__() == h
+
+
+def test_validate(settings):
+    with pytest.raises(AssertionError):
+        settings['isoc_age'] = 1e12
+    with pytest.raises(AssertionError):
+        settings.cmd_version = '2.5'
+    with pytest.raises(KeyError):
+        settings['no_such_setting'] = 1
+
+
+def test_frozen(settings):
+    from padova.settings import FrozenSettings
+    settings['isoc_age'] = 2e9
+    frozen = settings.freeze()
+    assert isinstance(frozen, FrozenSettings)
+    assert frozen.__hash__() == settings.__hash__()
+    assert frozen.settings == settings.settings
+    assert frozen.freeze() is frozen
+    with pytest.raises(TypeError):
+        frozen['isoc_age'] = 3e9
+    with pytest.raises(TypeError):
+        frozen.isoc_age = 3e9
+    with pytest.raises(TypeError):
+        del frozen['isoc_age']
+    # Changes to the original do not leak into the frozen copy
+    settings['isoc_age'] = 3e9
+    assert frozen['isoc_age'] == 2e9
+
+    other = frozen.replace(isoc_age=3e9)
+    assert isinstance(other, FrozenSettings)
+    assert other.__hash__() == settings.__hash__()
+    assert frozen['isoc_age'] == 2e9
+    with pytest.raises(AssertionError):
+        frozen.replace(isoc_age=1e12)
+
+
+def test_query(settings):
+    try:
+        from urllib.parse import urlencode
+    except ImportError:
+        from urllib import urlencode
+    settings['isoc_zeta'] = 0.012
+    assert settings.query == urlencode(settings.settings)